@@ -0,0 +1,126 @@
+## Benchmark: CSV parse throughput, schema-aware reader vs. plain pd.read_csv
+##
+## Writes a synthetic recording as CSV (tests/util.py:make_fake_data_file)
+##  and parses it with:
+##     - pd.read_csv: the untyped call pipeline() used to make
+##     - readers.read_csv with the 'c' and 'pyarrow' engines, for all neurons
+##        in float64 and float32, and for a quarter of the neurons selected
+##        by pattern
+##  and reports the file bytes parsed per second, the growth of the peak RSS
+##  while parsing (in a freshly spawned process per method, since pyarrow
+##  allocates outside of tracemalloc's reach), and checks every reader: the 'c' engine must give the
+##  values of pd.read_csv, and the 'pyarrow' engine, whose parser is
+##  correctly rounded, those of pd.read_csv(float_precision='round_trip'),
+##  with the same spike counts.
+##
+## Usage:
+##     python benchmarks/bench_csv.py [n_samples] [n_neurons]
+
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+sys.path.insert(0, str(Path(__file__).parent.parent / 'tests'))
+import util
+from my_pipeline import pipeline, readers
+
+PARAMETERS = {'sample_rate': 10000.0, 'threshold': 0.0}
+DIR_DATA = Path(tempfile.gettempdir()) / 'my_pipeline_benchmarks'
+
+
+def methods(n_neurons):
+    import pandas as pd
+
+    ## Neurons 1 to n_neurons // 4, as glob patterns
+    subset = [f'neuron_{ii}' for ii in range(1, n_neurons // 4 + 1)]
+    result = {'pd.read_csv': lambda filepath: pd.read_csv(filepath)}
+    for engine in readers.CSV_ENGINES:
+        result[engine] = lambda filepath, engine=engine: readers.read_csv(filepath, engine=engine)
+        result[engine + ' float32'] = lambda filepath, engine=engine: readers.read_csv(filepath, precision='float32', engine=engine)
+        result[engine + ' 1/4 neurons'] = lambda filepath, engine=engine: readers.read_csv(filepath, neurons=subset, engine=engine)
+    return result
+
+
+def measure(method, filepath, repeats=3):
+    walls = []
+    for _ in range(repeats):
+        tic = time.perf_counter()
+        data = method(filepath)
+        walls.append(time.perf_counter() - tic)
+    return data, min(walls)
+
+
+def measure_peak(name, filepath, n_neurons):
+    """
+    Growth of the peak RSS of a new process while it parses filepath.
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+        return pool.submit(_measure_peak, name, str(filepath), n_neurons).result()
+
+
+def _measure_peak(name, filepath, n_neurons):
+    import importlib
+    from my_pipeline import profiling
+
+    ## Imported before the measurement, which is of the parsing only
+    for module in ['pandas', 'pyarrow.csv']:
+        importlib.import_module(module)
+
+    method = methods(n_neurons)[name]
+    start = profiling._max_rss()
+    method(filepath)
+    return profiling._max_rss() - start
+
+
+def check(name, data, reference, counts_reference):
+    dtype = np.float32 if 'float32' in name else np.float64
+    for key in data.keys():
+        values, expected = np.asarray(data[key]), reference[key].to_numpy()
+        if key in readers.validation.KEYS_EPOCHS:
+            assert values.dtype == np.bool_ and np.array_equal(values, expected), name
+        else:
+            ## float32 is parsed as float64 and rounded by pandas, directly by pyarrow
+            assert values.dtype == dtype, name
+            assert np.array_equal(values, expected.astype(dtype)) or 'pyarrow float32' == name, name
+    if 'neurons' not in name and 'float32' not in name:
+        assert pipeline.analyze(data, PARAMETERS) == counts_reference, name + ' gives different spike counts'
+
+
+def main(n_samples=10**6, n_neurons=16):
+    DIR_DATA.mkdir(parents=True, exist_ok=True)
+    filepath = DIR_DATA / f'csv-{n_samples:.0e}-{n_neurons}.csv'.replace('+', '')
+    if not filepath.exists():
+        util.make_fake_data_file(str(filepath), n_samples, n_neurons, seed=0)
+    size = os.path.getsize(filepath)
+    print(f'{n_samples:.0e} samples x {n_neurons} neurons, {size / 2**20:.0f} MB of CSV, {os.cpu_count()} CPUs')
+    print(f"{'method':>20} {'wall (s)':>9} {'MB/s':>7} {'peak (MB)':>10} {'columns':>8}")
+    import pandas as pd
+
+    ## First, while this process is small: a spawned child starts with the
+    ##  peak RSS of its parent (ru_maxrss is inherited)
+    peaks = {name: measure_peak(name, filepath, n_neurons) for name in methods(n_neurons)}
+    reference, counts_reference = None, None
+    reference_exact = pd.read_csv(filepath, float_precision='round_trip')
+    for name, method in methods(n_neurons).items():
+        data, wall = measure(method, filepath)
+        peak = peaks[name]
+        if reference is None:
+            reference, counts_reference = data, pipeline.analyze(data, PARAMETERS)
+        else:
+            check(name, data, reference_exact if name.startswith('pyarrow') else reference, counts_reference)
+        print(f'{name:>20} {wall:>9.3f} {size / wall / 2**20:>7.1f} {peak / 2**20:>10.1f} {len(data.keys()):>8d}')
+
+
+if __name__ == '__main__':
+    n_samples = int(float(sys.argv[1])) if len(sys.argv) > 1 else 10**6
+    n_neurons = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+    main(n_samples, n_neurons)
@@ -0,0 +1,52 @@
+## Benchmark: per-neuron count_spikes vs. batched SpikeDetector
+##
+## Usage:
+##     python benchmarks/bench_detection.py [n_samples]
+
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from my_pipeline import detection, pipeline
+
+
+def make_traces(n_samples, n_neurons, seed=0):
+    """
+    Gaussian noise with sparse, 1 ms wide spikes, as a contiguous
+     (n_samples, n_neurons) Fortran-ordered array.
+    """
+    rng = np.random.default_rng(seed)
+    traces = np.asfortranarray(rng.normal(-70, 5, (n_samples, n_neurons)))
+    spikes = rng.random((n_samples, n_neurons)) < 0.002
+    for shift in range(-5, 6):
+        traces += np.roll(spikes, shift, axis=0) * 100 * np.exp(-(shift / 3) ** 2)
+    return traces
+
+
+def main(n_samples=100000, neuron_counts=(7, 64, 384), sample_rate=10000.0, threshold=-40.0):
+    detector = detection.SpikeDetector(sample_rate, threshold)
+    print(f"{'n_neurons':>10} {'per-neuron (s)':>15} {'batched (s)':>12} {'speedup':>8} {'n_spikes':>10}")
+    for n_neurons in neuron_counts:
+        traces = make_traces(n_samples, n_neurons)
+
+        tic = time.perf_counter()
+        expected_spikes = [pipeline.count_spikes(traces[:, ii], sample_rate, threshold) for ii in range(n_neurons)]
+        t_loop = time.perf_counter() - tic
+
+        tic = time.perf_counter()
+        spike_times, offsets = detector.detect_csr(traces)
+        t_batched = time.perf_counter() - tic
+
+        ## Validate against the per-neuron find_peaks results
+        for ii in range(n_neurons):
+            assert np.array_equal(spike_times[offsets[ii]:offsets[ii + 1]], expected_spikes[ii]), ii
+        print(f"{n_neurons:>10d} {t_loop:>15.3f} {t_batched:>12.3f} {t_loop / t_batched:>7.2f}x {len(spike_times):>10d}")
+        del traces
+
+
+if __name__ == '__main__':
+    n_samples = int(float(sys.argv[1])) if len(sys.argv) > 1 else 100000
+    main(n_samples)
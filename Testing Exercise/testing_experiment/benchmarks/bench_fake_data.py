@@ -0,0 +1,50 @@
+## Benchmark: synthetic recordings, per-neuron make_fake_voltage_trace vs.
+##  the vectorized generator, and streaming a large fixture to disk
+##
+## Usage:
+##     python benchmarks/bench_fake_data.py [n_samples_fixture] [n_neurons_fixture]
+
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+sys.path.insert(0, str(Path(__file__).parent.parent / 'tests'))
+import util
+
+
+def main(n_samples=10**6, neuron_counts=(7, 64), n_samples_fixture=10**7, n_neurons_fixture=64):
+    print(f"{'n_neurons':>10} {'per-neuron (s)':>15} {'vectorized (s)':>15} {'speedup':>8}")
+    for n_neurons in neuron_counts:
+        ## The per-neuron generator is timed on 7 neurons at most and scaled
+        n_reference = min(n_neurons, 7)
+        np.random.seed(0)
+        tic = time.perf_counter()
+        for _ in range(n_reference):
+            util.make_fake_voltage_trace(n_samples)
+        t_reference = (time.perf_counter() - tic) * n_neurons / n_reference
+
+        tic = time.perf_counter()
+        util.make_fake_data(n_samples, n_neurons, seed=0)
+        t_vectorized = time.perf_counter() - tic
+        print(f"{n_neurons:>10} {t_reference:>15.3f} {t_vectorized:>15.3f} {t_reference / t_vectorized:>7.1f}x")
+
+    dirpath = Path(tempfile.mkdtemp()) / 'fixture'
+    try:
+        tic = time.perf_counter()
+        util.make_fake_data_file(str(dirpath), n_samples_fixture, n_neurons_fixture, seed=0, fmt='npy')
+        wall = time.perf_counter() - tic
+        n_bytes = sum(f.stat().st_size for f in dirpath.iterdir())
+        print(f"Fixture {n_samples_fixture:.0e} x {n_neurons_fixture} as .npy: {n_bytes / 1e9:.2f} GB in {wall:.1f} s ({n_bytes / 1e6 / wall:.0f} MB/s)")
+    finally:
+        shutil.rmtree(str(dirpath.parent))
+
+
+if __name__ == '__main__':
+    n_samples_fixture = int(float(sys.argv[1])) if len(sys.argv) > 1 else 10**7
+    n_neurons_fixture = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+    main(n_samples_fixture=n_samples_fixture, n_neurons_fixture=n_neurons_fixture)
@@ -0,0 +1,89 @@
+## Benchmark: memory bandwidth of spike detection, fused kernel vs. separate passes
+##
+## Detects the spikes of synthetic recordings (tests/util.py:make_fake_data)
+##  with:
+##     - count_spikes: savgol_filter, then find_peaks, per neuron
+##     - batched: SpikeDetector.detect_csr (savgol_smooth on all neurons,
+##        then find_peaks_batched)
+##     - fused-numpy / fused-numba: fused.find_peaks_fused with each engine
+##        (numba only if installed; its compilation is not timed)
+##  and reports the trace bandwidth (bytes of traces read per second), the
+##  peak memory allocated on top of the traces (tracemalloc, numpy arrays
+##  included) and checks that every method finds the spikes of count_spikes.
+##
+## Usage:
+##     python benchmarks/bench_fused.py [n_samples] [n_neurons]
+
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+sys.path.insert(0, str(Path(__file__).parent.parent / 'tests'))
+import util
+from my_pipeline import detection, fused, pipeline
+
+PARAMETERS = {'sample_rate': 10000.0, 'threshold': 0.0}
+
+
+def methods():
+    plan = detection.get_plan(PARAMETERS['sample_rate'], PARAMETERS['threshold'])
+    detector = detection.SpikeDetector.from_parameters(PARAMETERS)
+    result = {
+        'count_spikes': lambda traces: [
+            pipeline.count_spikes(traces[:, ii], PARAMETERS['sample_rate'], PARAMETERS['threshold'])
+            for ii in range(traces.shape[1])
+        ],
+        'batched': lambda traces: _split(*detector.detect_csr(traces)),
+        'fused-numpy': lambda traces: _split(*fused.find_peaks_fused(traces, plan, engine='numpy')),
+    }
+    if fused.HAVE_NUMBA:
+        result['fused-numba'] = lambda traces: _split(*fused.find_peaks_fused(traces, plan, engine='numba'))
+    return result
+
+
+def _split(spike_times, offsets):
+    return [spike_times[offsets[ii]:offsets[ii + 1]] for ii in range(len(offsets) - 1)]
+
+
+def measure(method, traces, repeats=3):
+    import tracemalloc
+
+    method(traces[:1000]) ## warm-up (and numba compilation)
+    walls = []
+    for _ in range(repeats):
+        tic = time.perf_counter()
+        spike_times = method(traces)
+        walls.append(time.perf_counter() - tic)
+    tracemalloc.start()
+    try:
+        start = tracemalloc.get_traced_memory()[0]
+        method(traces)
+        peak = tracemalloc.get_traced_memory()[1] - start
+    finally:
+        tracemalloc.stop()
+    return spike_times, min(walls), peak
+
+
+def main(n_samples=10**6, n_neurons=16):
+    data = util.make_fake_data(n_samples, n_neurons, seed=0)
+    traces = detection.traces_matrix(data, [key for key in data if key.startswith('neuron')])
+    print(f'{n_samples:.0e} samples x {n_neurons} neurons ({traces.nbytes / 2**20:.0f} MB of traces), {PARAMETERS}')
+    print(f"{'method':>14} {'wall (s)':>9} {'GB/s':>6} {'peak (MB)':>10} {'n_spikes':>9}")
+    reference = None
+    for name, method in methods().items():
+        spike_times, wall, peak = measure(method, traces)
+        if reference is None:
+            reference = spike_times
+        assert all(np.array_equal(a, b) for a, b in zip(spike_times, reference)), name + ' differs from count_spikes'
+        print(f'{name:>14} {wall:>9.3f} {traces.nbytes / wall / 1e9:>6.2f} {peak / 2**20:>10.1f} {sum(map(len, spike_times)):>9d}')
+    if not fused.HAVE_NUMBA:
+        print('numba is not installed: fused-numba skipped')
+
+
+if __name__ == '__main__':
+    n_samples = int(float(sys.argv[1])) if len(sys.argv) > 1 else 10**6
+    n_neurons = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+    main(n_samples, n_neurons)
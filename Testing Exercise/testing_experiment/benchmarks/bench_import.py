@@ -0,0 +1,59 @@
+## Benchmark: import time of the package and of its first detection
+##
+## Every statement runs in a fresh interpreter (as a short-lived batch worker
+##  would), and the best of several runs is reported with the heavy
+##  dependencies it loaded.
+##
+## Usage:
+##     python benchmarks/bench_import.py [repeats]
+##     python -m pytest benchmarks/test_bench_import.py
+
+import subprocess
+import sys
+from pathlib import Path
+
+dir_package = Path(__file__).parent.parent
+
+## Statement -> import-time budget in seconds, checked by test_bench_import.py
+BUDGETS = {
+    'import my_pipeline': 0.02,
+    'from my_pipeline import pipeline': 0.5,
+    'from my_pipeline import detection; detection.get_plan(10000.0, 0.0)': 1.0,
+}
+HEAVY_MODULES = ['numpy', 'pandas', 'scipy.signal', 'scipy.ndimage', 'scipy.linalg', 'pyarrow']
+
+_SCRIPT = '''
+import sys, time
+tic = time.perf_counter()
+{statement}
+wall = time.perf_counter() - tic
+print(wall, ','.join(m for m in {heavy!r} if m in sys.modules))
+'''
+
+
+def measure(statement, repeats=5):
+    """
+    Best wall time (s) of statement over fresh interpreters, and the heavy
+     modules it loaded.
+    """
+    best, loaded = float('inf'), []
+    for _ in range(repeats):
+        output = subprocess.run(
+            [sys.executable, '-c', _SCRIPT.format(statement=statement, heavy=HEAVY_MODULES)],
+            cwd=str(dir_package), capture_output=True, text=True, check=True,
+        ).stdout.split()
+        if float(output[0]) < best:
+            best, loaded = float(output[0]), (output[1].split(',') if len(output) > 1 else [])
+    return best, loaded
+
+
+def main(repeats=5):
+    print(f"{'statement':>68} {'wall (ms)':>10} {'budget (ms)':>12}  loaded")
+    for statement, budget in BUDGETS.items():
+        wall, loaded = measure(statement, repeats)
+        print(f"{statement:>68} {wall * 1e3:>10.1f} {budget * 1e3:>12.0f}  {', '.join(loaded)}")
+
+
+if __name__ == '__main__':
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    main(repeats)
@@ -0,0 +1,62 @@
+## Benchmark: latency of the online (streaming) spike detector
+##
+## Simulates an acquisition system delivering blocks of samples and measures,
+##  for every block, the time to process it and, for every spike, the delay
+##  between its sample arriving and the block that emits it.
+##
+## Usage:
+##     python benchmarks/bench_online.py [seconds_of_data]
+
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from my_pipeline import detection, streaming
+from bench_detection import make_traces
+
+
+def main(duration=5.0, sample_rate=10000.0, n_neurons=384, block_durations=(0.001, 0.005, 0.01, 0.05), threshold=-40.0):
+    n_samples = int(duration * sample_rate)
+    traces = np.ascontiguousarray(make_traces(n_samples, n_neurons))
+    expected_spikes, expected_offsets = detection.SpikeDetector(sample_rate, threshold).detect_csr(traces)
+
+    print(f"{sample_rate:.0f} Hz x {n_neurons} channels, {duration:.1f} s of data")
+    print(f"{'block (ms)':>10} {'median (ms)':>12} {'p99 (ms)':>9} {'max (ms)':>9} {'load':>6} {'spike latency p50/p99/max (ms)':>32}")
+    for block_duration in block_durations:
+        block = max(1, int(block_duration * sample_rate))
+        detector = streaming.StreamingDetector(n_neurons, sample_rate, threshold)
+        block_times, latencies, blocks = [], [], []
+        for start in range(0, n_samples, block):
+            tic = time.perf_counter()
+            spike_times = detector.push(traces[start:start + block])
+            toc = time.perf_counter() - tic
+            block_times.append(toc)
+            blocks.append(spike_times)
+            ## The last sample of the block arrived at (start + block) / sample_rate
+            stop = min(start + block, n_samples)
+            for st in spike_times:
+                latencies.append((stop - st) / sample_rate + toc)
+        blocks.append(detector.finish())
+
+        ## Validate against the offline detector
+        for ii in range(n_neurons):
+            actual = np.concatenate([spike_times[ii] for spike_times in blocks])
+            assert np.array_equal(actual, expected_spikes[expected_offsets[ii]:expected_offsets[ii + 1]]), ii
+
+        block_times = np.array(block_times) * 1e3
+        latencies = np.concatenate(latencies) * 1e3
+        load = block_times.sum() / (duration * 1e3)
+        print(
+            f"{block / sample_rate * 1e3:>10.1f} {np.median(block_times):>12.2f} {np.percentile(block_times, 99):>9.2f}"
+            f" {block_times.max():>9.2f} {load:>5.0%} "
+            f"{np.median(latencies):>15.2f} / {np.percentile(latencies, 99):.2f} / {latencies.max():.2f}"
+        )
+    print(f"Latency bound from the filter window and refractory distance: {detector.latency / sample_rate * 1e3:.1f} ms + one block")
+
+
+if __name__ == '__main__':
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 5.0
+    main(duration)
@@ -0,0 +1,71 @@
+## Benchmark and accuracy check: float32 / int16 processing against float64
+##
+## Runs analyze() on synthetic recordings (tests/util.py:make_fake_data) in
+##  every precision and reports the peak memory of analyze() (traced with
+##  tracemalloc, numpy arrays included), the footprint from detection.memory_footprint, and
+##  how the spikes compare to the float64 run: spikes found by both, spikes
+##  only in one of them, and the largest difference of a condition count.
+##  A second recording is quantized to integer counts first, as 16-bit ADC
+##  data would be, where int16 storage is lossless.
+##
+## Usage:
+##     python benchmarks/bench_precision.py [n_samples] [n_neurons]
+
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+sys.path.insert(0, str(Path(__file__).parent.parent / 'tests'))
+import util
+from my_pipeline import detection, pipeline
+
+PARAMETERS = {'sample_rate': 10000.0, 'threshold': 0.0}
+
+
+def run(data, precision):
+    import tracemalloc
+
+    tracemalloc.start()
+    try:
+        start = tracemalloc.get_traced_memory()[0]
+        tic = time.perf_counter()
+        ns_conditions, spike_trains = pipeline.analyze(data, PARAMETERS, return_spikes=True, precision=precision)
+        wall = time.perf_counter() - tic
+        peak = tracemalloc.get_traced_memory()[1] - start
+    finally:
+        tracemalloc.stop()
+    return ns_conditions, spike_trains, wall, peak
+
+
+def compare(reference, spike_trains):
+    common = sum(len(np.intersect1d(a, b)) for a, b in zip(reference, spike_trains))
+    return common, len(reference.spike_times) - common, len(spike_trains.spike_times) - common
+
+
+def main(n_samples=10**6, n_neurons=64):
+    data = util.make_fake_data(n_samples, n_neurons, seed=0)
+    ## 16-bit ADC data: integer counts of 0.1 mV
+    data_adc = {key: (np.round(column * 10).astype(np.int16) if key.startswith('neuron') else column) for key, column in data.items()}
+    print(f'{n_samples:.0e} samples x {n_neurons} neurons, {PARAMETERS}')
+    print(f"{'data':>6} {'precision':>9} {'wall (s)':>9} {'peak (MB)':>10} {'footprint (MB)':>15} {'saved (MB)':>11}"
+          f" {'common':>8} {'only f64':>9} {'only new':>9} {'max count diff':>15}")
+    for name, recording in [('float', data), ('adc', data_adc)]:
+        reference = None
+        for precision in detection.PRECISIONS:
+            ns_conditions, spike_trains, wall, peak = run(recording, precision)
+            if reference is None:
+                reference, reference_counts = spike_trains, ns_conditions
+            common, only_reference, only_new = compare(reference, spike_trains)
+            max_diff = max(abs(ns_conditions[key] - reference_counts[key]) for key in ns_conditions)
+            footprint = detection.memory_footprint(n_samples, n_neurons, precision)
+            print(f"{name:>6} {precision:>9} {wall:>9.2f} {peak / 2**20:>10.0f} {footprint['total'] / 2**20:>15.0f}"
+                  f" {footprint['saved'] / 2**20:>11.0f} {common:>8} {only_reference:>9} {only_new:>9} {max_diff:>15}")
+
+
+if __name__ == '__main__':
+    n_samples = int(float(sys.argv[1])) if len(sys.argv) > 1 else 10**6
+    n_neurons = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+    main(n_samples, n_neurons)
@@ -0,0 +1,100 @@
+## Benchmark: spike snippet extraction and features, vectorized vs. per-spike loop
+##
+## Detects the spikes of a synthetic recording (tests/util.py:make_fake_data)
+##  and cuts a window around every spike of the smoothed traces with:
+##     - loop: a Python loop over spikes that slices and pads each snippet,
+##        then scipy.signal.peak_widths and np.argmin per snippet
+##     - vectorized: snippets.extract_snippets (strided view, one gather per
+##        block of spikes) and Snippets.features, in memory
+##     - spilled: the same with the snippets written to a memory-mapped .npy
+##  and reports spikes per second for extraction and features, and checks
+##  that all methods give the same snippets and features.
+##
+## Usage:
+##     python benchmarks/bench_snippets.py [n_samples] [n_neurons] [before] [after]
+
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+sys.path.insert(0, str(Path(__file__).parent.parent / 'tests'))
+import util
+from my_pipeline import detection, snippets, spikes
+
+PARAMETERS = {'sample_rate': 10000.0, 'threshold': 0.0}
+
+
+def loop_snippets(traces, spike_trains, before, after):
+    n_samples = len(traces)
+    waveforms = []
+    for ii in range(len(spike_trains)):
+        for t in spike_trains[ii]:
+            snippet = np.full(before + after + 1, np.nan)
+            lo, hi = max(t - before, 0), min(t + after + 1, n_samples)
+            snippet[lo - (t - before):hi - (t - before)] = traces[lo:hi, ii]
+            waveforms.append(snippet)
+    return np.array(waveforms).reshape(-1, before + after + 1)
+
+
+def loop_features(waveforms, before):
+    import scipy.signal
+
+    result = {key: [] for key in snippets.FEATURES}
+    for snippet in waveforms:
+        valid = np.flatnonzero(~np.isnan(snippet))
+        x, peak = snippet[valid[0]:valid[-1] + 1], before - valid[0]
+        result['amplitude'].append(x[peak])
+        result['half_width'].append(scipy.signal.peak_widths(x, [peak])[0][0])
+        result['trough_delay'].append(np.argmin(x[peak:]))
+        result['trough'].append(x[peak + result['trough_delay'][-1]])
+    return {key: np.array(values) for key, values in result.items()}
+
+
+def main(n_samples=10**6, n_neurons=16, before=10, after=20):
+    import warnings
+
+    data = util.make_fake_data(n_samples, n_neurons, seed=0)
+    traces = detection.traces_matrix(data, [key for key in data if key.startswith('neuron')])
+    detector = detection.SpikeDetector.from_parameters(PARAMETERS)
+    traces_smooth = detector.smooth(traces)
+    spike_trains = spikes.SpikeTrains(*detector.detect_csr(traces))
+    n_spikes = len(spike_trains.spike_times)
+    print(f'{n_samples:.0e} samples x {n_neurons} neurons, {n_spikes} spikes, window of {before} + 1 + {after} samples')
+    print(f"{'method':>11} {'extract (s)':>12} {'spikes/s':>10} {'features (s)':>13} {'spikes/s':>10}")
+
+    def report(name, extract, features):
+        print(f'{name:>11} {extract:>12.3f} {n_spikes / extract:>10.2e} {features:>13.3f} {n_spikes / features:>10.2e}')
+
+    tic = time.perf_counter()
+    expected = loop_snippets(traces_smooth, spike_trains, before, after)
+    extract = time.perf_counter() - tic
+    tic = time.perf_counter()
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')  ## peak_widths warns about flat peaks
+        expected_features = loop_features(expected, before)
+    report('loop', extract, time.perf_counter() - tic)
+
+    with tempfile.TemporaryDirectory() as directory:
+        for name, spill in [('vectorized', None), ('spilled', str(Path(directory) / 'snippets.npy'))]:
+            tic = time.perf_counter()
+            result = snippets.extract_snippets(traces_smooth, spike_trains, before, after, spill=spill, spill_bytes=0)
+            extract = time.perf_counter() - tic
+            tic = time.perf_counter()
+            features = result.features()
+            report(name, extract, time.perf_counter() - tic)
+
+            assert np.array_equal(result.waveforms, expected, equal_nan=True), name
+            for key in snippets.FEATURES:
+                ## Widths of spikes at the edges are in other coordinates in the loop
+                assert np.allclose(features[key], expected_features[key], rtol=1e-12, atol=0), name + ': ' + key
+            del result
+
+
+if __name__ == '__main__':
+    n_samples = int(float(sys.argv[1])) if len(sys.argv) > 1 else 10**6
+    args = [int(arg) for arg in sys.argv[2:5]]
+    main(n_samples, *args)
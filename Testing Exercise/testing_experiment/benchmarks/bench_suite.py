@@ -0,0 +1,180 @@
+## Benchmark suite: per-stage and end-to-end pipeline throughput across data sizes
+##
+## Datasets are made with tests/util.py:make_fake_data_file for every sample
+##  count and neuron count that fits in the byte budget, and the pipeline is run on
+##  them in memory (analyze() on loaded arrays) and on disk (pipeline() on a
+##  .npy directory and on a CSV file). Every case runs in a freshly spawned
+##  process, so its peak RSS is its own.
+##
+## Throughput is in trace samples per second: n_samples * n_neurons / wall time.
+##
+## Usage:
+##     python benchmarks/bench_suite.py [max_bytes]
+##     python -m pytest benchmarks [--bench-max-bytes=1e9] [--bench-update-baselines] [--bench-tolerance=2.0]
+## The pytest form compares every case to benchmarks/baselines.json and fails
+##  on regressions (see test_bench_suite.py). Baselines are only compared on a
+##  machine with the same architecture and CPU count as the one that recorded
+##  them (MACHINE_KEYS); elsewhere the cases are skipped. To record them on
+##  this machine, replacing those of any other:
+##     python -m pytest benchmarks/test_bench_suite.py --bench-update-baselines
+
+import json
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+dir_benchmarks = Path(__file__).parent
+sys.path.insert(0, str(dir_benchmarks.parent))
+sys.path.insert(0, str(dir_benchmarks.parent / 'tests'))
+
+SAMPLE_COUNTS = [10**5, 10**6, 10**7, 10**8]
+NEURON_COUNTS = [7, 64, 384, 1024]
+MODES = ['memory', 'npy', 'csv']
+## Approximate bytes per trace sample of each mode, to skip cases above the budget
+BYTES_PER_SAMPLE = {'memory': 8, 'npy': 8, 'csv': 20}
+## Default budget: cases whose data would be larger are skipped
+MAX_BYTES = 10**9
+PARAMETERS = {'sample_rate': 10000.0, 'threshold': 0.0}
+FILEPATH_BASELINES = dir_benchmarks / 'baselines.json'
+## Fields of machine() that must match for baselines to be compared
+MACHINE_KEYS = ['arch', 'cpu_count']
+DIR_DATA = Path(tempfile.gettempdir()) / 'my_pipeline_benchmarks'
+
+
+def case_id(n_samples, n_neurons, mode):
+    return f'{mode}-{n_samples:.0e}-{n_neurons}'.replace('+', '')
+
+
+def cases(max_bytes=MAX_BYTES):
+    """
+    All (n_samples, n_neurons, mode) cases, and whether each fits in max_bytes.
+    """
+    return [
+        ((n_samples, n_neurons, mode), n_samples * n_neurons * BYTES_PER_SAMPLE[mode] <= max_bytes)
+        for n_samples in SAMPLE_COUNTS for n_neurons in NEURON_COUNTS for mode in MODES
+    ]
+
+
+def run_case(n_samples, n_neurons, mode):
+    """
+    Run one case in a new spawned process.
+
+    Returns:
+        metrics (dict):
+            'wall' (s, end to end), 'throughput' (samples/s), 'peak_rss'
+             (bytes, of the process running the case) and 'stages' (wall
+             time of every pipeline stage).
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    context = multiprocessing.get_context('spawn')
+    ## The dataset is written by its own process, so that generating it does
+    ##  not count towards the peak RSS of the case.
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+        pool.submit(prepare_dataset, n_samples, n_neurons, mode).result()
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+        return pool.submit(_run_case, n_samples, n_neurons, mode).result()
+
+
+def prepare_dataset(n_samples, n_neurons, mode):
+    """
+    Write the dataset of a case (once) and return its filepath. The
+     'memory' mode loads the .npy directory into memory.
+    """
+    import util
+
+    path = DIR_DATA / f'fake_{n_samples}_{n_neurons}'
+    filepath = path.with_suffix('.csv') if mode == 'csv' else path
+    if not filepath.exists():
+        DIR_DATA.mkdir(parents=True, exist_ok=True)
+        path_tmp = path.with_name(path.name + '.tmp' + filepath.suffix)
+        util.make_fake_data_file(str(path_tmp), n_samples, n_neurons, seed=0, fmt='csv' if mode == 'csv' else 'npy')
+        path_tmp.rename(filepath)
+    return str(filepath)
+
+
+def _run_case(n_samples, n_neurons, mode):
+    import numpy as np
+    from my_pipeline import pipeline, profiling, readers, validation
+
+    filepath_data = prepare_dataset(n_samples, n_neurons, mode)
+    filepath_parameters = str(DIR_DATA / 'params.json')
+    with open(filepath_parameters, 'w') as f:
+        json.dump(PARAMETERS, f)
+
+    if mode == 'memory':
+        data = {key: np.array(column) for key, column in readers.read_npy_dir(filepath_data).items()}
+
+    with profiling.record(memory=False, per_neuron=False) as report:
+        tic = time.perf_counter()
+        if mode == 'memory':
+            with profiling.stage('validate_input'):
+                status, optional_error = validation.validate_input(data, PARAMETERS)
+            assert status, optional_error
+            result = pipeline.analyze(data, PARAMETERS)
+        else:
+            result = pipeline.pipeline(filepath_data, filepath_parameters)
+        wall = time.perf_counter() - tic
+    assert isinstance(result, dict), 'pipeline failed on ' + filepath_data
+
+    return {
+        'wall': wall,
+        'throughput': n_samples * n_neurons / wall,
+        'peak_rss': profiling._max_rss(),
+        'stages': {name: total['wall'] for name, total in report.summary().items()},
+    }
+
+
+def machine():
+    import os
+    import platform
+
+    return {'platform': platform.platform(), 'python': platform.python_version(), 'arch': platform.machine(), 'cpu_count': os.cpu_count()}
+
+
+def read_baselines():
+    """
+    Baseline metrics of every case, or {} if there are none or they were
+     recorded on a machine that differs from this one in MACHINE_KEYS.
+
+    Returns:
+        baselines (dict):
+            Metrics (see run_case) by case_id.
+        other_machine (dict or None):
+            machine() of the other machine that recorded baselines.json, or
+             None if they were recorded on this one (or there are none).
+    """
+    if not FILEPATH_BASELINES.exists():
+        return {}, None
+    with open(str(FILEPATH_BASELINES), 'r') as f:
+        stored = json.load(f)
+    current = machine()
+    if any(stored['machine'].get(key) != current[key] for key in MACHINE_KEYS):
+        return {}, stored['machine']
+    return stored['cases'], None
+
+
+def write_baselines(baselines):
+    with open(str(FILEPATH_BASELINES), 'w') as f:
+        json.dump({
+            'machine': machine(),
+            'parameters': PARAMETERS,
+            'cases': dict(sorted(baselines.items())),
+        }, f, indent=2)
+
+
+def main(max_bytes=MAX_BYTES):
+    print(f"{'case':>22} {'wall (s)':>9} {'samples/s':>10} {'peak RSS (MB)':>14}  stages (s)")
+    for (n_samples, n_neurons, mode), fits in cases(max_bytes):
+        if not fits:
+            continue
+        metrics = run_case(n_samples, n_neurons, mode)
+        stages = ', '.join(f'{name} {wall:.3f}' for name, wall in metrics['stages'].items())
+        print(f"{case_id(n_samples, n_neurons, mode):>22} {metrics['wall']:>9.3f} {metrics['throughput']:>10.2e} {metrics['peak_rss'] / 2**20:>14.0f}  {stages}")
+
+
+if __name__ == '__main__':
+    max_bytes = int(float(sys.argv[1])) if len(sys.argv) > 1 else MAX_BYTES
+    main(max_bytes)
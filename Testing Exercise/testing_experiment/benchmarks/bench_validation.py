@@ -0,0 +1,83 @@
+## Benchmark: per-cell validation loop vs. vectorized validation engine
+##
+## Usage:
+##     python benchmarks/bench_validation.py [n_rows ...]
+
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from my_pipeline import validation
+
+
+def validate_input_loop(data, parameters):
+    """
+    The original per-cell implementation of validate_input, kept here as the
+     reference point for the benchmark.
+    """
+    for required_column in ['trial_on', 'reward_on', 'light_on']:
+        if required_column not in data.keys():
+            return False, 'Critical temporal epoch column: ' + required_column + ' not in input data'
+        for val in data[required_column]:
+            if not isinstance(val, bool):
+                return False, 'Critical temporal epoch column: ' + required_column + ' value type is not bool in input data'
+
+    for column in data.keys():
+        if column not in ['trial_on', 'reward_on', 'light_on']:
+            if np.isnan(data[column]).any():
+                return False, 'Found invalue NaN value for column: ' + column + ' in input data'
+
+    for required_column in ['sample_rate', 'threshold']:
+        if required_column not in parameters:
+            return False, 'Column ' + required_column + ' missing in input parameters'
+        if not isinstance(parameters[required_column], float):
+            return False, 'Column ' + required_column + ' value type is not float in input parameters'
+
+    return True, ''
+
+
+def make_data(n, n_neurons=7, seed=0):
+    """
+    Epoch columns with the same layout as tests/util.py:make_fake_data_file,
+     and Gaussian noise for the neuron columns (validation does not look at
+     the spikes).
+    """
+    rng = np.random.default_rng(seed)
+    idx = np.arange(n)
+    data = {
+        'trial_on': (idx % 1000) > 500,
+        'reward_on': (idx % 1000) > 750,
+        'light_on': (idx % 2000) > 900,
+    }
+    data.update({f"neuron_{ii + 1}": rng.normal(-70, 10, n) for ii in range(n_neurons)})
+    return pd.DataFrame(data)
+
+
+def time_call(fn, *args, repeats=3):
+    times = []
+    for _ in range(repeats):
+        tic = time.perf_counter()
+        out = fn(*args)
+        times.append(time.perf_counter() - tic)
+    return min(times), out
+
+
+def main(sizes=(int(1e5), int(1e6), int(1e7))):
+    parameters = {'sample_rate': 10000.0, 'threshold': 9.0}
+    print(f"{'n_rows':>10} {'loop (s)':>10} {'vectorized (s)':>15} {'speedup':>8}")
+    for n in sizes:
+        data = make_data(n)
+        t_loop, out_loop = time_call(validate_input_loop, data, parameters, repeats=1)
+        t_vec, out_vec = time_call(validation.validate_input, data, parameters)
+        assert out_loop == out_vec, (out_loop, out_vec)
+        print(f"{n:>10d} {t_loop:>10.4f} {t_vec:>15.4f} {t_loop / t_vec:>7.1f}x")
+        del data
+
+
+if __name__ == '__main__':
+    sizes = [int(float(arg)) for arg in sys.argv[1:]] or (int(1e5), int(1e6), int(1e7))
+    main(sizes)
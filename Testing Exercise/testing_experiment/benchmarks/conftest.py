@@ -0,0 +1,11 @@
+## Options of the benchmark suite (see bench_suite.py)
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup('benchmarks')
+    group.addoption('--bench-max-bytes', type=float, default=None,
+                    help='Skip benchmark cases whose data are larger than this (default: bench_suite.MAX_BYTES).')
+    group.addoption('--bench-update-baselines', action='store_true',
+                    help='Store the measured metrics as the new baselines instead of comparing to them.')
+    group.addoption('--bench-tolerance', type=float, default=2.0,
+                    help='Fail when throughput drops, or peak RSS grows, by more than this factor.')
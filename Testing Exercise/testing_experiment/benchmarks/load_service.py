@@ -0,0 +1,144 @@
+## Load test: resident service (service.py) vs. one Python process per session
+##
+## Writes n_sessions synthetic recordings (tests/util.py:make_fake_data_file,
+##  .npy directories), then
+##     - cold: runs every session in a new `python -c "pipeline.pipeline(...)"`
+##        process, one after the other, as an orchestrator shelling out would;
+##     - warm: starts `my-pipeline serve` on a Unix socket and submits all
+##        sessions from `concurrency` client threads at once, so that the
+##        queue fills up and backpressure (503, retried by the client) kicks in.
+##  and reports throughput, client-side latency percentiles, the service
+##  metrics (queue wait, run time, rejected submissions) and checks that
+##  both give the same counts.
+##
+## Usage:
+##     python benchmarks/load_service.py [n_sessions] [concurrency] [n_workers] [max_queue]
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+
+dir_root = Path(__file__).parent.parent
+sys.path.insert(0, str(dir_root))
+sys.path.insert(0, str(dir_root / 'tests'))
+import util
+from my_pipeline import service
+
+PARAMETERS = {'sample_rate': 10000.0, 'threshold': 0.0}
+N_SAMPLES = 10**5
+N_NEURONS = 16
+DIR_DATA = Path(tempfile.gettempdir()) / 'my_pipeline_load'
+
+
+def prepare(n_sessions):
+    DIR_DATA.mkdir(parents=True, exist_ok=True)
+    filepath_parameters = DIR_DATA / 'params.json'
+    with open(str(filepath_parameters), 'w') as f:
+        json.dump(PARAMETERS, f)
+    sessions = []
+    for ii in range(n_sessions):
+        path = DIR_DATA / f'session_{ii:03d}'
+        if not path.exists():
+            util.make_fake_data_file(str(path), N_SAMPLES, N_NEURONS, seed=ii, fmt='npy')
+        sessions.append(str(path))
+    return sessions, str(filepath_parameters)
+
+
+def run_cold(sessions, filepath_parameters):
+    code = 'import json, sys; from my_pipeline import pipeline; print(json.dumps(pipeline.pipeline(sys.argv[1], sys.argv[2])))'
+    env = dict(os.environ, PYTHONPATH=str(dir_root))
+    latencies, counts = [], {}
+    for session in sessions:
+        tic = time.perf_counter()
+        output = subprocess.run([sys.executable, '-c', code, session, filepath_parameters], env=env,
+                                check=True, capture_output=True, text=True).stdout
+        latencies.append(time.perf_counter() - tic)
+        counts[session] = json.loads(output)
+    return counts, np.array(latencies)
+
+
+def run_warm(sessions, filepath_parameters, concurrency, n_workers, max_queue):
+    filepath_socket = str(DIR_DATA / 'service.sock')
+    command = [sys.executable, '-m', 'my_pipeline', 'serve', '--socket', filepath_socket, '--params', filepath_parameters,
+               '--jobs', str(n_workers), '--max-queue', str(max_queue)]
+    server = subprocess.Popen(command, env=dict(os.environ, PYTHONPATH=str(dir_root)))
+    try:
+        _wait_until_up(filepath_socket)
+        latencies, counts = [], {}
+        todo = iter(sessions)
+        lock = threading.Lock()
+
+        def client_loop():
+            with service.Client(filepath_socket) as client:
+                while True:
+                    with lock:
+                        session = next(todo, None)
+                    if session is None:
+                        return
+                    tic = time.perf_counter()
+                    result = client.run(session, retries=100)
+                    with lock:
+                        latencies.append(time.perf_counter() - tic)
+                        counts[session] = result['counts']
+
+        threads = [threading.Thread(target=client_loop) for _ in range(concurrency)]
+        tic = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        wall = time.perf_counter() - tic
+        with service.Client(filepath_socket) as client:
+            metrics = client.metrics()
+    finally:
+        server.terminate()
+        server.wait()
+    return counts, np.array(latencies), wall, metrics
+
+
+def _wait_until_up(filepath_socket, timeout=60):
+    deadline = time.perf_counter() + timeout
+    while True:
+        try:
+            with service.Client(filepath_socket, timeout=1) as client:
+                client.health()
+            return
+        except OSError:
+            if time.perf_counter() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def _row(name, latencies, wall):
+    p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+    return f'{name:>6} {len(latencies):>9d} {wall:>9.2f} {len(latencies) / wall:>11.2f} {p50:>8.3f} {p90:>8.3f} {p99:>8.3f}'
+
+
+def main(n_sessions=32, concurrency=16, n_workers=4, max_queue=4):
+    sessions, filepath_parameters = prepare(n_sessions)
+    print(f'{n_sessions} sessions of {N_SAMPLES:.0e} samples x {N_NEURONS} neurons (.npy),'
+          f' {concurrency} clients, {n_workers} workers, queue of {max_queue}')
+    print(f"{'mode':>6} {'sessions':>9} {'wall (s)':>9} {'sessions/s':>11} {'p50 (s)':>8} {'p90 (s)':>8} {'p99 (s)':>8}")
+
+    counts_cold, latencies_cold = run_cold(sessions, filepath_parameters)
+    print(_row('cold', latencies_cold, latencies_cold.sum()))
+    counts_warm, latencies_warm, wall, metrics = run_warm(sessions, filepath_parameters, concurrency, n_workers, max_queue)
+    print(_row('warm', latencies_warm, wall))
+    assert counts_warm == counts_cold, 'the service and pipeline() give different counts'
+
+    print(f"service: {metrics['completed']} completed, {metrics['failed']} failed,"
+          f" {metrics['rejected']} submissions rejected while the queue was full")
+    for name in ['queue_time', 'run_time', 'latency']:
+        stats = metrics[name]
+        print(f"  {name:>10}: mean {stats['mean']:.3f} s, p50 {stats['p50']:.3f} s, p99 {stats['p99']:.3f} s, max {stats['max']:.3f} s")
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:5]))
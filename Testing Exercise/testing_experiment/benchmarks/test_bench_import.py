@@ -0,0 +1,11 @@
+## Import-time budgets of bench_import.py
+
+import pytest
+
+import bench_import
+
+
+@pytest.mark.parametrize('statement, budget', list(bench_import.BUDGETS.items()))
+def test_import_budget(statement, budget):
+    wall, loaded = bench_import.measure(statement)
+    assert wall <= budget, f'{statement!r} took {wall * 1e3:.1f} ms (budget {budget * 1e3:.0f} ms), loaded {loaded}'
@@ -0,0 +1,38 @@
+## Benchmark regression tests: every case of bench_suite.py against its baseline
+
+import pytest
+
+import bench_suite
+
+
+@pytest.mark.parametrize(
+    'n_samples, n_neurons, mode',
+    [case for case, _ in bench_suite.cases(float('inf'))],
+    ids=[bench_suite.case_id(*case) for case, _ in bench_suite.cases(float('inf'))],
+)
+def test_benchmark(n_samples, n_neurons, mode, request):
+    max_bytes = request.config.getoption('--bench-max-bytes') or bench_suite.MAX_BYTES
+    if n_samples * n_neurons * bench_suite.BYTES_PER_SAMPLE[mode] > max_bytes:
+        pytest.skip('data larger than --bench-max-bytes=' + str(max_bytes))
+
+    key = bench_suite.case_id(n_samples, n_neurons, mode)
+    metrics = bench_suite.run_case(n_samples, n_neurons, mode)
+    baselines, other_machine = bench_suite.read_baselines()
+    if request.config.getoption('--bench-update-baselines'):
+        baselines[key] = metrics
+        bench_suite.write_baselines(baselines)
+        return
+
+    if other_machine is not None:
+        pytest.skip('baselines were recorded on another machine (' + str(other_machine) + '), run with --bench-update-baselines')
+    baseline = baselines.get(key)
+    if baseline is None:
+        pytest.skip('no baseline for ' + key + ', run with --bench-update-baselines')
+    tolerance = request.config.getoption('--bench-tolerance')
+    assert metrics['throughput'] >= baseline['throughput'] / tolerance, (
+        'Throughput regression: ' + f"{metrics['throughput']:.3e} samples/s vs baseline {baseline['throughput']:.3e}"
+        + '. Stages: ' + str(metrics['stages']) + ', baseline: ' + str(baseline['stages'])
+    )
+    assert metrics['peak_rss'] <= baseline['peak_rss'] * tolerance, (
+        'Peak RSS regression: ' + f"{metrics['peak_rss'] / 2**20:.0f} MB vs baseline {baseline['peak_rss'] / 2**20:.0f} MB"
+    )
@@ -1,8 +1,35 @@
+import importlib
+
 __all__ = [
-    'pipeline'
+    'pipeline',
+    'batch',
+    'cache',
+    'cli',
+    'conditions',
+    'detection',
+    'fused',
+    'intervals',
+    'parallel',
+    'profiling',
+    'readers',
+    'service',
+    'snippets',
+    'spikes',
+    'streaming',
+    'sweep',
+    'validation',
 ]
 
-for pkg in __all__:
-    exec('from . import ' + pkg)
-
 __version__ = '0.0.1'
+
+
+def __getattr__(name):
+    ## Submodules are imported on first access (PEP 562), so that
+    ##  `import my_pipeline` does not load numpy, pandas or scipy.
+    if name in __all__:
+        return importlib.import_module('.' + name, __name__)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,7 @@
+## python -m my_pipeline ... (same as the my-pipeline command, see cli.py)
+
+import sys
+
+from .cli import main
+
+sys.exit(main())
@@ -0,0 +1,174 @@
+## Batch execution of the pipeline over many sessions
+
+import glob
+import os
+
+import numpy as np
+
+from . import conditions, parallel, validation
+
+
+def run_batch(sessions, filepath_parameters, executor='threads', n_workers=None, chunk_size=None):
+    """
+    Run the pipeline over many data files that share one parameters file.
+    The parameters are read and validated once, and sessions run
+     concurrently on a bounded pool whose workers keep their imports between
+     sessions. A session that fails does not abort the batch: its error
+     message is recorded in the 'error' column instead.
+
+    Args:
+        sessions (str or list of str):
+            Filepaths of the data files (any format accepted by pipeline()),
+             or a glob pattern matching them.
+        filepath_parameters (str):
+            Filepath to the parameters JSON file (see pipeline()).
+        executor (str):
+            How sessions are run: 'serial', 'threads' or 'processes'.
+        n_workers (int):
+            Maximum number of sessions running at the same time.
+            If None, os.cpu_count() is used.
+        chunk_size (int):
+            If given, every session is streamed in blocks of chunk_size rows
+             (see pipeline()).
+
+    Returns:
+        results (pandas.DataFrame):
+            One row per session, indexed by the session filepath, with one
+             column of spike counts per condition (nullable integers, missing
+             for failed sessions) and an 'error' column (None for sessions
+             that succeeded).
+
+    Raises:
+        ValueError:
+            If the parameters file is invalid, since no session could run.
+    """
+    if isinstance(sessions, str):
+        sessions = sorted(glob.glob(sessions))
+    sessions = [str(session) for session in sessions]
+    outputs = {session: (ns_conditions, error) for session, ns_conditions, error in iter_batch(
+        sessions, filepath_parameters, executor=executor, n_workers=n_workers, chunk_size=chunk_size,
+    )}
+    return results_table(sessions, [outputs[session] for session in sessions])
+
+
+def iter_batch(sessions, filepath_parameters, executor='threads', n_workers=None, chunk_size=None):
+    """
+    Run the pipeline over many data files like run_batch, but yield every
+     session as soon as it finishes, so that results can be written out
+     while the batch is running.
+
+    Args:
+        sessions (list of str):
+            Filepaths of the data files.
+        filepath_parameters, executor, n_workers, chunk_size:
+            See run_batch.
+
+    Yields:
+        session (str):
+            Filepath of the data file.
+        ns_conditions (dict or None):
+            Spike counts per condition, or None if the session failed.
+        error (str or None):
+            Error message if the session failed.
+        Sessions come in the order they finish, which for the 'threads'
+         and 'processes' executors is not the order of sessions.
+
+    Raises:
+        ValueError:
+            If the parameters file is invalid (before any session runs).
+    """
+    from .pipeline import load_parameters
+
+    sessions = [str(session) for session in sessions]
+    if executor not in parallel.EXECUTORS:
+        raise ValueError('executor must be one of ' + str(parallel.EXECUTORS) + ', got: ' + repr(executor))
+
+    parameters = load_parameters(filepath_parameters)
+    errors = validation.validate_parameters(parameters)
+    if len(errors) > 0:
+        raise ValueError('; '.join(errors))
+    return _iter_sessions(sessions, parameters, executor, n_workers, chunk_size)
+
+
+def _iter_sessions(sessions, parameters, executor, n_workers, chunk_size):
+    ## Separate from iter_batch so that invalid parameters raise on the call,
+    ##  not on the first iteration
+    n_workers = n_workers if n_workers is not None else (os.cpu_count() or 1)
+    if executor == 'serial' or n_workers <= 1:
+        for session in sessions:
+            yield (session,) + run_session((session, parameters, chunk_size))
+        return
+
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+    pool_class = ThreadPoolExecutor if executor == 'threads' else ProcessPoolExecutor
+    with pool_class(max_workers=n_workers) as pool:
+        futures = {pool.submit(run_session, (session, parameters, chunk_size)): session for session in sessions}
+        try:
+            for future in as_completed(futures):
+                yield (futures[future],) + future.result()
+        finally:
+            ## If the consumer stops early, sessions not started are dropped
+            for future in futures:
+                future.cancel()
+
+
+def run_session(task):
+    """
+    Run one session of a batch.
+
+    Args:
+        task (tuple):
+            (filepath_data, parameters, chunk_size), with parameters already
+             parsed and validated.
+
+    Returns:
+        ns_conditions (dict or None):
+            Spike counts per condition, or None if the session failed.
+        error (str or None):
+            Error message if the session failed.
+    """
+    from . import readers, streaming
+    from .pipeline import PROBE_ROWS, analyze
+
+    filepath_data, parameters, chunk_size = task
+    try:
+        if chunk_size is not None:
+            return streaming.count_spikes_chunked(readers.read_chunks(filepath_data, chunk_size), parameters), None
+
+        ## A malformed file fails on its first rows, before it is read in full
+        _check_data(readers.read_head(filepath_data, PROBE_ROWS))
+        data = readers.read_data(filepath_data)
+        _check_data(data)
+        return analyze(data, parameters), None
+    except Exception as ex:
+        return None, type(ex).__name__ + ': ' + str(ex)
+
+
+def _check_data(data):
+    errors = validation.validate_data(data)
+    if len(errors) > 0:
+        raise ValueError('Input data validation failed due to: ' + '; '.join(errors))
+
+
+def results_table(sessions, outputs):
+    """
+    Combine the outputs of run_session into one DataFrame indexed by session.
+    """
+    import pandas as pd
+
+    counts = np.zeros((len(sessions), len(conditions.CONDITIONS)), dtype=np.int64)
+    failed = np.zeros((len(sessions), len(conditions.CONDITIONS)), dtype=np.bool_)
+    errors = []
+    for ii, (ns_conditions, error) in enumerate(outputs):
+        if ns_conditions is None:
+            failed[ii] = True
+        else:
+            counts[ii] = [ns_conditions[key] for key in conditions.CONDITIONS]
+        errors.append(error)
+
+    results = pd.DataFrame(
+        {key: pd.arrays.IntegerArray(counts[:, jj], failed[:, jj]) for jj, key in enumerate(conditions.CONDITIONS)},
+        index=pd.Index(sessions, name='session'),
+    )
+    results['error'] = pd.Series(errors, index=results.index, dtype=object)
+    return results
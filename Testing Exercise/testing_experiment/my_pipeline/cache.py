@@ -0,0 +1,226 @@
+## On-disk, content-addressed cache of intermediate pipeline results
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+from . import conditions, detection, spikes
+
+## Name of the file memoizing the content hash of each data file by its stat
+FILENAME_DIGESTS = 'digests.json'
+## Bytes read at a time when hashing a data file
+HASH_BLOCK_SIZE = 2**20
+
+
+class ResultCache:
+    """
+    Cache of the two expensive intermediate results of pipeline(), stored
+     separately so that a parameter change only recomputes what depends on it:
+        - 'smoothed' entries: the smoothed traces and epoch codes of a data
+           file, keyed by the file content and sample_rate. A threshold-only
+           change goes straight to peak finding on them.
+        - 'spikes' entries: the spike trains and epoch code histogram, keyed
+           by the file content, sample_rate and threshold. An unchanged
+           input returns its counts without reading the data.
+    Data files are identified by a hash of their content, so renamed or
+     copied files hit the cache and edited files miss it. The hash of a file
+     is memoized by (size, modification time) so unchanged files are not
+     read again.
+    Entries are directories of .npy files written atomically. Reading an
+     entry marks it as recently used; when the cache grows above max_bytes
+     the least recently used entries are deleted. An entry larger than
+     max_bytes on its own is not stored.
+
+    Args:
+        directory (str):
+            Directory of the cache. Created if needed.
+        max_bytes (int):
+            Size limit of all entries.
+    """
+    def __init__(self, directory, max_bytes=2**30):
+        self.directory = Path(directory)
+        self.max_bytes = int(max_bytes)
+        (self.directory / 'entries').mkdir(parents=True, exist_ok=True)
+
+    def data_digest(self, filepath_data):
+        """
+        Content hash of a data file (or of every file of a .npy directory).
+
+        Raises:
+            FileNotFoundError:
+                If filepath_data does not exist.
+        """
+        if str(filepath_data) == '':
+            raise FileNotFoundError('Empty data filepath')
+        path = Path(filepath_data).resolve()
+        files = sorted(p for p in path.rglob('*') if p.is_file()) if path.is_dir() else [path]
+        stats = [[str(p.relative_to(path)) if path.is_dir() else '', p.stat().st_size, p.stat().st_mtime_ns] for p in files]
+
+        digests = self._read_digests()
+        memo = digests.get(str(path))
+        if memo is not None and memo['stats'] == stats:
+            return memo['digest']
+
+        h = hashlib.sha256()
+        for p, (name, _, _) in zip(files, stats):
+            h.update(name.encode() + b'\0')
+            with open(str(p), 'rb') as f:
+                for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+                    h.update(block)
+        digest = h.hexdigest()
+        digests[str(path)] = {'stats': stats, 'digest': digest}
+        self._write_json(self.directory / FILENAME_DIGESTS, digests)
+        return digest
+
+    def lookup(self, digest, parameters, precision='float64'):
+        """
+        Spike detection results for a data file and parameters, from the
+         'spikes' entry if present, otherwise from the 'smoothed' entry
+         (the new spikes are then cached). Results of each precision (see
+         pipeline()) are cached separately.
+
+        Returns:
+            histogram (np.ndarray):
+                Spike count per epoch code (see conditions.code_histogram).
+            spike_trains (spikes.SpikeTrains):
+                Spike times of every neuron.
+            None is returned instead if neither entry is cached.
+        """
+        sample_rate, threshold = parameters['sample_rate'], parameters['threshold']
+        path = self._get(_key(_kind('spikes', precision), digest, sample_rate, threshold))
+        if path is not None:
+            return np.load(str(path / 'histogram.npy')), spikes.SpikeTrains.load(str(path / 'spikes.npz'))
+
+        path = self._get(_key(_kind('smoothed', precision), digest, sample_rate))
+        if path is None:
+            return None
+        traces_smooth = np.load(str(path / 'traces_smooth.npy'), mmap_mode='r')
+        codes = np.load(str(path / 'codes.npy'))
+        with open(str(path / 'neurons.json'), 'r') as f:
+            neurons = json.load(f)
+
+        plan = detection.get_plan(float(sample_rate), float(threshold))
+        spike_times, offsets = detection.find_peaks_batched(traces_smooth, plan.threshold, plan.distance)
+        spike_trains = spikes.SpikeTrains(spike_times, offsets, neurons, n_samples=len(codes))
+        histogram = conditions.code_histogram(spike_trains.spike_times, codes)
+        self.put_spikes(digest, parameters, histogram, spike_trains, precision=precision)
+        return histogram, spike_trains
+
+    def put_smoothed(self, digest, sample_rate, traces_smooth, codes, neurons, precision='float64'):
+        """
+        Store the smoothed traces (n_samples, n_neurons) and epoch codes of a data file.
+        """
+        def write(path):
+            np.save(str(path / 'traces_smooth.npy'), traces_smooth)
+            np.save(str(path / 'codes.npy'), codes)
+            self._write_json(path / 'neurons.json', list(neurons))
+        nbytes = np.asarray(traces_smooth).nbytes + np.asarray(codes).nbytes
+        self._put(_key(_kind('smoothed', precision), digest, sample_rate), write, nbytes)
+
+    def put_spikes(self, digest, parameters, histogram, spike_trains, precision='float64'):
+        """
+        Store the spike trains and epoch code histogram of a data file.
+        """
+        def write(path):
+            np.save(str(path / 'histogram.npy'), histogram)
+            spike_trains.save(str(path / 'spikes.npz'))
+        nbytes = histogram.nbytes + spike_trains.spike_times.nbytes + spike_trains.offsets.nbytes
+        self._put(_key(_kind('spikes', precision), digest, parameters['sample_rate'], parameters['threshold']), write, nbytes)
+
+    def size(self):
+        """
+        Total size in bytes of the cached entries.
+        """
+        return sum(size for _, _, size in self._entries())
+
+    def clear(self):
+        """
+        Delete every entry and memoized hash.
+        """
+        shutil.rmtree(str(self.directory))
+        (self.directory / 'entries').mkdir(parents=True, exist_ok=True)
+
+    def _get(self, key):
+        path = self.directory / 'entries' / key
+        if not path.is_dir():
+            return None
+        ## The modification time of the entry directory is its last use
+        os.utime(str(path))
+        return path
+
+    def _put(self, key, write, nbytes):
+        path = self.directory / 'entries' / key
+        if path.is_dir():
+            os.utime(str(path))
+            return
+        ## It would be evicted as soon as written, along with everything else
+        if nbytes > self.max_bytes:
+            logging.warning('Cache entry ' + key + ' of ' + str(nbytes) + ' bytes not stored: larger than max_bytes=' + str(self.max_bytes))
+            return
+        ## Write into a temporary directory and rename it, so that readers
+        ##  (possibly other processes) never see a partial entry.
+        path_tmp = Path(tempfile.mkdtemp(dir=str(self.directory / 'entries'), prefix='.tmp-'))
+        try:
+            write(path_tmp)
+            os.rename(str(path_tmp), str(path))
+        except OSError:
+            ## Another process stored the same entry first
+            shutil.rmtree(str(path_tmp), ignore_errors=True)
+            if not path.is_dir():
+                raise
+        self._evict()
+
+    def _entries(self):
+        """
+        (last use, path, size) of every complete entry.
+        """
+        entries = []
+        for path in (self.directory / 'entries').iterdir():
+            if path.name.startswith('.tmp-'):
+                continue
+            size = sum(p.stat().st_size for p in path.iterdir())
+            entries.append((path.stat().st_mtime_ns, path, size))
+        return entries
+
+    def _evict(self):
+        entries = sorted(self._entries(), key=lambda entry: entry[0])
+        total = sum(size for _, _, size in entries)
+        for _, path, size in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(str(path), ignore_errors=True)
+            total -= size
+
+    def _read_digests(self):
+        try:
+            with open(str(self.directory / FILENAME_DIGESTS), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    @staticmethod
+    def _write_json(filepath, obj):
+        filepath_tmp = str(filepath) + '.tmp-' + str(os.getpid())
+        with open(filepath_tmp, 'w') as f:
+            json.dump(obj, f)
+        os.replace(filepath_tmp, str(filepath))
+
+
+def _kind(kind, precision):
+    ## No precision suffix for float64, so that existing keys stay valid
+    return kind if precision == 'float64' else kind + '_' + precision
+
+
+def _key(kind, digest, *parameters):
+    """
+    Entry name: the kind of entry and a hash of the data digest and parameters.
+    Parameters are hashed by their JSON representation, which is exact for floats.
+    """
+    h = hashlib.sha256(json.dumps([digest] + [float(p) for p in parameters]).encode())
+    return kind + '-' + h.hexdigest()[:32]
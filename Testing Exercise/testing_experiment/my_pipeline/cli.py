@@ -0,0 +1,333 @@
+## Command-line interface
+##
+##     my-pipeline run data/*.csv --params params.json --jobs 8 --out results.parquet
+##
+## Sessions run on a pool of processes (see batch.iter_batch). Each row is
+##  written to the output as soon as its session finishes, and a rerun with
+##  --resume skips the sessions that already succeeded in the output, so an
+##  interrupted job can be restarted where it stopped. Failed sessions are
+##  run again and their rows replaced.
+##
+##     my-pipeline serve --params params.json --port 8765 --jobs 8
+##     my-pipeline submit data/session_01.csv --port 8765
+##
+## serve keeps a resident service running (see service.py) and submit sends
+##  sessions to it, without paying for the interpreter start and imports.
+
+import argparse
+import csv
+import glob
+import json
+import os
+import sys
+import time
+from pathlib import Path
+
+from . import conditions, parallel, readers
+
+COLUMNS = ['session'] + list(conditions.CONDITIONS) + ['error']
+## Parquet files cannot be appended to, so rows are streamed to this CSV
+##  journal next to the output and converted when the batch ends
+SUFFIX_JOURNAL = '.partial.csv'
+DEFAULT_PORT = 8765
+
+
+def main(argv=None):
+    """
+    Entry point of the my-pipeline command (also `python -m my_pipeline`).
+
+    Returns:
+        status (int):
+            0 if every session run succeeded, 1 if some failed (their errors
+             are in the output), 2 if the batch could not start.
+    """
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+def build_parser():
+    from . import __version__
+
+    parser = argparse.ArgumentParser(prog='my-pipeline', description='Count spikes per condition in neural recordings.')
+    parser.add_argument('--version', action='version', version='%(prog)s ' + __version__)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run = commands.add_parser('run', help='Run the pipeline over many sessions.')
+    run.add_argument('sessions', nargs='+',
+                     help='Data files (any format accepted by pipeline()) or quoted glob patterns.')
+    run.add_argument('--params', required=True,
+                     help='Parameters JSON file shared by all sessions.')
+    run.add_argument('--out', required=True,
+                     help='Results file, one row per session: .csv, or .parquet/.pq.')
+    run.add_argument('--jobs', '-j', type=int, default=None,
+                     help='Number of sessions run at the same time (default: number of CPUs).')
+    run.add_argument('--executor', choices=parallel.EXECUTORS, default='processes',
+                     help='How sessions are run concurrently (default: processes).')
+    run.add_argument('--chunk-size', type=int, default=None,
+                     help='Stream every session in blocks of this many rows (ties between equal peaks may resolve differently, see pipeline()).')
+    mode = run.add_mutually_exclusive_group()
+    mode.add_argument('--resume', action='store_true',
+                      help='Skip the sessions that succeeded in the output, and add (or replace) the others.')
+    mode.add_argument('--overwrite', action='store_true',
+                      help='Replace the output if it exists.')
+    run.add_argument('--quiet', '-q', action='store_true',
+                     help='Only print the final summary.')
+    run.set_defaults(func=run_command)
+
+    serve = commands.add_parser('serve', help='Run a resident service that sessions can be submitted to.')
+    _add_address_arguments(serve)
+    serve.add_argument('--params', default=None,
+                       help='Default parameters JSON file of the submitted sessions.')
+    serve.add_argument('--jobs', '-j', type=int, default=None,
+                       help='Number of sessions run at the same time (default: number of CPUs).')
+    serve.add_argument('--executor', choices=['threads', 'processes'], default='processes',
+                       help='How sessions are run concurrently (default: processes).')
+    serve.add_argument('--max-queue', type=int, default=None,
+                       help='Sessions that may wait for a worker before the service answers busy'
+                            ' (default: 4 per worker).')
+    serve.set_defaults(func=serve_command)
+
+    submit = commands.add_parser('submit', help='Run sessions on a running service and print the results as JSON.')
+    _add_address_arguments(submit)
+    submit.add_argument('sessions', nargs='+',
+                        help='Data files or quoted glob patterns, as seen by the service.')
+    submit.add_argument('--params', default=None,
+                        help='Parameters JSON file (default: the one the service was started with).')
+    submit.add_argument('--chunk-size', type=int, default=None,
+                        help='Stream every session in blocks of this many rows (ties between equal peaks may resolve differently, see pipeline()).')
+    submit.set_defaults(func=submit_command)
+    return parser
+
+
+def _add_address_arguments(parser):
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='Address of the service (default: 127.0.0.1).')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT,
+                        help=f'Port of the service (default: {DEFAULT_PORT}).')
+    parser.add_argument('--socket', default=None,
+                        help='Unix socket of the service, instead of --host and --port.')
+
+
+def _address(args):
+    return args.socket if args.socket is not None else (args.host, args.port)
+
+
+def run_command(args):
+    from . import batch
+
+    sessions = expand_sessions(args.sessions)
+    filepath_out = Path(args.out)
+    is_parquet = filepath_out.suffix.lower() in readers.SUFFIXES_PARQUET
+    filepath_rows = journal_path(filepath_out) if is_parquet else filepath_out
+
+    if args.overwrite:
+        for path in [filepath_out, filepath_rows]:
+            if path.exists():
+                path.unlink()
+    elif (filepath_out.exists() or filepath_rows.exists()) and not args.resume:
+        _print_error(str(filepath_out) + ' exists, use --resume to add to it or --overwrite to replace it')
+        return 2
+    done = read_sessions(filepath_out) | read_sessions(filepath_rows)
+    todo = [session for session in sessions if session not in done]
+
+    try:
+        results = batch.iter_batch(todo, args.params, executor=args.executor, n_workers=args.jobs, chunk_size=args.chunk_size)
+    except (OSError, ValueError) as ex:
+        _print_error('invalid parameters file ' + args.params + ': ' + str(ex))
+        return 2
+    ## The rows of failed sessions run again are replaced, not duplicated
+    _drop_rows(filepath_rows, set(todo))
+
+    n_failed, n_bytes = 0, 0
+    tic = time.perf_counter()
+    with RowWriter(filepath_rows) as writer:
+        for ii, (session, ns_conditions, error) in enumerate(results):
+            writer.write(session, ns_conditions, error)
+            n_failed += error is not None
+            n_bytes += _size(session)
+            if not args.quiet:
+                status = 'ok' if error is None else 'failed: ' + error
+                print(f'[{ii + 1}/{len(todo)}] {session} {status}', file=sys.stderr, flush=True)
+    wall = time.perf_counter() - tic
+
+    if is_parquet:
+        write_parquet(filepath_out, filepath_rows)
+
+    n_run = len(todo)
+    print(
+        f'{n_run} sessions run ({n_failed} failed, {len(sessions) - n_run} skipped) in {wall:.1f} s:'
+        f' {n_run / wall if wall > 0 else 0:.2f} sessions/s, {n_bytes / 1e6 / wall if wall > 0 else 0:.1f} MB/s',
+        file=sys.stderr,
+    )
+    return 1 if n_failed > 0 else 0
+
+
+def serve_command(args):
+    from . import service
+
+    try:
+        service.serve(_address(args), args.params, executor=args.executor, n_workers=args.jobs, max_queue=args.max_queue)
+    except (OSError, ValueError) as ex:
+        _print_error('cannot start the service: ' + str(ex))
+        return 2
+    return 0
+
+
+def submit_command(args):
+    from . import service
+
+    sessions = expand_sessions(args.sessions)
+    n_failed = 0
+    try:
+        with service.Client(_address(args)) as client:
+            for session in sessions:
+                result = client.run(session, args.params, chunk_size=args.chunk_size)
+                n_failed += result['error'] is not None
+                print(json.dumps(result), flush=True)
+    except (OSError, ValueError, service.ServiceBusy) as ex:
+        _print_error('service error: ' + str(ex))
+        return 2
+    return 1 if n_failed > 0 else 0
+
+
+def expand_sessions(patterns):
+    """
+    Filepaths of the sessions: every argument that exists as is, and the
+     (sorted) matches of the others as glob patterns. Duplicates are dropped.
+    """
+    sessions = []
+    for pattern in patterns:
+        matches = [pattern] if os.path.exists(pattern) else sorted(glob.glob(pattern))
+        if len(matches) == 0:
+            _print_error('no session matches ' + pattern)
+        sessions.extend(matches)
+    return list(dict.fromkeys(sessions))
+
+
+def journal_path(filepath_out):
+    return filepath_out.with_name(filepath_out.name + SUFFIX_JOURNAL)
+
+
+def read_sessions(filepath):
+    """
+    Sessions that succeeded in a results file (CSV or Parquet), or an empty
+     set if it does not exist. A row cut off by an interrupted run is ignored.
+    """
+    filepath = Path(filepath)
+    if not filepath.exists():
+        return set()
+    if filepath.suffix.lower() in readers.SUFFIXES_PARQUET:
+        import pyarrow.parquet
+        table = pyarrow.parquet.read_table(str(filepath), columns=['session', 'error']).to_pydict()
+        return {session for session, error in zip(table['session'], table['error']) if error is None}
+    with open(str(filepath), 'r', newline='') as f:
+        return {row['session'] for row in csv.DictReader(f) if row.get('error') == ''}
+
+
+class RowWriter:
+    """
+    Appends result rows to a CSV file, flushing after every row so that the
+     file holds every finished session even if the run is killed.
+    """
+    def __init__(self, filepath):
+        self.filepath = Path(filepath)
+        self._file = None
+        self._writer = None
+
+    def __enter__(self):
+        _drop_partial_row(self.filepath)
+        is_new = not self.filepath.exists() or self.filepath.stat().st_size == 0
+        self._file = open(str(self.filepath), 'a', newline='')
+        self._writer = csv.writer(self._file)
+        if is_new:
+            self._writer.writerow(COLUMNS)
+            self._file.flush()
+        return self
+
+    def write(self, session, ns_conditions, error):
+        counts = [''] * len(conditions.CONDITIONS) if ns_conditions is None else [ns_conditions[key] for key in conditions.CONDITIONS]
+        self._writer.writerow([session] + counts + ['' if error is None else error])
+        self._file.flush()
+
+    def __exit__(self, *exc):
+        self._file.close()
+
+
+def write_parquet(filepath_out, filepath_rows):
+    """
+    Add the rows of the CSV journal to the Parquet output (atomically
+     replacing it) and remove the journal. A session's row in the journal
+     replaces its earlier one (a failed session run again).
+    """
+    import pandas as pd
+
+    tables = []
+    if filepath_out.exists():
+        tables.append(pd.read_parquet(str(filepath_out)))
+    if filepath_rows.exists():
+        tables.append(read_rows(filepath_rows))
+    results = pd.concat(tables, ignore_index=True) if tables else read_rows(None)
+    results = results.drop_duplicates('session', keep='last')
+
+    filepath_tmp = filepath_out.with_name(filepath_out.name + '.tmp')
+    results.to_parquet(str(filepath_tmp), index=False)
+    os.replace(str(filepath_tmp), str(filepath_out))
+    if filepath_rows.exists():
+        filepath_rows.unlink()
+
+
+def read_rows(filepath):
+    """
+    Results CSV as a DataFrame with the columns of batch.results_table:
+     nullable integer counts and an 'error' column (None if it succeeded).
+    """
+    import pandas as pd
+
+    if filepath is None:
+        return pd.DataFrame({key: pd.Series([], dtype='Int64' if key in conditions.CONDITIONS else object) for key in COLUMNS})
+    dtypes = {key: 'Int64' for key in conditions.CONDITIONS}
+    dtypes.update(session=str, error=str)
+    results = pd.read_csv(str(filepath), dtype=dtypes, keep_default_na=False, na_values={key: [''] for key in conditions.CONDITIONS})
+    results['error'] = results['error'].astype(object).where(results['error'] != '', None)
+    return results
+
+
+def _drop_partial_row(filepath):
+    ## A run killed while writing leaves a row without its line ending, which
+    ##  the next row would be appended to
+    if not filepath.exists() or filepath.stat().st_size == 0:
+        return
+    with open(str(filepath), 'rb+') as f:
+        f.seek(-1, os.SEEK_END)
+        if f.read(1) == b'\n':
+            return
+        f.seek(0)
+        f.truncate(f.read().rfind(b'\n') + 1)
+
+
+def _drop_rows(filepath, sessions):
+    ## Rewrites a results CSV without the rows of the given sessions
+    if not filepath.exists() or filepath.stat().st_size == 0:
+        return
+    _drop_partial_row(filepath)
+    with open(str(filepath), 'r', newline='') as f:
+        rows = list(csv.reader(f))
+    kept = rows[:1] + [row for row in rows[1:] if row[0] not in sessions]
+    if len(kept) == len(rows):
+        return
+    filepath_tmp = filepath.with_name(filepath.name + '.tmp')
+    with open(str(filepath_tmp), 'w', newline='') as f:
+        csv.writer(f).writerows(kept)
+    os.replace(str(filepath_tmp), str(filepath))
+
+
+def _size(filepath):
+    path = Path(filepath)
+    if path.is_dir():
+        return sum(f.stat().st_size for f in path.iterdir() if f.is_file())
+    return path.stat().st_size if path.exists() else 0
+
+
+def _print_error(message):
+    print('my-pipeline: ' + message, file=sys.stderr)
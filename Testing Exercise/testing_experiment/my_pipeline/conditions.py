@@ -0,0 +1,263 @@
+## Single-pass condition counting
+
+import numpy as np
+
+## Bit of each temporal epoch in the packed per-sample code
+EPOCH_BITS = {
+    't': 1, ## trial_on
+    'r': 2, ## reward_on
+    'l': 4, ## light_on
+}
+## Data column of each epoch
+EPOCH_COLUMNS = {
+    't': 'trial_on',
+    'r': 'reward_on',
+    'l': 'light_on',
+}
+## Conditions reported by pipeline(). Each letter is an epoch that must be on.
+CONDITIONS = ['t', 'r', 'l', 'tr', 'tl', 'rl', 'trl']
+N_CODES = 2 ** len(EPOCH_BITS)
+
+
+def epoch_codes(t, r, l):
+    """
+    Pack the three boolean epoch columns into one uint8 code per sample.
+
+    Args:
+        t, r, l (1-D array-like of bool):
+            'trial_on', 'reward_on' and 'light_on' columns.
+
+    Returns:
+        codes (np.ndarray of uint8):
+            t * 1 + r * 2 + l * 4 for every sample.
+    """
+    codes = np.asarray(t, dtype=np.uint8).copy()
+    codes |= np.asarray(r, dtype=np.uint8) << 1
+    codes |= np.asarray(l, dtype=np.uint8) << 2
+    return codes
+
+
+def code_histogram(spike_times, codes):
+    """
+    Look up the epoch code of every spike once and histogram them.
+
+    Args:
+        spike_times (1-D array of int):
+            Sample index of each spike. Spikes of different neurons may
+             share an index and are counted separately.
+        codes (np.ndarray of uint8):
+            Output of epoch_codes.
+
+    Returns:
+        histogram (np.ndarray of int64):
+            Number of spikes for each of the N_CODES epoch codes.
+    """
+    return np.bincount(codes[spike_times], minlength=N_CODES)
+
+
+def neuron_code_histogram(spike_times, neuron_ids, codes, n_neurons):
+    """
+    code_histogram for every neuron in one pass.
+
+    Args:
+        spike_times (1-D array of int):
+            Sample index of each spike.
+        neuron_ids (1-D array of int):
+            Neuron of each spike.
+        codes (np.ndarray of uint8):
+            Output of epoch_codes.
+        n_neurons (int):
+            Number of neurons (rows of the output).
+
+    Returns:
+        histograms (np.ndarray of int64, shape (n_neurons, N_CODES)):
+            Number of spikes of each neuron for each epoch code.
+    """
+    flat = neuron_ids.astype(np.int64) * N_CODES + codes[spike_times]
+    return np.bincount(flat, minlength=n_neurons * N_CODES).reshape(n_neurons, N_CODES)
+
+
+def condition_mask(condition):
+    """
+    Bitmask of a condition string such as 'tr'. The empty string selects
+     every spike.
+    """
+    mask = 0
+    for key in condition:
+        if key not in EPOCH_BITS:
+            raise ValueError('Unknown epoch ' + repr(key) + ' in condition ' + repr(condition) + '. Expected letters from ' + str(list(EPOCH_BITS)))
+        mask |= EPOCH_BITS[key]
+    return mask
+
+
+def evaluate_condition(condition, epochs, everything):
+    """
+    Evaluate a condition on any representation of the epochs that supports
+     the &, |, ^ and ~ operators (boolean arrays, intervals.Intervals).
+    A condition is either
+        - a string of epoch letters (see EPOCH_BITS): all of them must be on,
+           whatever the state of the others. 'tr' is trial and reward on;
+           the empty string is always true.
+        - an expression combining epochs with & (and), | (or), ^ (xor) and
+           ~ (not), e.g. 't & ~l' or '(r | l) & t'. Epochs can be named by
+           letter, by letters ('tr' is 't & r') or by column ('trial_on'),
+           and `and`, `or` and `not` can be used instead of the operators.
+
+    Args:
+        condition (str):
+            Condition to evaluate.
+        epochs (dict):
+            Value of each epoch letter.
+        everything:
+            Value of the empty condition (all samples).
+
+    Raises:
+        ValueError:
+            If the condition is not a valid expression of the epochs.
+    """
+    import ast
+
+    if all(key in EPOCH_BITS for key in condition):
+        return _all_of(condition, epochs, everything)
+    try:
+        tree = ast.parse(condition, mode='eval')
+    except SyntaxError as ex:
+        raise ValueError('Invalid condition ' + repr(condition) + ': ' + str(ex.msg)) from None
+    return _evaluate_node(tree.body, condition, epochs, everything)
+
+
+def _all_of(letters, epochs, everything):
+    result = everything
+    for key in letters:
+        result = result & epochs[key]
+    return result
+
+
+def _evaluate_node(node, condition, epochs, everything):
+    import ast
+
+    evaluate = lambda child: _evaluate_node(child, condition, epochs, everything)
+    if isinstance(node, ast.Name):
+        columns = {column: key for key, column in EPOCH_COLUMNS.items()}
+        if node.id in columns:
+            return epochs[columns[node.id]]
+        if all(key in EPOCH_BITS for key in node.id):
+            return _all_of(node.id, epochs, everything)
+        raise ValueError('Unknown epoch ' + repr(node.id) + ' in condition ' + repr(condition)
+                         + '. Expected letters from ' + str(list(EPOCH_BITS)) + ' or columns ' + str(list(EPOCH_COLUMNS.values())))
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.Invert, ast.Not)):
+        return ~evaluate(node.operand)
+    if isinstance(node, ast.BinOp) and isinstance(node.op, (ast.BitAnd, ast.BitOr, ast.BitXor)):
+        left, right = evaluate(node.left), evaluate(node.right)
+        if isinstance(node.op, ast.BitAnd):
+            return left & right
+        if isinstance(node.op, ast.BitOr):
+            return left | right
+        return left ^ right
+    if isinstance(node, ast.BoolOp):
+        values = [evaluate(value) for value in node.values]
+        result = values[0]
+        for value in values[1:]:
+            result = (result & value) if isinstance(node.op, ast.And) else (result | value)
+        return result
+    raise ValueError('Invalid condition ' + repr(condition) + ': only epochs, &, |, ^, ~, and, or, not and parentheses are allowed')
+
+
+def condition_codes(condition):
+    """
+    Truth table of a condition (see evaluate_condition) over the epoch
+     codes: entry [code] is True if a spike with that code counts towards
+     the condition.
+    """
+    codes = np.arange(N_CODES)
+    epochs = {key: (codes & bit) != 0 for key, bit in EPOCH_BITS.items()}
+    return np.asarray(evaluate_condition(condition, epochs, np.ones(N_CODES, dtype=np.bool_)))
+
+
+def condition_matrix(conditions=CONDITIONS):
+    """
+    (N_CODES, n_conditions) matrix of 0/1: entry [code, jj] is 1 if a spike
+     with that code counts towards conditions[jj].
+    """
+    matrix = np.zeros((N_CODES, len(conditions)), dtype=np.int64)
+    for jj, condition in enumerate(conditions):
+        matrix[:, jj] = condition_codes(condition)
+    return matrix
+
+
+def count_conditions(histogram, conditions=CONDITIONS):
+    """
+    Number of spikes during each condition, read off the code histogram.
+    A spike counts towards a condition of epoch letters if all of the
+     condition's epochs are on, whatever the state of the other epochs.
+
+    Args:
+        histogram (np.ndarray):
+            Output of code_histogram.
+        conditions (list of str):
+            Conditions to count, as strings of epoch letters (see EPOCH_BITS)
+             or expressions (see evaluate_condition).
+
+    Returns:
+        ns_conditions (dict):
+            Number of spikes for each condition.
+    """
+    ns_conditions = {}
+    for condition in conditions:
+        ns_conditions[condition] = int(histogram[condition_codes(condition)].sum())
+    return ns_conditions
+
+
+def count_conditions_matrix(histograms, conditions=CONDITIONS):
+    """
+    count_conditions for every row of histograms.
+
+    Args:
+        histograms (np.ndarray, shape (n_neurons, N_CODES)):
+            Output of neuron_code_histogram.
+        conditions (list of str):
+            Conditions to count.
+
+    Returns:
+        ns_conditions (np.ndarray of int64, shape (n_neurons, n_conditions)):
+            Number of spikes of each neuron during each condition.
+    """
+    return np.asarray(histograms, dtype=np.int64) @ condition_matrix(conditions)
+
+
+def trial_bounds(trial_on):
+    """
+    Trials as the contiguous runs of trial_on, found from its rising and
+     falling edges.
+
+    Returns:
+        starts, stops (np.ndarray of int64):
+            Trial ii covers samples starts[ii] <= index < stops[ii].
+    """
+    on = np.asarray(trial_on, dtype=np.int8)
+    edges = np.diff(on, prepend=np.int8(0), append=np.int8(0))
+    return np.flatnonzero(edges == 1).astype(np.int64), np.flatnonzero(edges == -1).astype(np.int64)
+
+
+def count_trials(spike_times, neuron_ids, starts, stops, n_neurons):
+    """
+    Number of spikes of each neuron during each trial.
+
+    Args:
+        spike_times, neuron_ids (1-D array of int):
+            Sample index and neuron of each spike.
+        starts, stops (1-D array of int):
+            Output of trial_bounds.
+        n_neurons (int):
+            Number of neurons (rows of the output).
+
+    Returns:
+        ns_trials (np.ndarray of int64, shape (n_neurons, n_trials)):
+            Number of spikes of each neuron in each trial.
+    """
+    n_trials = len(starts)
+    trial = np.searchsorted(starts, spike_times, side='right') - 1
+    inside = trial >= 0
+    inside[inside] = spike_times[inside] < stops[trial[inside]]
+    flat = neuron_ids[inside].astype(np.int64) * n_trials + trial[inside]
+    return np.bincount(flat, minlength=n_neurons * n_trials).reshape(n_neurons, n_trials)
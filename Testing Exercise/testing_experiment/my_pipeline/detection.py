@@ -0,0 +1,528 @@
+## Spike detection plans and batched smoothing
+
+import functools
+from collections import namedtuple
+
+import numpy as np
+
+## Everything count_spikes derives from (sample_rate, threshold)
+DetectionPlan = namedtuple('DetectionPlan', [
+    'sample_rate',
+    'threshold',
+    'window_length', ## Savitzky-Golay window (samples)
+    'coeffs', ## Savitzky-Golay convolution coefficients (read-only)
+    'distance', ## minimal distance between spikes (samples), as passed to find_peaks
+])
+
+## Precisions the traces can be stored and smoothed in (see as_precision)
+PRECISIONS = ['float64', 'float32', 'int16']
+## Steps local_maxima_batched walks along flat tops before ending the
+##  longer ones in one pass over their columns
+FLAT_STEPS = 8
+
+## int16 traces with their per-neuron calibration: traces ~ counts * scale + offset
+QuantizedTraces = namedtuple('QuantizedTraces', [
+    'counts', ## int16 array, same shape as the traces
+    'scale', ## float32, one per neuron
+    'offset', ## float32, one per neuron
+])
+
+
+@functools.lru_cache(maxsize=64)
+def get_plan(sample_rate, threshold):
+    """
+    Build (or fetch from the LRU cache) the detection plan for a sample rate
+     and threshold. Plans are shared by every detector, neuron and file with
+     the same parameters.
+    Raises the ValueError of scipy.signal.savgol_filter if the sample rate
+     gives a window too short for the polynomial fit (e.g. sample_rate=1000).
+    """
+    from .pipeline import peak_distance, savgol_window
+
+    window_length = savgol_window(sample_rate)
+    coeffs = savgol_coeffs(window_length)
+    coeffs.setflags(write=False)
+    return DetectionPlan(sample_rate, threshold, window_length, coeffs, peak_distance(sample_rate))
+
+
+def savgol_coeffs(window_length, polyorder=2):
+    """
+    Same coefficients as scipy.signal.savgol_coeffs(window_length, polyorder),
+     bit for bit: the same least-squares problem solved with the same
+     scipy.linalg.lstsq call. scipy.signal itself takes longer to import than
+     all of spike detection on a short recording, and only count_spikes needs it.
+    """
+    import scipy.linalg
+
+    if polyorder >= window_length:
+        raise ValueError('polyorder must be less than window_length.')
+
+    ## Centered window (between two samples if window_length is even),
+    ##  reversed for use as a convolution kernel
+    halflen, rem = divmod(window_length, 2)
+    pos = halflen if rem else halflen - 0.5
+    x = np.arange(-pos, window_length - pos, dtype=float)[::-1]
+    A = x ** np.arange(polyorder + 1).reshape(-1, 1)
+    y = np.zeros(polyorder + 1)
+    y[0] = 1.0
+    coeffs, _, _, _ = scipy.linalg.lstsq(A, y)
+    return coeffs
+
+
+class SpikeDetector:
+    """
+    Reusable spike detector built from the pipeline parameters.
+    The Savitzky-Golay coefficients, window and peak distance come from a
+     cached DetectionPlan, and the filter and peak search are applied to all
+     neuron columns at once. The spike times are identical to calling
+     count_spikes on each column.
+
+    Args:
+        sample_rate (float):
+            Frequency at which data samples were collected.
+        threshold (float):
+            Voltage above which the voltage must reach to be considered a valid spike.
+        precision (str):
+            If given, traces are converted to this precision before smoothing
+             (see as_precision). None smooths float32 traces in float32 and
+             everything else in float64, as count_spikes does.
+        fused (bool or str):
+            If set, detect() and detect_csr() smooth and search for peaks in
+             one pass without storing the smoothed traces (see fused.py).
+             True uses the default engine; 'numba' or 'numpy' picks one.
+    """
+    def __init__(self, sample_rate, threshold, precision=None, fused=False):
+        if precision is not None and precision not in PRECISIONS:
+            raise ValueError('precision must be one of ' + str(PRECISIONS) + ', got: ' + repr(precision))
+        self.plan = get_plan(float(sample_rate), float(threshold))
+        self.precision = precision
+        self.fused = fused
+
+    @classmethod
+    def from_parameters(cls, parameters, precision=None, fused=False):
+        """
+        Build a detector from a parameters dict (see pipeline()).
+        """
+        return cls(parameters['sample_rate'], parameters['threshold'], precision=precision, fused=fused)
+
+    @classmethod
+    def from_file(cls, filepath_parameters):
+        """
+        Build a detector from a parameters JSON file (see pipeline()).
+        """
+        from .pipeline import load_parameters
+        return cls.from_parameters(load_parameters(filepath_parameters))
+
+    def smooth(self, traces):
+        """
+        Savitzky-Golay filter of every column of traces.
+
+        Args:
+            traces (array-like, shape (n_samples,) or (n_samples, n_neurons), or QuantizedTraces):
+                Voltage traces, one neuron per column.
+
+        Returns:
+            traces_smooth (np.ndarray):
+                Same shape as traces. float32 input stays float32, everything
+                 else is filtered in float64 (as savgol_filter does), unless
+                 the detector has a precision.
+        """
+        if self.precision is not None:
+            traces = as_precision(traces, self.precision)
+        return savgol_smooth(traces, self.plan)
+
+    def detect(self, traces):
+        """
+        Spike times of every column of traces.
+
+        Args:
+            traces (array-like, shape (n_samples,) or (n_samples, n_neurons)):
+                Voltage traces, one neuron per column.
+
+        Returns:
+            spike_times (np.ndarray or list of np.ndarray):
+                Peak indices of the trace, or of each column for 2-D input.
+        """
+        spike_times, offsets = self.detect_csr(traces)
+        if np.ndim(traces) == 1:
+            return spike_times
+        return [spike_times[offsets[ii]:offsets[ii + 1]] for ii in range(len(offsets) - 1)]
+
+    def detect_csr(self, traces):
+        """
+        Spike times of every column of traces in compressed (CSR-like) form.
+        All columns are smoothed and searched for peaks at once (see
+         savgol_smooth and find_peaks_batched), or one after the other by
+         the fused kernel.
+
+        Args:
+            traces (array-like, shape (n_samples,) or (n_samples, n_neurons)):
+                Voltage traces, one neuron per column.
+
+        Returns:
+            spike_times (np.ndarray of int64):
+                Peak indices of all neurons, neuron after neuron.
+            offsets (np.ndarray of int64, shape (n_neurons + 1,)):
+                Peaks of neuron ii are spike_times[offsets[ii]:offsets[ii + 1]].
+        """
+        if self.fused:
+            from . import fused
+
+            if self.precision is not None:
+                traces = as_precision(traces, self.precision)
+            return fused.find_peaks_fused(traces, self.plan, engine=None if self.fused is True else self.fused)
+        return find_peaks_batched(self.smooth(traces), self.plan.threshold, self.plan.distance)
+
+
+def savgol_smooth(traces, plan, fit_start=True, fit_end=True):
+    """
+    savgol_filter(traces, plan.window_length, 2, axis=0), with cached
+     coefficients and bitwise identical to filtering each column on its own.
+    savgol_filter fits a polynomial to the first and last window of samples
+     to fill in the first and last window_length // 2 outputs. np.polyfit
+     solves all columns of a 2-D block together, which is not bitwise
+     identical to the 1-D fit, so those few samples are fitted per column
+     (see _fit_edge).
+
+    Args:
+        traces (array-like, shape (n_samples,) or (n_samples, n_neurons), or QuantizedTraces):
+            Voltage traces, one neuron per column. int16 counts are filtered
+             into float32 and then calibrated with their scale and offset.
+        plan (DetectionPlan):
+            Output of get_plan.
+        fit_start, fit_end (bool):
+            Whether the first/last samples of traces are the ends of the
+             recording. If False, the corresponding edge values are left as
+             the (zero-padded) convolution output, for callers that discard
+             them (see streaming.py).
+
+    Returns:
+        traces_smooth (np.ndarray):
+            Same shape as traces.
+    """
+    import scipy.ndimage
+
+    if isinstance(traces, QuantizedTraces):
+        ## int16 counts are filtered into float32 directly (ndimage accumulates
+        ##  in float64 whatever the input type), without a float copy of the
+        ##  input, then calibrated
+        x = traces.counts
+        dtype_out = np.float32
+    else:
+        x = np.asarray(traces)
+        if x.dtype != np.float64 and x.dtype != np.float32:
+            x = x.astype(np.float64)
+        dtype_out = x.dtype
+    window_length = plan.window_length
+    if window_length > x.shape[0]:
+        raise ValueError("If mode is 'interp', window_length must be less than or equal to the size of x.")
+
+    ## np.empty_like keeps the memory layout, so Fortran-ordered traces give
+    ##  contiguous smoothed neurons.
+    y = np.empty_like(x, dtype=dtype_out)
+    scipy.ndimage.convolve1d(x, plan.coeffs, axis=0, output=y, mode='constant')
+
+    halflen = window_length // 2
+    if halflen > 0 and (fit_start or fit_end):
+        ## (n_samples, n_neurons) views, also for 1-D input
+        x_2d = x.reshape(x.shape[0], -1)
+        y_2d = y.reshape(y.shape[0], -1)
+        for ii in range(x_2d.shape[1]):
+            if fit_start:
+                y_2d[:halflen, ii] = _fit_edge(x_2d[:window_length, ii], 0, halflen)
+            if fit_end:
+                y_2d[-halflen:, ii] = _fit_edge(x_2d[-window_length:, ii], window_length - halflen, window_length)
+    if isinstance(traces, QuantizedTraces):
+        y *= traces.scale
+        y += traces.offset
+    return y
+
+
+def _fit_edge(x_edge, interp_start, interp_stop):
+    """
+    The polynomial edge fit of savgol_filter(mode='interp') for one column,
+     done the same way (a (window_length, 1) np.polyfit, then np.polyval)
+     without the rest of savgol_filter.
+    """
+    poly_coeffs = np.polyfit(np.arange(len(x_edge)), x_edge.reshape(-1, 1), 2)
+    values = np.polyval(poly_coeffs, np.arange(interp_start, interp_stop).reshape(-1, 1))
+    return values[:, 0]
+
+
+def traces_matrix(data, keys, precision=None):
+    """
+    Stack the neuron columns of data into one (n_samples, n_neurons) array.
+    The array is Fortran-ordered, so every neuron is contiguous.
+    If precision is None the array has the common dtype of the columns;
+     otherwise every column is converted as it is copied (see as_precision),
+     so no full-size float64 copy is made.
+    """
+    columns = [np.asarray(data[key]) for key in keys]
+    if precision == 'int16':
+        counts = np.empty((len(columns[0]) if columns else 0, len(columns)), dtype=np.int16, order='F')
+        scale = np.ones(len(columns), dtype=np.float32)
+        offset = np.zeros(len(columns), dtype=np.float32)
+        for ii, column in enumerate(columns):
+            quantized = quantize(column)
+            counts[:, ii], scale[ii], offset[ii] = quantized.counts, quantized.scale[0], quantized.offset[0]
+        return QuantizedTraces(counts, scale, offset)
+    if precision is not None:
+        dtype = np.dtype(precision)
+    else:
+        dtype = np.result_type(*columns) if len(columns) > 0 else np.float64
+    traces = np.empty((len(columns[0]) if columns else 0, len(columns)), dtype=dtype, order='F')
+    for ii, column in enumerate(columns):
+        traces[:, ii] = column
+    return traces
+
+
+def as_precision(traces, precision):
+    """
+    Voltage traces in one of PRECISIONS:
+        - 'float64': exact, as count_spikes.
+        - 'float32': half the memory. Smoothing and peak finding run in
+           float32, so a peak within float32 rounding of a neighbour or of
+           the threshold can move or (dis)appear.
+        - 'int16': a quarter of the memory, as QuantizedTraces (see
+           quantize). Lossless for integer ADC data that fit in int16,
+           otherwise each neuron is quantized onto 65535 levels spanning its
+           range. Smoothing runs in float32.
+    QuantizedTraces are returned as they are for 'int16'.
+    """
+    if precision not in PRECISIONS:
+        raise ValueError('precision must be one of ' + str(PRECISIONS) + ', got: ' + repr(precision))
+    if isinstance(traces, QuantizedTraces):
+        if precision == 'int16':
+            return traces
+        traces = traces.counts * traces.scale + traces.offset
+    if precision == 'int16':
+        return quantize(traces)
+    return np.asarray(traces, dtype=precision)
+
+
+def quantize(traces):
+    """
+    int16 counts, scale and offset of every column of traces, with
+     traces ~ counts * scale + offset.
+    Integer-valued columns within the int16 range (e.g. raw ADC counts) are
+     kept exactly (scale 1, offset 0). Other columns are mapped linearly onto
+     -32767 ... 32767 with a rounding error of at most scale / 2.
+    """
+    x = np.asarray(traces)
+    x_2d = x.reshape(x.shape[0], -1)
+    counts = np.empty(x_2d.shape, dtype=np.int16, order='F')
+    scale = np.ones(x_2d.shape[1], dtype=np.float32)
+    offset = np.zeros(x_2d.shape[1], dtype=np.float32)
+    info = np.iinfo(np.int16)
+    for ii in range(x_2d.shape[1]):
+        column = x_2d[:, ii]
+        lo, hi = (column.min(), column.max()) if len(column) > 0 else (0, 0)
+        if not (np.isfinite(lo) and np.isfinite(hi)):
+            raise ValueError('Cannot quantize a trace with non-finite values')
+        if lo >= info.min and hi <= info.max and (column.dtype.kind in 'iub' or np.array_equal(column, np.round(column))):
+            counts[:, ii] = column
+            continue
+        offset[ii] = (np.float64(lo) + np.float64(hi)) / 2
+        scale[ii] = max((np.float64(hi) - np.float64(lo)) / (2 * info.max), np.finfo(np.float32).tiny)
+        counts[:, ii] = np.clip(np.rint((column - offset[ii]) / scale[ii]), -info.max, info.max)
+    return QuantizedTraces(counts.reshape(x.shape), scale, offset)
+
+
+def memory_footprint(n_samples, n_neurons, precision='float64'):
+    """
+    Bytes held by spike detection for a recording: the traces matrix and the
+     smoothed traces (the two arrays that grow with the data), in a precision
+     and compared to float64.
+
+    Returns:
+        footprint (dict):
+            'traces', 'smoothed' and 'total' in bytes, and 'saved', the bytes
+             saved compared to float64.
+    """
+    if precision not in PRECISIONS:
+        raise ValueError('precision must be one of ' + str(PRECISIONS) + ', got: ' + repr(precision))
+    n = int(n_samples) * int(n_neurons)
+    traces = n * np.dtype(precision).itemsize
+    smoothed = n * (8 if precision == 'float64' else 4)
+    return {'traces': traces, 'smoothed': smoothed, 'total': traces + smoothed, 'saved': 16 * n - traces - smoothed}
+
+
+def find_peaks_batched(traces_smooth, threshold, distance, block_size=2**24):
+    """
+    Vectorized equivalent of running scipy.signal.find_peaks(x, height=threshold,
+     distance=distance) on every column of traces_smooth.
+        - Local maxima above threshold (including the middle of flat tops)
+           are found in all columns at once.
+        - The `distance` rule of find_peaks (keep the highest peak, drop its
+           neighbours closer than `distance`, repeat) is applied in rounds:
+           every peak that is higher than all its remaining neighbours is
+           kept and its neighbours are dropped. Peaks with no neighbour
+           closer than `distance` are kept in the first round. Ties are
+           broken by the same np.argsort that find_peaks uses, so the output
+           is identical.
+
+    Args:
+        traces_smooth (np.ndarray, shape (n_samples, n_neurons)):
+            Smoothed traces, one neuron per column.
+        threshold (float):
+            Minimal height of a peak.
+        distance (float):
+            Minimal distance in samples between peaks of the same neuron.
+        block_size (int):
+            Approximate number of samples processed at a time; neurons are
+             taken in blocks of block_size // n_samples columns to bound the
+             size of the temporary arrays.
+
+    Returns:
+        spike_times (np.ndarray of int64):
+            Peak indices of all neurons, neuron after neuron.
+        offsets (np.ndarray of int64, shape (n_neurons + 1,)):
+            Peaks of neuron ii are spike_times[offsets[ii]:offsets[ii + 1]].
+    """
+    if distance is not None and distance < 1:
+        raise ValueError('`distance` must be greater or equal to 1')
+    x = np.asarray(traces_smooth)
+    if x.ndim == 1:
+        x = x[:, None]
+    n_samples, n_neurons = x.shape
+    distance = int(np.ceil(distance))
+
+    n_columns = max(1, block_size // max(n_samples, 1))
+    spike_times, neurons = [], []
+    for start in range(0, n_neurons, n_columns):
+        block = x[:, start:start + n_columns]
+        peaks, columns, heights = local_maxima_batched(block, threshold)
+        keep = select_by_distance_batched(peaks, columns, heights, distance)
+        spike_times.append(peaks[keep])
+        neurons.append(columns[keep] + start)
+
+    spike_times = np.concatenate(spike_times) if spike_times else np.empty(0, dtype=np.int64)
+    neurons = np.concatenate(neurons) if neurons else np.empty(0, dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(neurons, minlength=n_neurons))]).astype(np.int64)
+    return spike_times.astype(np.int64), offsets
+
+
+def local_maxima_batched(x, threshold):
+    """
+    Local maxima of height >= threshold in every column of x, with the same
+     rules as find_peaks: a peak is a rising edge followed (after an optional
+     run of equal values) by a falling edge, located at the middle of the run.
+    Only two vectorized passes touch every sample; the remaining checks run
+     on the samples that are above threshold and higher than their left
+     neighbour.
+
+    Returns:
+        peaks, columns (np.ndarray of int64):
+            Sample index and column of every local maximum, sorted by
+             column, then sample.
+        heights (np.ndarray of float64):
+            Value of x at every local maximum.
+    """
+    n_samples = x.shape[0]
+    if n_samples < 3:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, np.empty(0, dtype=np.float64)
+
+    ## Rising edges into a sample above threshold, for samples 1 .. n - 2
+    center = x[1:-1]
+    with np.errstate(invalid='ignore'):
+        rising = center >= _threshold_as(threshold, x.dtype)
+        rising &= center > x[:-2]
+    idx = np.flatnonzero(rising.ravel(order='F'))
+    columns = idx // (n_samples - 2)
+    left = idx % (n_samples - 2) + 1
+    heights = x[left, columns]
+
+    ## Walk over runs of equal values (flat tops): a few steps cover the
+    ##  short ones, then the runs still going (e.g. a clipped channel) are
+    ##  ended in one pass over the changes of value of their columns
+    right = left + 1
+    flat = np.flatnonzero((x[right, columns] == heights) & (right < n_samples - 1))
+    for _ in range(FLAT_STEPS):
+        if len(flat) == 0:
+            break
+        right[flat] += 1
+        flat = flat[(x[right[flat], columns[flat]] == heights[flat]) & (right[flat] < n_samples - 1)]
+    for column in np.unique(columns[flat]):
+        runs = flat[columns[flat] == column]
+        trace = x[:, column]
+        ## First sample of every new value, then the last sample
+        changes = np.append(np.flatnonzero(trace[1:] != trace[:-1]) + 1, n_samples - 1)
+        right[runs] = np.minimum(changes[np.searchsorted(changes, right[runs], side='right')], n_samples - 1)
+    ## A flat top reaching the last sample is not a peak
+    is_peak = x[right, columns] < heights
+
+    peaks = (left + right - 1) // 2
+    return peaks[is_peak].astype(np.int64), columns[is_peak].astype(np.int64), heights[is_peak].astype(np.float64)
+
+
+def _threshold_as(threshold, dtype):
+    """
+    Threshold in the dtype of the traces, such that x >= result in that dtype
+     is the same as float64(x) >= threshold (find_peaks compares in float64).
+    """
+    if dtype == np.float64 or dtype.kind != 'f':
+        return np.float64(threshold)
+    threshold_cast = dtype.type(threshold)
+    if np.float64(threshold_cast) < threshold:
+        threshold_cast = np.nextafter(threshold_cast, dtype.type(np.inf))
+    return threshold_cast
+
+
+def select_by_distance_batched(peaks, columns, heights, distance, kind=None):
+    """
+    find_peaks' `distance` rule for sorted peaks of many columns at once.
+
+    Args:
+        kind (str):
+            Sort used to rank the peaks of a column by height. The default
+             is the (unstable) sort of find_peaks; 'stable' keeps the later
+             of two equal peaks.
+
+    Returns:
+        keep (np.ndarray of bool):
+            Mask of the kept peaks.
+    """
+    n_peaks = len(peaks)
+    keep = np.ones(n_peaks, dtype=np.bool_)
+    ## Pairs of peaks of the same column closer than distance. Peaks of a
+    ##  column are at least 2 samples apart, so pairs are at most
+    ##  distance // 2 positions apart in the sorted array.
+    pairs_left, pairs_right = [], []
+    for shift in range(1, max(distance // 2, 1) + 1):
+        if shift >= n_peaks:
+            break
+        close = (columns[shift:] == columns[:-shift]) & (peaks[shift:] - peaks[:-shift] < distance)
+        idx = np.flatnonzero(close)
+        if len(idx) == 0:
+            break
+        pairs_left.append(idx)
+        pairs_right.append(idx + shift)
+    if len(pairs_left) == 0:
+        return keep
+    left, right = np.concatenate(pairs_left), np.concatenate(pairs_right)
+
+    ## Priority of each peak within its column: its position in the same
+    ##  np.argsort of the column's peak heights that find_peaks uses.
+    rank = np.zeros(n_peaks, dtype=np.int64)
+    bounds = np.searchsorted(columns, np.unique(columns[left]))
+    for start in bounds:
+        stop = np.searchsorted(columns, columns[start], side='right')
+        rank[start + np.argsort(heights[start:stop], kind=kind)] = np.arange(stop - start)
+
+    undecided = np.zeros(n_peaks, dtype=np.bool_)
+    undecided[left] = True
+    undecided[right] = True
+    keep[undecided] = False
+    while undecided.any():
+        both = undecided[left] & undecided[right]
+        dominated = np.zeros(n_peaks, dtype=np.bool_)
+        dominated[left[both & (rank[right] > rank[left])]] = True
+        dominated[right[both & (rank[left] > rank[right])]] = True
+        ## Highest of their remaining neighbours: kept, neighbours dropped
+        winners = undecided & ~dominated
+        keep[winners] = True
+        undecided[winners] = False
+        undecided[right[winners[left]]] = False
+        undecided[left[winners[right]]] = False
+    return keep
@@ -0,0 +1,324 @@
+## Fused smoothing and peak detection
+##
+## count_spikes (and SpikeDetector) write the full smoothed trace, then
+##  find_peaks sweeps it again for local maxima, heights and distances. The
+##  kernels here smooth and search in the same pass and keep only the
+##  candidate peaks (local maxima above threshold), which are few; the
+##  `distance` rule of find_peaks then runs on the candidates alone. The
+##  spike times are identical to count_spikes.
+##
+## Two engines:
+##     - 'numba': one compiled loop per neuron that applies the
+##        Savitzky-Golay coefficients in a rolling window, in the same
+##        order as scipy.ndimage, and tracks rising edges and flat tops as
+##        it goes. Nothing of the length of the trace is allocated. Needs
+##        the optional numba package; compiled on first use.
+##     - 'numpy': the trace is smoothed block by block (scipy.ndimage on the
+##        block and its filter context) and each block is searched while it
+##        is in cache, so memory is bounded by the block size.
+
+import importlib.util
+
+import numpy as np
+
+from . import detection
+
+ENGINES = ['numba', 'numpy']
+## Samples smoothed at a time by the 'numpy' engine
+BLOCK_SIZE = 2 ** 16
+HAVE_NUMBA = importlib.util.find_spec('numba') is not None
+
+_kernel = None
+
+
+def default_engine():
+    """
+    'numba' if numba is installed, else 'numpy'.
+    """
+    return 'numba' if HAVE_NUMBA else 'numpy'
+
+
+def find_peaks_fused(traces, plan, engine=None, block_size=BLOCK_SIZE):
+    """
+    Same output as
+        detection.find_peaks_batched(detection.savgol_smooth(traces, plan), plan.threshold, plan.distance)
+     without materializing the smoothed traces.
+
+    Args:
+        traces (array-like, shape (n_samples,) or (n_samples, n_neurons), or QuantizedTraces):
+            Voltage traces, one neuron per column (see savgol_smooth).
+        plan (DetectionPlan):
+            Output of detection.get_plan.
+        engine (str):
+            'numba' or 'numpy'. None picks default_engine().
+        block_size (int):
+            Samples smoothed at a time by the 'numpy' engine.
+
+    Returns:
+        spike_times (np.ndarray of int64):
+            Peak indices of all neurons, neuron after neuron.
+        offsets (np.ndarray of int64, shape (n_neurons + 1,)):
+            Peaks of neuron ii are spike_times[offsets[ii]:offsets[ii + 1]].
+    """
+    if engine is None:
+        engine = default_engine()
+    if engine not in ENGINES:
+        raise ValueError('engine must be one of ' + str(ENGINES) + ', got: ' + repr(engine))
+    if plan.distance is not None and plan.distance < 1:
+        raise ValueError('`distance` must be greater or equal to 1')
+
+    quantized = isinstance(traces, detection.QuantizedTraces)
+    if quantized:
+        x = traces.counts
+        dtype_out = np.float32
+    else:
+        x = np.asarray(traces)
+        if x.dtype != np.float64 and x.dtype != np.float32:
+            x = x.astype(np.float64)
+        dtype_out = x.dtype
+    if plan.window_length > x.shape[0]:
+        raise ValueError("If mode is 'interp', window_length must be less than or equal to the size of x.")
+    x_2d = x.reshape(x.shape[0], -1)
+    scale = traces.scale.reshape(-1) if quantized else None
+    offset = traces.offset.reshape(-1) if quantized else None
+    distance = int(np.ceil(plan.distance))
+
+    spike_times, counts = [], []
+    for ii in range(x_2d.shape[1]):
+        calibration = (scale[ii], offset[ii]) if quantized else None
+        if engine == 'numba':
+            peaks, heights = _candidates_numba(x_2d[:, ii], plan, dtype_out, calibration)
+        else:
+            peaks, heights = _candidates_numpy(x_2d[:, ii], plan, dtype_out, calibration, block_size)
+        keep = detection.select_by_distance_batched(peaks, np.zeros(len(peaks), dtype=np.int64), heights, distance)
+        spike_times.append(peaks[keep])
+        counts.append(np.count_nonzero(keep))
+
+    spike_times = np.concatenate(spike_times) if spike_times else np.empty(0, dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    return spike_times.astype(np.int64), offsets
+
+
+def _edges(x, plan, dtype_out, calibration):
+    """
+    Smoothed values of the first and last window_length // 2 samples: the
+     polynomial fits of savgol_filter, calibrated like the other samples.
+    """
+    window_length = plan.window_length
+    halflen = window_length // 2
+    if halflen == 0:
+        empty = np.empty(0, dtype=dtype_out)
+        return empty, empty
+    edge_start = detection._fit_edge(x[:window_length], 0, halflen).astype(dtype_out)
+    edge_end = detection._fit_edge(x[-window_length:], window_length - halflen, window_length).astype(dtype_out)
+    if calibration is not None:
+        for edge in (edge_start, edge_end):
+            edge *= calibration[0]
+            edge += calibration[1]
+    return edge_start, edge_end
+
+
+def _candidates_numpy(x, plan, dtype_out, calibration, block_size):
+    """
+    Local maxima of height >= threshold of the smoothed trace, as
+     (peaks, heights), smoothing block_size samples at a time.
+    """
+    import scipy.ndimage
+
+    n_samples = len(x)
+    window_length = plan.window_length
+    halflen = window_length // 2
+    edge_start, edge_end = _edges(x, plan, dtype_out, calibration)
+    block_size = max(int(block_size), window_length)
+
+    peaks, heights = [], []
+    ## Last smoothed sample of the previous block, and the first sample and
+    ##  value of the flat top above threshold it is on, if that flat top was
+    ##  reached by a rising edge (plateau_left < 0: none)
+    carry = np.empty(0, dtype=dtype_out)
+    plateau_left, plateau_value = -1, 0.0
+    for start in range(0, n_samples, block_size):
+        stop = min(start + block_size, n_samples)
+        ## Every output depends on at most window_length // 2 + 1 samples on
+        ##  either side; zeros past the ends are the 'constant' mode padding
+        lo, hi = max(0, start - window_length), min(n_samples, stop + window_length)
+        y = np.empty(hi - lo, dtype=dtype_out)
+        scipy.ndimage.convolve1d(x[lo:hi], plan.coeffs, output=y, mode='constant')
+        y = y[start - lo:stop - lo]
+        if calibration is not None:
+            y *= calibration[0]
+            y += calibration[1]
+        if start < halflen:
+            y[:halflen - start] = edge_start[start:min(halflen, stop)]
+        if stop > n_samples - halflen:
+            y[max(0, n_samples - halflen - start):] = edge_end[max(0, start - (n_samples - halflen)):stop - (n_samples - halflen)]
+
+        seg = np.concatenate([carry, y])
+        seg_start = start - len(carry)
+        ## A carried flat top ends at the first sample of another value, and
+        ##  is a peak if that sample is lower
+        if plateau_left >= 0:
+            differs = np.flatnonzero(seg[1:] != plateau_value)
+            if len(differs) > 0:
+                right = differs[0] + 1
+                if seg[right] < plateau_value:
+                    peaks.append(np.array([(plateau_left + seg_start + right - 1) // 2], dtype=np.int64))
+                    heights.append(np.array([plateau_value], dtype=np.float64))
+                plateau_left = -1
+        found, _, found_heights = detection.local_maxima_batched(seg[:, None], plan.threshold)
+        peaks.append(found + seg_start)
+        heights.append(found_heights)
+        if plateau_left < 0:
+            left = _trailing_plateau(seg, plan.threshold)
+            if left is not None:
+                plateau_left, plateau_value = seg_start + left, seg[-1]
+        carry = seg[-1:]
+
+    peaks = np.concatenate(peaks) if peaks else np.empty(0, dtype=np.int64)
+    heights = np.concatenate(heights) if heights else np.empty(0, dtype=np.float64)
+    return peaks, heights
+
+
+def _trailing_plateau(seg, threshold):
+    ## 1-D version of streaming._trailing_plateaus: first sample of the
+    ##  trailing run of equal values if it can still be a peak (above
+    ##  threshold, reached by a rising edge inside seg), else None
+    changes = np.flatnonzero(seg[1:] != seg[:-1])
+    if len(changes) == 0:
+        return None
+    left = changes[-1] + 1
+    if np.float64(seg[-1]) < threshold or seg[left - 1] >= seg[-1]:
+        return None
+    return left
+
+
+def _candidates_numba(x, plan, dtype_out, calibration):
+    """
+    Local maxima of height >= threshold of the smoothed trace, as
+     (peaks, heights), from the compiled single-pass kernel.
+    """
+    kernel = _numba_kernel()
+    weights = np.ascontiguousarray(plan.coeffs[::-1], dtype=np.float64)
+    length = len(weights)
+    size1 = length // 2
+    size2 = length - size1 - 1
+    ## scipy.ndimage.convolve1d: weights reversed, origin -1 for even
+    ##  lengths, and symmetric odd filters summed in pairs
+    shift = 0 if length % 2 else 1
+    symmetric = length % 2 == 1 and all(
+        abs(weights[size1 + jj] - weights[size1 - jj]) <= np.finfo(np.float64).eps for jj in range(1, size1 + 1)
+    )
+    edge_start, edge_end = _edges(x, plan, dtype_out, calibration)
+    scale, offset = calibration if calibration is not None else (np.float32(1), np.float32(0))
+    return kernel(
+        x, weights, size1, size2, shift, symmetric,
+        edge_start.astype(np.float64), edge_end.astype(np.float64),
+        dtype_out == np.float32, calibration is not None, np.float32(scale), np.float32(offset),
+        float(plan.threshold),
+    )
+
+
+def _numba_kernel():
+    global _kernel
+    if _kernel is None:
+        if not HAVE_NUMBA:
+            raise ImportError("The 'numba' engine needs numba (pip install numba); use engine='numpy' without it.")
+        import numba
+        _kernel = numba.njit(nogil=True, cache=True)(_candidates_kernel)
+    return _kernel
+
+
+def _candidates_kernel(x, weights, size1, size2, shift, symmetric, edge_start, edge_end,
+                       to_float32, calibrated, scale, offset, threshold):
+    ## Compiled by numba (see _numba_kernel). Sample ii of the smoothed
+    ##  trace is computed from x[ii + shift - size1 : ii + shift + size2 + 1]
+    ##  in float64, in the order scipy.ndimage sums it, and rounded to the
+    ##  output precision; then the rules of find_peaks' local maxima search
+    ##  are applied to it and the previous sample. Samples are smoothed
+    ##  CHUNK at a time into a small buffer, taps in the outer loop, so that
+    ##  the sums of neighbouring samples run side by side (each sample's sum
+    ##  keeps its order, so the result is unchanged).
+    CHUNK = 512
+    n_samples = x.shape[0]
+    halflen = edge_start.shape[0]
+    buffer = np.empty(CHUNK, dtype=np.float64)
+    capacity = 1024
+    peaks = np.empty(capacity, dtype=np.int64)
+    heights = np.empty(capacity, dtype=np.float64)
+    n_peaks = 0
+    ## Start and value of the current run of equal values reached by a
+    ##  rising edge above threshold (left < 0: none)
+    left = -1
+    height = 0.0
+    previous = 0.0
+    for chunk_start in range(0, n_samples, CHUNK):
+        chunk_stop = min(chunk_start + CHUNK, n_samples)
+        ## Peaks are at least 2 samples apart, so a chunk ends at most
+        ##  CHUNK // 2 + 1 runs. Growing the outputs here rather than in the
+        ##  sample loop keeps that loop free of array reassignments.
+        if n_peaks + CHUNK // 2 + 1 > capacity:
+            capacity = 2 * capacity + CHUNK
+            peaks_grown = np.empty(capacity, dtype=np.int64)
+            heights_grown = np.empty(capacity, dtype=np.float64)
+            peaks_grown[:n_peaks] = peaks[:n_peaks]
+            heights_grown[:n_peaks] = heights[:n_peaks]
+            peaks, heights = peaks_grown, heights_grown
+        ## Filtered samples of the chunk (the edges are filled in below)
+        interior_start = max(chunk_start, halflen)
+        interior_stop = min(chunk_stop, n_samples - halflen)
+        if interior_stop > interior_start:
+            ## Slices indexed from 0, so that the inner loops need no
+            ##  negative index handling and vectorize
+            out = buffer[interior_start - chunk_start:interior_stop - chunk_start]
+            center = interior_start + shift
+            n_interior = interior_stop - interior_start
+            if symmetric:
+                xc = x[center:center + n_interior]
+                for kk in range(n_interior):
+                    out[kk] = np.float64(xc[kk]) * weights[size1]
+                for jj in range(1, size1 + 1):
+                    weight = weights[size1 - jj]
+                    xl = x[center - jj:center - jj + n_interior]
+                    xr = x[center + jj:center + jj + n_interior]
+                    for kk in range(n_interior):
+                        out[kk] += (np.float64(xl[kk]) + np.float64(xr[kk])) * weight
+            else:
+                weight = weights[size1 + size2]
+                xc = x[center + size2:center + size2 + n_interior]
+                for kk in range(n_interior):
+                    out[kk] = np.float64(xc[kk]) * weight
+                for jj in range(-size1, size2):
+                    weight = weights[size1 + jj]
+                    xc = x[center + jj:center + jj + n_interior]
+                    for kk in range(n_interior):
+                        out[kk] += np.float64(xc[kk]) * weight
+
+        for ii in range(chunk_start, chunk_stop):
+            if ii < halflen:
+                value = edge_start[ii]
+            elif ii >= n_samples - halflen:
+                value = edge_end[ii - (n_samples - halflen)]
+            elif to_float32:
+                value32 = np.float32(buffer[ii - chunk_start])
+                if calibrated:
+                    value32 = value32 * scale
+                    value32 = value32 + offset
+                value = np.float64(value32)
+            else:
+                value = buffer[ii - chunk_start]
+
+            if left >= 0:
+                if value == height and ii < n_samples - 1:
+                    previous = value
+                    continue
+                ## End of the run: a peak if the signal falls
+                if value < height:
+                    peaks[n_peaks] = (left + ii - 1) // 2
+                    heights[n_peaks] = height
+                    n_peaks += 1
+                left = -1
+            if 1 <= ii < n_samples - 1 and previous < value and value >= threshold:
+                left = ii
+                height = value
+            previous = value
+    return peaks[:n_peaks].copy(), heights[:n_peaks].copy()
@@ -0,0 +1,224 @@
+## Run-length-encoded epochs and interval-based condition counting
+##
+## Epochs are long contiguous runs, so each one is stored as the start and
+##  stop samples of its runs: memory scales with the number of epoch
+##  transitions instead of the number of samples. Conditions (see
+##  conditions.evaluate_condition) are evaluated on the intervals, and spikes
+##  are counted with np.searchsorted against the interval bounds.
+
+import numpy as np
+
+from . import conditions
+
+## Samples scanned at a time when encoding a mask, which bounds the
+##  temporaries of from_mask for long (e.g. memory-mapped) columns
+BLOCK_SIZE = 2 ** 20
+
+
+class Intervals:
+    """
+    Sorted, disjoint, non-adjacent half-open intervals of samples:
+     run ii covers starts[ii] <= index < stops[ii].
+    Supports & (intersection), | (union), ^ (symmetric difference) and
+     ~ (complement within [0, n_samples)), so conditions can be evaluated on
+     intervals like on boolean masks.
+
+    Args:
+        starts, stops (1-D array of int):
+            Bounds of the runs.
+        n_samples (int):
+            Length of the recording.
+    """
+    __slots__ = ('starts', 'stops', 'n_samples')
+
+    def __init__(self, starts, stops, n_samples):
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.stops = np.asarray(stops, dtype=np.int64)
+        self.n_samples = int(n_samples)
+
+    @classmethod
+    def from_mask(cls, mask):
+        """
+        Run-length encode a boolean column.
+        """
+        mask = np.asarray(mask)
+        n_samples = len(mask)
+        starts, stops = [], []
+        previous = False
+        for start in range(0, n_samples, BLOCK_SIZE):
+            block = mask[start:start + BLOCK_SIZE].astype(bool, copy=False)
+            ## Samples that differ from the one before (the first one from
+            ##  the last sample of the previous block)
+            changes = np.flatnonzero(block[1:] != block[:-1]) + 1
+            if block[0] != previous:
+                changes = np.concatenate([[0], changes])
+            rising = block[changes]
+            starts.append(changes[rising] + start)
+            stops.append(changes[~rising] + start)
+            previous = block[-1]
+        if previous:
+            stops.append(np.array([n_samples]))
+        return cls(
+            np.concatenate(starts) if starts else [],
+            np.concatenate(stops) if stops else [],
+            n_samples,
+        )
+
+    @classmethod
+    def full(cls, n_samples):
+        """
+        One run covering the whole recording.
+        """
+        return cls([0], [n_samples], n_samples) if n_samples > 0 else cls([], [], 0)
+
+    def to_mask(self):
+        """
+        Decode to a boolean column of n_samples.
+        """
+        edges = np.zeros(self.n_samples + 1, dtype=np.int8)
+        np.add.at(edges, self.starts, 1)
+        np.add.at(edges, self.stops, -1)
+        return np.cumsum(edges[:-1], dtype=np.int8).astype(bool)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def duration(self):
+        """
+        Number of samples covered.
+        """
+        return int((self.stops - self.starts).sum())
+
+    @property
+    def nbytes(self):
+        return self.starts.nbytes + self.stops.nbytes
+
+    def contains(self, positions):
+        """
+        Whether each sample index in positions falls in a run.
+        """
+        positions = np.asarray(positions)
+        run = np.searchsorted(self.starts, positions, side='right') - 1
+        inside = run >= 0
+        inside[inside] = positions[inside] < self.stops[run[inside]]
+        return inside
+
+    def count(self, spike_times, assume_sorted=False):
+        """
+        Number of spikes in the runs.
+
+        Args:
+            spike_times (1-D array of int):
+                Sample index of each spike. Spikes of different neurons may
+                 share an index and are counted separately.
+            assume_sorted (bool):
+                If spike_times is sorted, the spikes are counted per run from
+                 two searchsorted of the bounds into spike_times, instead of
+                 one search per spike.
+        """
+        if assume_sorted:
+            return int((np.searchsorted(spike_times, self.stops) - np.searchsorted(spike_times, self.starts)).sum())
+        return int(np.count_nonzero(self.contains(spike_times)))
+
+    def __and__(self, other):
+        return self._combine(other, np.logical_and)
+
+    def __or__(self, other):
+        return self._combine(other, np.logical_or)
+
+    def __xor__(self, other):
+        return self._combine(other, np.logical_xor)
+
+    def __invert__(self):
+        bounds = np.concatenate([[0], np.stack([self.starts, self.stops], axis=1).ravel(), [self.n_samples]])
+        starts, stops = bounds[0::2], bounds[1::2]
+        keep = starts < stops
+        return Intervals(starts[keep], stops[keep], self.n_samples)
+
+    def _combine(self, other, op):
+        if self.n_samples != other.n_samples:
+            raise ValueError(f'Intervals of different lengths: {self.n_samples} and {other.n_samples}')
+        ## Both sides are constant between consecutive bounds, so the result
+        ##  is op of their membership at the start of every segment
+        bounds = np.union1d(
+            np.concatenate([self.starts, self.stops, other.starts, other.stops]),
+            [0, self.n_samples],
+        )
+        segment_starts = bounds[:-1]
+        on = op(self.contains(segment_starts), other.contains(segment_starts)).astype(np.int8)
+        edges = np.diff(on, prepend=np.int8(0), append=np.int8(0))
+        return Intervals(bounds[np.flatnonzero(edges == 1)], bounds[np.flatnonzero(edges == -1)], self.n_samples)
+
+    def __eq__(self, other):
+        if not isinstance(other, Intervals):
+            return NotImplemented
+        return (
+            self.n_samples == other.n_samples
+            and np.array_equal(self.starts, other.starts)
+            and np.array_equal(self.stops, other.stops)
+        )
+
+    def __repr__(self):
+        return f'Intervals(n_runs={len(self)}, duration={self.duration()}, n_samples={self.n_samples})'
+
+
+def epoch_intervals(t, r, l):
+    """
+    Intervals of the three boolean epoch columns.
+
+    Args:
+        t, r, l (1-D array-like of bool):
+            'trial_on', 'reward_on' and 'light_on' columns.
+
+    Returns:
+        epochs (dict):
+            Intervals of each epoch letter (see conditions.EPOCH_BITS).
+    """
+    return {key: Intervals.from_mask(column) for key, column in zip(conditions.EPOCH_BITS, (t, r, l))}
+
+
+def condition_intervals(condition, epochs):
+    """
+    Intervals during which a condition (see conditions.evaluate_condition)
+     holds, given the output of epoch_intervals.
+    """
+    n_samples = next(iter(epochs.values())).n_samples
+    return conditions.evaluate_condition(condition, epochs, Intervals.full(n_samples))
+
+
+def count_conditions(spike_times, epochs, conditions_list=conditions.CONDITIONS):
+    """
+    Number of spikes during each condition, counted against the interval
+     bounds. Same output as conditions.count_conditions on the code histogram
+     of the same spikes.
+    The bounds of all epochs cut the recording into segments during which no
+     epoch changes. Each spike is looked up once with np.searchsorted and
+     histogrammed by segment; each condition is evaluated on the state of the
+     epochs in every segment and sums the segments it covers.
+
+    Args:
+        spike_times (1-D array of int):
+            Sample index of each spike, in any order.
+        epochs (dict):
+            Output of epoch_intervals.
+        conditions_list (list of str):
+            Conditions to count (see conditions.evaluate_condition).
+
+    Returns:
+        ns_conditions (dict):
+            Number of spikes for each condition.
+    """
+    n_samples = next(iter(epochs.values())).n_samples
+    bounds = np.union1d(
+        np.concatenate([np.concatenate([epoch.starts, epoch.stops]) for epoch in epochs.values()]),
+        [0, n_samples],
+    )
+    segment_starts = bounds[:-1]
+    segment = np.searchsorted(bounds, spike_times, side='right') - 1
+    histogram = np.bincount(segment, minlength=len(segment_starts))
+    on = {key: epoch.contains(segment_starts) for key, epoch in epochs.items()}
+    everything = np.ones(len(segment_starts), dtype=np.bool_)
+    return {
+        condition: int(histogram[conditions.evaluate_condition(condition, on, everything)].sum())
+        for condition in conditions_list
+    }
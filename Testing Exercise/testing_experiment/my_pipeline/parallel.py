@@ -0,0 +1,128 @@
+## Parallel per-neuron spike detection
+
+import os
+
+import numpy as np
+
+EXECUTORS = ['serial', 'threads', 'processes']
+
+
+def detect_spikes(traces, sample_rate, threshold, executor='serial', n_workers=None, precision='float64'):
+    """
+    Run count_spikes on every neuron trace, optionally in parallel.
+    Each trace is processed independently, so the results are identical
+     for every executor.
+
+    Args:
+        traces (list of 1-D array-like):
+            Voltage trace of each neuron.
+        sample_rate (float):
+            Frequency at which data samples were collected.
+        threshold (float):
+            Voltage above which the voltage must reach to be considered a valid spike.
+        executor (str):
+            One of:
+                - 'serial': one trace after the other in this process.
+                - 'threads': a thread pool.
+                - 'processes': a process pool. The traces are copied once
+                   into shared memory and the workers read them from there
+                   instead of receiving pickled copies.
+        n_workers (int):
+            Number of workers for the 'threads' and 'processes' executors.
+            If None, os.cpu_count() is used.
+        precision (str):
+            Passed to count_spikes. With 'float32', the shared memory of the
+             'processes' executor holds float32 traces.
+
+    Returns:
+        spike_times (list of np.ndarray):
+            Peak indices for each trace, in the same order as traces.
+    """
+    from .pipeline import count_spikes
+
+    if executor not in EXECUTORS:
+        raise ValueError('executor must be one of ' + str(EXECUTORS) + ', got: ' + repr(executor))
+    n_workers = n_workers if n_workers is not None else (os.cpu_count() or 1)
+
+    if executor == 'serial' or n_workers <= 1 or len(traces) <= 1:
+        return [count_spikes(trace, sample_rate, threshold, precision) for trace in traces]
+
+    if executor == 'threads':
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=n_workers) as pool:
+            return list(pool.map(lambda trace: count_spikes(trace, sample_rate, threshold, precision), traces))
+
+    return _detect_spikes_processes(traces, sample_rate, threshold, n_workers, precision)
+
+
+def _smoothing_dtype(trace, precision='float64'):
+    """
+    savgol_filter keeps float32 input as float32 and converts everything
+     else to float64. The shared buffers follow the same rule so that the
+     workers smooth exactly the values the serial path would.
+    """
+    if precision == 'float32' or np.asarray(trace).dtype == np.float32:
+        return np.dtype(np.float32)
+    return np.dtype(np.float64)
+
+
+def _detect_spikes_processes(traces, sample_rate, threshold, n_workers, precision='float64'):
+    from concurrent.futures import ProcessPoolExecutor
+    from multiprocessing.shared_memory import SharedMemory
+
+    n_samples = len(traces[0])
+    ## One (n_neurons, n_samples) shared block per smoothing dtype, so that
+    ##  each neuron is a contiguous row.
+    groups = {}
+    for ii, trace in enumerate(traces):
+        groups.setdefault(_smoothing_dtype(trace, precision), []).append(ii)
+
+    blocks = []
+    try:
+        tasks = []
+        for dtype, idx in groups.items():
+            shape = (len(idx), n_samples)
+            shm = SharedMemory(create=True, size=max(int(np.prod(shape)) * dtype.itemsize, 1))
+            blocks.append(shm)
+            _fill_shared(shm, shape, dtype, [traces[ii] for ii in idx])
+            tasks += [(ii, (shm.name, shape, dtype.str, row, sample_rate, threshold, precision)) for row, ii in enumerate(idx)]
+
+        spike_times = [None] * len(traces)
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            chunksize = max(1, len(tasks) // (4 * n_workers))
+            results = pool.map(_count_spikes_shared, [task for _, task in tasks], chunksize=chunksize)
+            for (ii, _), peaks in zip(tasks, results):
+                spike_times[ii] = peaks
+        return spike_times
+    finally:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+
+
+def _fill_shared(shm, shape, dtype, traces):
+    block = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    for row, trace in enumerate(traces):
+        block[row] = np.asarray(trace)
+
+
+def _count_spikes_shared(task):
+    """
+    Worker function: attach to the shared block and run count_spikes on one row.
+    """
+    name, shape, dtype, row, sample_rate, threshold, precision = task
+    from multiprocessing.shared_memory import SharedMemory
+    from .pipeline import count_spikes
+
+    shm = SharedMemory(name=name)
+    try:
+        block = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+        return count_spikes(block[row], sample_rate, threshold, precision)
+    finally:
+        block = None
+        try:
+            shm.close()
+        except BufferError:
+            ## A traceback still references a view of the buffer; the mapping
+            ##  is released together with it.
+            pass
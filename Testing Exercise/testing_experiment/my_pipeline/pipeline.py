@@ -2,7 +2,13 @@
 
 import numpy as np
 
-def pipeline(filepath_data, filepath_parameters):
+from . import cache as result_cache
+from . import conditions, detection, intervals, parallel, profiling, readers, spikes, streaming, validation
+
+# Rows of the data file read and validated before the full read, see pipeline()
+PROBE_ROWS = 100
+
+def pipeline(filepath_data, filepath_parameters, executor='serial', n_workers=None, chunk_size=None, return_spikes=False, cache=None, instrument=None, precision='float64', conditions_list=None, fused=False, neurons=None, csv_engine='c'):
     """
     Fake neuroscience analysis pipeline.
     This code counts the number of spikes fired by neurons.
@@ -21,6 +27,9 @@ def pipeline(filepath_data, filepath_parameters):
     Args:
         filepath_data (str):
             Filepath to CSV file.
+            Binary columnar copies of the same layout are also accepted and
+             picked by extension (see readers.py): a directory of .npy arrays,
+             or a '.parquet' / '.feather' file. readers.convert_csv writes them.
             CSV file should have one row of headers.
             Each column should correspond to a timeseries trace and the first row should be the name of that trace.
             The data should contain the 3 critical columns that correspond to temporal epochs within the experiment:
@@ -33,110 +42,372 @@ def pipeline(filepath_data, filepath_parameters):
             The parameters are expected to contain the following elements with defined 'key' names:
                 - 'sample_rate' (float): frequency at which data samples were collected.
                 - 'threshold' (float): voltage above which the voltage must reach to be considered a valid spike.
+        executor (str):
+            How the per-neuron spike detection is run. One of:
+                - 'serial': one neuron after the other (default).
+                - 'threads': a thread pool.
+                - 'processes': a process pool reading the traces from shared memory.
+            All executors give identical results. Any other value raises
+             ValueError before the data file is read.
+        n_workers (int):
+            Number of workers for the 'threads' and 'processes' executors.
+            If None, os.cpu_count() is used.
+        chunk_size (int):
+            If given, the data file is streamed in blocks of chunk_size rows
+             instead of being loaded at once (see streaming.py), so memory is
+             bounded by the chunk size. Spike detection then runs serially and
+             executor is ignored. Off by default, since the output can differ
+             from in-memory processing in one case: when two peaks of a neuron
+             of exactly equal height are closer than the minimal peak
+             distance, streaming keeps the later one, whereas find_peaks
+             orders such ties with an unstable sort of all the neuron's peaks,
+             which cannot be reproduced block by block. Equal heights are rare
+             on float traces, but common on integer ones (e.g. ADC counts),
+             where a few spikes per 10^4 can then differ.
+        return_spikes (bool):
+            If True, return (ns_conditions, spike_trains), where spike_trains
+             is a spikes.SpikeTrains with the spike times of every neuron
+             (None if the inputs were invalid).
+        cache (str or cache.ResultCache):
+            If given, a cache directory (see cache.py). Smoothed traces are
+             cached per data file and sample_rate, and spike times per data
+             file, sample_rate and threshold, so a rerun with only threshold
+             changed skips reading and smoothing the data, and an unchanged
+             rerun returns without reading the data. Spike detection then
+             runs serially and executor is ignored. Not used together with
+             chunk_size.
+        instrument (callable or str):
+            If given, the run is recorded stage by stage (see profiling.py):
+             wall time, CPU time and peak memory of reading, validation,
+             smoothing, peak finding and condition counting, with the same
+             code path as an uninstrumented run. A callable is called with the
+             profiling.Report; a str is a filepath the JSON report is written
+             to. profiling.record() is the context-manager form; it can also
+             write a cProfile dump, and time the detection of every neuron
+             with per_neuron=True (the 'serial' executor then detects spikes
+             neuron by neuron).
+        precision (str):
+            Precision the voltage traces are stored and smoothed in (see
+             detection.as_precision):
+                - 'float64': exact (default).
+                - 'float32': CSV traces are parsed straight to float32 and
+                   smoothed in float32; half the memory of float64.
+                - 'int16': traces are stored as int16 counts with a
+                   per-neuron scale and offset and smoothed in float32; a
+                   quarter of the memory for the traces and half for the
+                   smoothed traces.
+            detection.memory_footprint gives the bytes saved. A peak within
+             rounding error of the threshold or of a neighbouring peak can
+             differ from float64: on 1e6 samples x 64 neurons of the
+             synthetic recordings of tests/util.py, float32 finds the same
+             55194 spikes, int16 moves 6 of them by a sample, and no
+             condition count changes (benchmarks/bench_precision.py).
+             Must be 'float64' when chunk_size is given (ValueError
+             otherwise); chunked runs already bound memory.
+        conditions_list (list of str):
+            Conditions to count; the keys of the output. Default:
+             conditions.CONDITIONS. Besides strings of epoch letters ('tr':
+             trial and reward on), expressions of the epochs are accepted,
+             e.g. 't & ~l' or 'trial_on and not light_on' (see
+             conditions.evaluate_condition).
+        fused (bool or str):
+            If set, each neuron is smoothed and searched for peaks in one pass
+             that never stores its smoothed trace (see fused.py). True picks
+             the compiled 'numba' kernel if numba is installed and the
+             block-wise 'numpy' one otherwise; 'numba' or 'numpy' picks one.
+             The spikes are identical. Only with the 'serial' executor, and
+             not with chunk_size or cache (ValueError).
+        neurons (list of str):
+            Names or glob patterns (e.g. 'neuron_1?') of the neuron columns
+             to analyze; the other columns of a CSV file are not parsed. A
+             name or pattern that matches no column is an invalid data file.
+             Default: all neurons.
+        csv_engine (str):
+            Parser of CSV data files (see readers.read_csv): 'c' (default)
+             or 'pyarrow', multithreaded and correctly rounded.
     """
-    import pandas as pd
-    import json
     import logging
 
-    # Create empty dataframe to store final output
-    result = pd.DataFrame()
+    if precision not in detection.PRECISIONS:
+      raise ValueError('precision must be one of ' + str(detection.PRECISIONS) + ', got: ' + repr(precision))
+    if precision != 'float64' and chunk_size is not None:
+      raise ValueError('precision ' + repr(precision) + ' cannot be used together with chunk_size')
+    if fused not in [False, True, 'numba', 'numpy']:
+      raise ValueError("fused must be True, False, 'numba' or 'numpy', got: " + repr(fused))
+    if fused and executor != 'serial':
+      raise ValueError("fused requires executor='serial', got: " + repr(executor))
+    if fused and (chunk_size is not None or cache is not None):
+      raise ValueError('fused cannot be used together with chunk_size or cache')
+    if csv_engine not in readers.CSV_ENGINES:
+      raise ValueError('csv_engine must be one of ' + str(readers.CSV_ENGINES) + ', got: ' + repr(csv_engine))
+    if conditions_list is None:
+      conditions_list = conditions.CONDITIONS
+    for condition in conditions_list:
+      conditions.condition_codes(condition)
+    if executor not in parallel.EXECUTORS:
+      raise ValueError('executor must be one of ' + str(parallel.EXECUTORS) + ', got: ' + repr(executor))
 
-    # Now try reading both the CSV and JSON input files from filepath_data and
-    # filepath_parameters respectively. If any error comes up, simply log it
-    # and return empty result.
+    if instrument is not None:
+      callback = instrument if callable(instrument) else (lambda report: report.to_json(instrument))
+      with profiling.record(callback=callback, per_neuron=False):
+        return pipeline(filepath_data, filepath_parameters, executor=executor, n_workers=n_workers,
+                        chunk_size=chunk_size, return_spikes=return_spikes, cache=cache, precision=precision,
+                        conditions_list=conditions_list, fused=fused, neurons=neurons, csv_engine=csv_engine)
+
+    # Pre-flight: the parameters JSON file, then the header and first rows of
+    # the data file are read and validated before anything is read in full
+    # (or hashed for the cache), so invalid inputs are rejected in
+    # milliseconds whatever the size of the data file. If any error comes
+    # up, simply log it and return empty result.
     try:
-      data = pd.read_csv(filepath_data)
+      parameters = load_parameters(filepath_parameters)
+    except Exception as ex:
+      logging.exception('Error in reading filepath_parameters JSON file. Please check the stacktrace below for details.')
+      return empty_result(return_spikes)
+    errors = validation.validate_parameters(parameters)
+    if len(errors) > 0:
+      logging.exception('Input data validation failed due to: ' + '; '.join(errors))
+      return empty_result(return_spikes)
+
+    try:
+      with profiling.stage('probe_data'):
+        head = readers.read_head(filepath_data, PROBE_ROWS, neurons=neurons)
     except Exception as ex:
       logging.exception('Error in reading filepath_data CSV file. Please check the stacktrace below for details.')
-      return result
+      return empty_result(return_spikes)
+    errors = validation.validate_data(head)
+    if len(errors) > 0:
+      logging.exception('Input data validation failed due to: ' + '; '.join(errors))
+      return empty_result(return_spikes)
 
+    # Now read the data file in full (or stream it). The whole of it is
+    # validated below, since rows after the probed ones can still be invalid.
     try:
-      with open(filepath_parameters, 'r') as f:
-        parameters = json.load(f)
+      if cache is not None and chunk_size is None:
+        # The data are only read on a cache miss, see below.
+        if not isinstance(cache, result_cache.ResultCache):
+          cache = result_cache.ResultCache(cache)
+        with profiling.stage('data_digest'):
+          digest = cache.data_digest(filepath_data)
+        # Entries of a subset of neurons, or of CSV values parsed by another
+        # engine, are kept apart from the default ones
+        if neurons is not None:
+          digest += ':' + ','.join([neurons] if isinstance(neurons, str) else neurons)
+        if csv_engine != 'c' and readers.data_format(filepath_data) == 'csv':
+          digest += ':' + csv_engine
+      elif chunk_size is None:
+        with profiling.stage('read_data'):
+          data = readers.read_data(filepath_data, precision=precision, neurons=neurons, csv_engine=csv_engine)
+      else:
+        data = readers.read_chunks(filepath_data, chunk_size, neurons=neurons)
     except Exception as ex:
-      logging.exception('Error in reading filepath_parameters JSON file. Please check the stacktrace below for details.')
-      return result
+      logging.exception('Error in reading filepath_data CSV file. Please check the stacktrace below for details.')
+      return empty_result(return_spikes)
+
+    if cache is not None and chunk_size is None:
+      with profiling.stage('cache_lookup'):
+        cached = cache.lookup(digest, parameters, precision=precision)
+      if cached is not None:
+        histogram, spike_trains = cached
+        ns_conditions = conditions.count_conditions(histogram, conditions_list)
+        return (ns_conditions, spike_trains) if return_spikes else ns_conditions
+      try:
+        with profiling.stage('read_data'):
+          data = readers.read_data(filepath_data, precision=precision, neurons=neurons, csv_engine=csv_engine)
+      except Exception as ex:
+        logging.exception('Error in reading filepath_data CSV file. Please check the stacktrace below for details.')
+        return empty_result(return_spikes)
+
+    # In streaming mode every chunk is validated as it is read.
+    if chunk_size is not None:
+      try:
+        with profiling.stage('streaming'):
+          return streaming.count_spikes_chunked(data, parameters, return_spikes=return_spikes, conditions_list=conditions_list)
+      except ValueError as ex:
+        logging.exception('Input data validation failed due to: ' + str(ex))
+        return empty_result(return_spikes)
 
     # Validate the data read above. If not as expected, return empty result.
-    status, optional_error = validate_input(data, parameters)
+    with profiling.stage('validate_input'):
+      status, optional_error = validate_input(data, parameters)
     if not status:
       logging.exception('Input data validation failed due to: ' + optional_error)
-      return result
+      return empty_result(return_spikes)
+
+    if cache is not None and chunk_size is None:
+      return analyze_cached(data, parameters, cache, digest, return_spikes=return_spikes, precision=precision,
+                            conditions_list=conditions_list)
+    return analyze(data, parameters, executor=executor, n_workers=n_workers, return_spikes=return_spikes, precision=precision,
+                   conditions_list=conditions_list, fused=fused)
+
+
+def empty_result(return_spikes=False):
+    """
+    Result of pipeline() when the inputs are invalid: an empty dataframe (and
+     no spike trains). pandas is only imported here, so runs that succeed on
+     binary data never load it.
+    """
+    import pandas as pd
+
+    return (pd.DataFrame(), None) if return_spikes else pd.DataFrame()
+
+
+def load_parameters(filepath_parameters):
+    """
+    Read the parameters JSON file into a dict.
+    """
+    import json
+
+    with open(filepath_parameters, 'r') as f:
+        return json.load(f)
+
+
+def analyze(data, parameters, executor='serial', n_workers=None, return_spikes=False, precision='float64',
+            conditions_list=conditions.CONDITIONS, fused=False):
+    """
+    Spike detection and condition counting on data that already passed
+     validate_input. See pipeline() for the arguments.
 
+    Returns:
+        ns_conditions (dict):
+            Number of spikes, summed across neurons, for each condition.
+        spike_trains (spikes.SpikeTrains):
+            Only if return_spikes is True.
+    """
     keys_trial = ['trial_on', 'reward_on', 'light_on']
     t, r, l = (data[key] for key in keys_trial)
     keys_neurons = [key for key in data.keys() if key not in keys_trial]
     # Use sample_rate and threshold value from extracted 'parameters'.
-    st = [count_spikes(data[key], parameters['sample_rate'], parameters['threshold']) for key in keys_neurons] # 'spike_times'
-    # st = [count_spikes(data[key]) for key in keys_neurons] # 'spike_times'
-    st_cat = np.concatenate(st)
-
-    bool_to_idx = lambda x: np.where(x)[0]    # Means only return 'True' indexes
-    idx_conditions = {
-        't': bool_to_idx(t), ## trial_on
-        'r': bool_to_idx(r), ## reward_on
-        'l': bool_to_idx(l), ## light_on
-        'tr': bool_to_idx(t * r),
-        'tl': bool_to_idx(t * l),
-        'rl': bool_to_idx(r * l),
-        'trl': bool_to_idx(t * r * l),
-    }
-
-    ns_conditions = {key: np.isin(st_cat, val).sum() for key, val in idx_conditions.items()}
+    if executor == 'serial' and (fused or profiling.per_neuron()):
+        # Fused kernel or instrumented run: one neuron at a time, same spikes.
+        detector = detection.SpikeDetector.from_parameters(parameters, precision=_detector_precision(precision), fused=fused)
+        st = []
+        for key in keys_neurons:
+            with profiling.stage('detect_neuron', neuron=key):
+                st.append(detector.detect(np.asarray(data[key])))
+        spike_trains = spikes.SpikeTrains.from_list(st, keys_neurons, n_samples=len(t))
+    elif executor == 'serial':
+        # All neurons are smoothed and searched for peaks at once; the spike
+        # times of all neurons come back already concatenated.
+        detector = detection.SpikeDetector.from_parameters(parameters)
+        with profiling.stage('traces_matrix', precision=precision):
+            traces = detection.traces_matrix(data, keys_neurons, precision=_detector_precision(precision))
+        with profiling.stage('smooth'):
+            traces_smooth = detector.smooth(traces)
+        with profiling.stage('find_peaks'):
+            st_cat, offsets = detection.find_peaks_batched(traces_smooth, detector.plan.threshold, detector.plan.distance)
+        spike_trains = spikes.SpikeTrains(st_cat, offsets, keys_neurons, n_samples=len(t))
+    else:
+        with profiling.stage('detect_spikes', executor=executor):
+            st = parallel.detect_spikes(
+                [data[key] for key in keys_neurons],
+                parameters['sample_rate'],
+                parameters['threshold'],
+                executor=executor,
+                n_workers=n_workers,
+                precision=precision,
+            ) # 'spike_times'
+        spike_trains = spikes.SpikeTrains.from_list(st, keys_neurons, n_samples=len(t))
+
+    # Run-length encode the epochs and count all conditions against the
+    # interval bounds; memory scales with the number of epoch transitions.
+    with profiling.stage('count_conditions'):
+        epochs = intervals.epoch_intervals(t, r, l)
+        ns_conditions = intervals.count_conditions(spike_trains.spike_times, epochs, conditions_list)
+    if return_spikes:
+        return ns_conditions, spike_trains
     return ns_conditions
 
 
-def count_spikes(trace, sample_rate=10000, threshold=10):
-    import scipy
+def analyze_cached(data, parameters, cache, digest, return_spikes=False, precision='float64',
+                   conditions_list=conditions.CONDITIONS):
+    """
+    analyze() with the serial detector, storing the smoothed traces and the
+     spike times in cache (a cache.ResultCache) under the data digest.
+    """
+    keys_trial = ['trial_on', 'reward_on', 'light_on']
+    keys_neurons = [key for key in data.keys() if key not in keys_trial]
+    codes = conditions.epoch_codes(*(data[key] for key in keys_trial))
+
+    detector = detection.SpikeDetector.from_parameters(parameters)
+    with profiling.stage('smooth'):
+        traces_smooth = detector.smooth(detection.traces_matrix(data, keys_neurons, precision=_detector_precision(precision)))
+    with profiling.stage('cache_store'):
+        cache.put_smoothed(digest, parameters['sample_rate'], traces_smooth, codes, keys_neurons, precision=precision)
+    with profiling.stage('find_peaks'):
+        st_cat, offsets = detection.find_peaks_batched(traces_smooth, detector.plan.threshold, detector.plan.distance)
+    spike_trains = spikes.SpikeTrains(st_cat, offsets, keys_neurons, n_samples=len(codes))
+
+    histogram = conditions.code_histogram(spike_trains.spike_times, codes)
+    cache.put_spikes(digest, parameters, histogram, spike_trains, precision=precision)
+    ns_conditions = conditions.count_conditions(histogram, conditions_list)
+    if return_spikes:
+        return ns_conditions, spike_trains
+    return ns_conditions
+
+
+def _detector_precision(precision):
+    # 'float64' is the precision of the data as read: float32 columns (e.g.
+    # from a Feather file) are smoothed in float32, as by count_spikes.
+    return None if precision == 'float64' else precision
+
+
+def count_spikes(trace, sample_rate=10000, threshold=10, precision='float64'):
+    import scipy.signal
+
+    ## reduced precision (see detection.as_precision): the trace is stored
+    ##  as float32 or int16 and smoothed in float32
+    quantized = None
+    if precision != 'float64':
+        trace = detection.as_precision(trace, precision)
+        if precision == 'int16':
+            quantized, trace = trace, trace.counts.astype(np.float32)
 
     ## smooth the trace
-    w = sample_rate / 500 # roughly the n_samples of a spike
-    w = int(w + np.remainder(w, 2)) # make odd
     trace_smooth = scipy.signal.savgol_filter(
         x=trace,
-        window_length=w,
+        window_length=savgol_window(sample_rate),
         polyorder=2,
     )
+    if quantized is not None:
+        trace_smooth *= quantized.scale
+        trace_smooth += quantized.offset
 
     ## find peaks (spike times)
     peaks, _ = scipy.signal.find_peaks(
         x=trace_smooth,
         height=threshold,
-        distance=(2/1000 * sample_rate),
+        distance=peak_distance(sample_rate),
     )
 
     return peaks
 
 
+def savgol_window(sample_rate):
+    """
+    Savitzky-Golay window length (in samples) used to smooth the traces.
+    """
+    w = sample_rate / 500 # roughly the n_samples of a spike
+    w = int(w + np.remainder(w, 2)) # make odd
+    return w
+
+
+def peak_distance(sample_rate):
+    """
+    Minimal distance (in samples) between two spikes of the same neuron.
+    """
+    return 2/1000 * sample_rate
+
+
 def validate_input(data, parameters):
   # Input data must have:
   #   1. 3 critical column names: 'trial', 'reward' and 'light' tags
   #   2. above 3 columns are temporal epochs that should have a boolean value
   #   3. there is atleast 1 neuron voltage trace observation per row
   #   4. all neuron voltage trace columns should have numerical values
-  for required_column in ['trial_on', 'reward_on', 'light_on']:
-    if required_column not in data.keys():
-      return False, 'Critical temporal epoch column: ' + required_column + ' not in input data'
-    # Refered: https://docs.python.org/2/library/functions.html#isinstance
-    for val in data[required_column]:
-      if not isinstance(val, bool):
-        return False, 'Critical temporal epoch column: ' + required_column + ' value type is not bool in input data'
-
-  for column in data.keys():
-    # For all other columns, it should be numerical (int/float) value
-    if column not in ['trial_on', 'reward_on', 'light_on']:
-      if np.isnan(data[column]).any():
-        return False, 'Found invalue NaN value for column: ' + column + ' in input data'
-
   # Input parameters must have:
   #   1. Both 'sample_rate' and 'threshold' keys
   #   2. Value corresponding to each should be of 'float' type
-  for required_column in ['sample_rate', 'threshold']:
-    if required_column not in parameters:
-      return False, 'Column ' + required_column + ' missing in input parameters'
-    if not isinstance(parameters[required_column], float):
-      return False, 'Column ' + required_column + ' value type is not float in input parameters'
-
-  # If all validation checks pass, return true
-  return True, ''
-
+  # The checks are done column-wise (see validation.py), and every failure
+  # is reported in the returned message.
+  return validation.validate_input(data, parameters)
@@ -0,0 +1,200 @@
+## Opt-in per-stage instrumentation of the pipeline
+
+import contextlib
+import contextvars
+import json
+import sys
+import threading
+import time
+
+## Recorder of the current run; None when instrumentation is off
+_recorder = contextvars.ContextVar('my_pipeline_recorder', default=None)
+_NULL_STAGE = contextlib.nullcontext()
+
+
+def stage(name, **info):
+    """
+    Context manager timing one stage of a run, e.g.
+        with profiling.stage('read'):
+            data = readers.read_data(filepath_data)
+    When no recording is active this returns a shared no-op context, so the
+     cost of an instrumented line is one context variable lookup.
+
+    Args:
+        name (str):
+            Name of the stage. Nested stages are recorded with their depth.
+        info:
+            JSON-serializable details stored with the stage (e.g. neuron=...).
+    """
+    recorder = _recorder.get()
+    if recorder is None:
+        return _NULL_STAGE
+    return recorder.stage(name, **info)
+
+
+def per_neuron():
+    """
+    True if a recording is active and asked for per-neuron stages, which
+     callers only collect when they will be recorded.
+    """
+    recorder = _recorder.get()
+    return recorder is not None and recorder.per_neuron
+
+
+@contextlib.contextmanager
+def record(callback=None, memory=True, per_neuron=False, filepath_profile=None):
+    """
+    Record every stage run inside the block, e.g.
+        with profiling.record() as report:
+            pipeline.pipeline(filepath_data, filepath_parameters)
+        report.to_json('report.json')
+
+    Args:
+        callback (callable):
+            Called with the Report at the end of the block.
+        memory (bool):
+            Whether to measure the peak memory of every stage with
+             tracemalloc (numpy arrays are included). Tracing slows down
+             allocations, so it can be turned off for timing-only reports.
+        per_neuron (bool):
+            Whether to also record one stage per neuron (off by default).
+             Spike detection then runs neuron by neuron instead of on all
+             neurons at once, which gives the same spikes but is slower, so
+             the other stages are no longer those of an uninstrumented run.
+        filepath_profile (str):
+            If given, the block also runs under cProfile and the stats are
+             dumped to this file (readable with pstats or snakeviz).
+
+    Yields:
+        report (Report):
+            Filled in as the stages complete.
+    """
+    import tracemalloc
+
+    recorder = Report(memory=memory, per_neuron=per_neuron)
+    token = _recorder.set(recorder)
+    started_tracing = memory and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    profiler = None
+    if filepath_profile is not None:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    tic_wall, tic_cpu = time.perf_counter(), time.process_time()
+    try:
+        yield recorder
+    finally:
+        recorder.wall = time.perf_counter() - tic_wall
+        recorder.cpu = time.process_time() - tic_cpu
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(str(filepath_profile))
+        if started_tracing:
+            tracemalloc.stop()
+        recorder.max_rss = _max_rss()
+        _recorder.reset(token)
+        if callback is not None:
+            callback(recorder)
+
+
+class Report:
+    """
+    Stages recorded during one run, in the order they finished.
+    Each stage has its wall time and CPU time (of the whole process, so
+     concurrent threads are included) in seconds and, if memory tracing is
+     on, its peak memory in bytes above the memory in use when it started.
+     Peak memory is exact for stages run one at a time and approximate for
+     stages running concurrently in threads.
+    """
+    def __init__(self, memory=True, per_neuron=False):
+        self.memory = memory
+        self.per_neuron = per_neuron
+        self.stages = []
+        self.wall = None
+        self.cpu = None
+        self.max_rss = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @contextlib.contextmanager
+    def stage(self, name, **info):
+        import tracemalloc
+
+        stack = self._stack()
+        frame = {'start': 0, 'peak': 0}
+        if self.memory and tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            if stack:
+                stack[-1]['peak'] = max(stack[-1]['peak'], peak)
+            tracemalloc.reset_peak()
+            frame = {'start': current, 'peak': current}
+        stack.append(frame)
+        tic_wall, tic_cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - tic_wall
+            cpu = time.process_time() - tic_cpu
+            stack.pop()
+            entry = dict(name=name, depth=len(stack), wall=wall, cpu=cpu, **info)
+            if self.memory and tracemalloc.is_tracing():
+                frame['peak'] = max(frame['peak'], tracemalloc.get_traced_memory()[1])
+                entry['peak_memory'] = frame['peak'] - frame['start']
+                if stack:
+                    stack[-1]['peak'] = max(stack[-1]['peak'], frame['peak'])
+            with self._lock:
+                self.stages.append(entry)
+
+    def summary(self):
+        """
+        Total wall time, CPU time, maximal peak memory and number of calls
+         per stage name.
+        """
+        totals = {}
+        for entry in self.stages:
+            total = totals.setdefault(entry['name'], {'calls': 0, 'wall': 0.0, 'cpu': 0.0})
+            total['calls'] += 1
+            total['wall'] += entry['wall']
+            total['cpu'] += entry['cpu']
+            if 'peak_memory' in entry:
+                total['peak_memory'] = max(total.get('peak_memory', 0), entry['peak_memory'])
+        return totals
+
+    def to_dict(self):
+        return {
+            'wall': self.wall,
+            'cpu': self.cpu,
+            'max_rss': self.max_rss,
+            'summary': self.summary(),
+            'stages': list(self.stages),
+        }
+
+    def to_json(self, filepath=None):
+        """
+        The report as a JSON string, also written to filepath if given.
+        """
+        text = json.dumps(self.to_dict(), indent=2)
+        if filepath is not None:
+            with open(str(filepath), 'w') as f:
+                f.write(text)
+        return text
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+
+def _max_rss():
+    """
+    Peak resident memory of the process in bytes, or None where the resource
+     module is not available (Windows).
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    ## Kilobytes on Linux and the BSDs, bytes on macOS
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
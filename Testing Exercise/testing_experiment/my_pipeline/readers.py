@@ -0,0 +1,470 @@
+## Input readers: CSV and binary columnar formats
+
+import csv
+import fnmatch
+import json
+from pathlib import Path
+
+import numpy as np
+
+from . import validation
+
+## Suffixes of the binary formats. A directory is read as memory-mapped .npy columns.
+SUFFIXES_PARQUET = ['.parquet', '.pq']
+SUFFIXES_FEATHER = ['.feather', '.arrow']
+## Name of the metadata file of a .npy directory
+FILENAME_META = 'meta.json'
+## CSV parsers of read_csv: pandas' C parser, or pyarrow's multithreaded one
+CSV_ENGINES = ['c', 'pyarrow']
+## Spellings of the epoch booleans, the ones pandas accepts
+TRUE_VALUES = ['True', 'TRUE', 'true']
+FALSE_VALUES = ['False', 'FALSE', 'false']
+
+
+def data_format(filepath_data):
+    """
+    Format of the data file, picked from its extension: 'npy' for a
+     directory, 'parquet', 'feather', or 'csv' for anything else.
+    """
+    path = Path(filepath_data)
+    if str(filepath_data) != '' and path.is_dir():
+        return 'npy'
+    if path.suffix.lower() in SUFFIXES_PARQUET:
+        return 'parquet'
+    if path.suffix.lower() in SUFFIXES_FEATHER:
+        return 'feather'
+    return 'csv'
+
+
+def read_data(filepath_data, precision=None, neurons=None, csv_engine='c'):
+    """
+    Read a data file in any supported format.
+
+    Args:
+        filepath_data (str):
+            One of:
+                - a CSV file (the original layout, see pipeline()), parsed
+                   with the column types of the layout (see read_csv).
+                - a directory written by convert_csv, with one memory-mapped
+                   .npy array per neuron column and the epoch columns stored
+                   as packed bits.
+                - a Parquet or Feather (Arrow IPC) file. The epoch columns
+                   are Arrow booleans, which are bit-packed.
+        precision (str):
+            'float32' or 'int16' parses the neuron columns of CSV files
+             straight to float32 (int16 traces are quantized from those, see
+             detection.as_precision). Binary columns are returned as stored
+             and converted neuron by neuron later.
+        neurons (list of str):
+            Neuron columns to read, by name or glob pattern (see
+             select_columns). Default: all of them.
+        csv_engine (str):
+            Parser of CSV files, see read_csv.
+
+    Returns:
+        data (pandas.DataFrame or dict):
+            DataFrame for CSV files read with the 'c' engine, otherwise a
+             dict from column name to a 1-D np.ndarray. Neuron columns of
+             .npy directories and of uncompressed Feather files are
+             zero-copy views of the file.
+    """
+    fmt = data_format(filepath_data)
+    if fmt == 'npy':
+        data = read_npy_dir(filepath_data)
+        return {key: data[key] for key in select_columns(list(data), neurons)}
+    if fmt in ('parquet', 'feather'):
+        return _read_arrow_columns(filepath_data, fmt, neurons)
+    return read_csv(filepath_data, precision=precision, neurons=neurons, engine=csv_engine)
+
+
+def read_csv(filepath_data, precision=None, neurons=None, engine='c'):
+    """
+    Read a CSV data file with the column types of the layout instead of
+     letting the parser infer them: bool for the epoch columns, float64 (or
+     float32, see read_data) for the neuron columns. Only the selected
+     neuron columns are parsed.
+    A file that does not parse with these types (e.g. an epoch column with
+     a missing or non-boolean value) is read again without them, so that
+     validation.validate_data reports the problem as for any invalid file.
+
+    Args:
+        filepath_data (str):
+            Filepath to the CSV file.
+        precision (str):
+            'float32' or 'int16' parses the neuron columns to float32.
+        neurons (list of str):
+            Neuron columns to read, by name or glob pattern (see
+             select_columns). Default: all of them.
+        engine (str):
+            - 'c': pandas' C parser (default).
+            - 'pyarrow': pyarrow.csv, which parses blocks of the file on
+               all cores. Its floats are correctly rounded (those of
+               float_precision='round_trip'), while the C parser's can be
+               off in the last digits (about 7% of the values of the
+               synthetic recordings of tests/util.py), so a spike within
+               rounding error of the threshold or of a neighbouring peak
+               can differ.
+
+    Returns:
+        data (pandas.DataFrame or dict):
+            DataFrame with the 'c' engine, dict from column name to a 1-D
+             np.ndarray with 'pyarrow'.
+    """
+    if engine not in CSV_ENGINES:
+        raise ValueError('engine must be one of ' + str(CSV_ENGINES) + ', got: ' + repr(engine))
+    keys = select_columns(read_header(filepath_data), neurons)
+    dtype_neurons = np.float32 if precision in ('float32', 'int16') else np.float64
+    dtypes = {key: np.bool_ if key in validation.KEYS_EPOCHS else dtype_neurons for key in keys}
+
+    import pandas as pd
+    try:
+        if engine == 'pyarrow':
+            return _read_csv_arrow(filepath_data, dtypes)
+        return pd.read_csv(filepath_data, usecols=keys, dtype=dtypes, true_values=TRUE_VALUES, false_values=FALSE_VALUES)
+    except (ValueError, TypeError):
+        ## pyarrow's ArrowInvalid is a ValueError
+        return pd.read_csv(filepath_data, usecols=keys)
+
+
+def read_header(filepath_data):
+    """
+    Column names of a CSV file, from its first line.
+    """
+    with open(str(filepath_data), 'r', newline='', encoding='utf-8-sig') as f:
+        return next(csv.reader(f), [])
+
+
+def select_columns(keys, neurons=None):
+    """
+    Columns of keys to read: the epoch columns and the neuron columns
+     selected by neurons, in the order of keys.
+
+    Args:
+        keys (list of str):
+            Column names of the data file.
+        neurons (list of str):
+            Names or glob patterns (fnmatch, e.g. 'neuron_1?') of the neuron
+             columns. Default: all of them.
+
+    Raises:
+        ValueError:
+            If a name or pattern matches no neuron column.
+    """
+    if neurons is None:
+        return list(keys)
+    if isinstance(neurons, str):
+        neurons = [neurons]
+    keys_neurons = [key for key in keys if key not in validation.KEYS_EPOCHS]
+    selected = set()
+    for pattern in neurons:
+        matches = fnmatch.filter(keys_neurons, pattern)
+        if len(matches) == 0:
+            raise ValueError('No neuron column matches ' + repr(pattern))
+        selected.update(matches)
+    return [key for key in keys if key in validation.KEYS_EPOCHS or key in selected]
+
+
+def read_chunks(filepath_data, chunk_size, neurons=None):
+    """
+    Iterate over blocks of chunk_size rows of a data file in any supported
+     format, with only the neuron columns selected by neurons (see
+     select_columns).
+
+    Returns:
+        chunks (iterator of pandas.DataFrame or dict):
+            Same types as read_data. Binary formats are sliced lazily from
+             the memory-mapped columns.
+    """
+    fmt = data_format(filepath_data)
+    if fmt == 'csv':
+        import pandas as pd
+        keys = select_columns(read_header(filepath_data), neurons)
+        return pd.read_csv(filepath_data, chunksize=chunk_size, usecols=keys)
+
+    if fmt == 'npy':
+        meta, columns = _open_npy_dir(filepath_data)
+        columns = {key: columns[key] for key in select_columns(list(columns), neurons)}
+    else:
+        columns = _read_arrow_columns(filepath_data, fmt, neurons)
+        meta = {'n_samples': len(next(iter(columns.values()))) if columns else 0}
+    return _iter_slices(meta, columns, chunk_size)
+
+
+def read_head(filepath_data, n_rows, neurons=None):
+    """
+    First n_rows rows of a data file in any supported format, without
+     parsing or loading the rest of it. CSV values are not given the types
+     of read_csv, so that validation.validate_data sees them as they are.
+
+    Args:
+        filepath_data (str):
+            Filepath of the data file.
+        n_rows (int):
+            Number of rows to read.
+        neurons (list of str):
+            Neuron columns to read, see select_columns.
+
+    Returns:
+        data (pandas.DataFrame or dict):
+            Same types as read_chunks, with every column of the file (or of
+             the selection) even if the file has no rows.
+    """
+    fmt = data_format(filepath_data)
+    if fmt == 'csv':
+        import pandas as pd
+        return pd.read_csv(filepath_data, nrows=n_rows, usecols=select_columns(read_header(filepath_data), neurons))
+    if fmt == 'npy':
+        meta, columns = _open_npy_dir(filepath_data)
+        stop = min(n_rows, meta['n_samples'])
+        return {key: columns[key](0, stop) for key in select_columns(list(columns), neurons)}
+
+    if fmt == 'feather':
+        import pyarrow.feather
+        table = pyarrow.feather.read_table(str(filepath_data), memory_map=True)
+    else:
+        import pyarrow as pa
+        import pyarrow.parquet
+        ## Only the first row group is decoded
+        parquet_file = pyarrow.parquet.ParquetFile(str(filepath_data), memory_map=True)
+        batch = next(parquet_file.iter_batches(batch_size=n_rows), None)
+        table = pa.Table.from_batches([batch]) if batch is not None else parquet_file.schema_arrow.empty_table()
+    table = table.slice(0, n_rows).select(select_columns(table.column_names, neurons))
+    return {key: table.column(key).to_numpy() for key in table.column_names}
+
+
+def read_npy_dir(dirpath):
+    """
+    Read a directory written by convert_csv. Neuron columns are memory-mapped,
+     epoch columns are unpacked from their bits.
+    """
+    meta, columns = _open_npy_dir(dirpath)
+    return {key: column(0, meta['n_samples']) for key, column in columns.items()}
+
+
+def convert_csv(filepath_csv, filepath_out, chunk_size=1000000):
+    """
+    One-shot conversion of a CSV data file to a binary format.
+    The output format is picked from the extension of filepath_out
+     ('.parquet'/'.pq', '.feather'/'.arrow'); any other path is written as a
+     directory of .npy arrays.
+
+    Args:
+        filepath_csv (str):
+            Filepath to the CSV file.
+        filepath_out (str):
+            Filepath of the output file or directory.
+        chunk_size (int):
+            Number of rows parsed at a time. The .npy and Parquet writers
+             stream the CSV, so memory is bounded by the chunk size.
+    """
+    import pandas as pd
+
+    path_out = Path(filepath_out)
+    suffix = path_out.suffix.lower()
+    if suffix in SUFFIXES_FEATHER:
+        import pyarrow as pa
+        import pyarrow.feather
+        ## Written as a single uncompressed record batch so that every column
+        ##  can be memory-mapped without a copy.
+        table = pa.Table.from_pandas(pd.read_csv(filepath_csv), preserve_index=False).combine_chunks()
+        pyarrow.feather.write_feather(table, str(path_out), compression='uncompressed')
+        return
+
+    if suffix in SUFFIXES_PARQUET:
+        import pyarrow as pa
+        import pyarrow.parquet
+        writer = None
+        try:
+            for chunk in pd.read_csv(filepath_csv, chunksize=chunk_size):
+                table = pa.Table.from_pandas(chunk, preserve_index=False)
+                if writer is None:
+                    writer = pyarrow.parquet.ParquetWriter(str(path_out), table.schema)
+                writer.write_table(table.cast(writer.schema))
+        finally:
+            if writer is not None:
+                writer.close()
+        return
+
+    _write_npy_dir(filepath_csv, path_out, chunk_size)
+
+
+def write_npy_dir(data, dirpath):
+    """
+    Write columns that are already in memory as a directory readable by
+     read_npy_dir (the layout written by convert_csv).
+
+    Args:
+        data (pandas.DataFrame or dict):
+            Mapping from column name to a 1-D array, in the layout of pipeline().
+        dirpath (str):
+            Output directory. Created if needed.
+    """
+    path_out = Path(dirpath)
+    path_out.mkdir(parents=True, exist_ok=True)
+    columns = list(data.keys())
+    n_samples = len(data[columns[0]]) if columns else 0
+    for key in columns:
+        if key in validation.KEYS_EPOCHS:
+            array = np.packbits(np.asarray(data[key], dtype=np.bool_))
+        else:
+            array = np.asarray(data[key], dtype=np.float64)
+        np.save(str(path_out / (key + _npy_suffix(key))), array)
+    with open(str(path_out / FILENAME_META), 'w') as f:
+        json.dump({'n_samples': n_samples, 'columns': columns}, f)
+
+
+def write_npy_chunks(chunks, dirpath, n_samples):
+    """
+    Stream chunks of rows into a directory readable by read_npy_dir, with
+     memory bounded by the chunk size.
+
+    Args:
+        chunks (iterable):
+            Mappings from column name to a 1-D array, all with the same
+             columns. Every chunk but the last must have a multiple of 8
+             rows, so that the epoch columns pack into whole bytes.
+        dirpath (str):
+            Output directory. Created if needed.
+        n_samples (int):
+            Total number of rows of the chunks.
+    """
+    path_out = Path(dirpath)
+    path_out.mkdir(parents=True, exist_ok=True)
+    columns = None
+    arrays = {}
+    start = 0
+    for chunk in chunks:
+        if start % 8 != 0:
+            raise ValueError('Only the last chunk can have a number of rows that is not a multiple of 8')
+        if columns is None:
+            columns = list(chunk.keys())
+            for key in columns:
+                if key in validation.KEYS_EPOCHS:
+                    shape, dtype = ((n_samples + 7) // 8,), np.uint8
+                else:
+                    shape, dtype = (n_samples,), np.float64
+                arrays[key] = np.lib.format.open_memmap(str(path_out / (key + _npy_suffix(key))), mode='w+', dtype=dtype, shape=shape)
+        n_rows = len(chunk[columns[0]])
+        for key in columns:
+            if key in validation.KEYS_EPOCHS:
+                arrays[key][start // 8:(start + n_rows + 7) // 8] = np.packbits(np.asarray(chunk[key], dtype=np.bool_))
+            else:
+                arrays[key][start:start + n_rows] = chunk[key]
+        start += n_rows
+    if start != n_samples:
+        raise ValueError(f'Chunks have {start} rows in total, expected {n_samples}')
+
+    for array in arrays.values():
+        array.flush()
+    with open(str(path_out / FILENAME_META), 'w') as f:
+        json.dump({'n_samples': n_samples, 'columns': columns or []}, f)
+
+
+def _write_npy_dir(filepath_csv, path_out, chunk_size):
+    import pandas as pd
+
+    with open(filepath_csv, 'r') as f:
+        n_samples = sum(1 for _ in f) - 1
+    ## Chunks are a multiple of 8 rows so that each packs into whole bytes
+    chunk_size = max(8, chunk_size - chunk_size % 8)
+
+    def validated_chunks():
+        for chunk in pd.read_csv(filepath_csv, chunksize=chunk_size):
+            ## Packing bits and casting to float would silently hide invalid values
+            errors = validation.validate_data(chunk)
+            if len(errors) > 0:
+                raise ValueError('; '.join(errors))
+            yield {key: chunk[key].to_numpy() for key in chunk.keys()}
+
+    write_npy_chunks(validated_chunks(), path_out, n_samples)
+
+
+def _npy_suffix(key):
+    return '.bits.npy' if key in validation.KEYS_EPOCHS else '.npy'
+
+
+def _open_npy_dir(dirpath):
+    """
+    Returns the metadata and, for every column, a function (start, stop) -> array.
+    """
+    path = Path(dirpath)
+    with open(str(path / FILENAME_META), 'r') as f:
+        meta = json.load(f)
+
+    columns = {}
+    for key in meta['columns']:
+        array = np.load(str(path / (key + _npy_suffix(key))), mmap_mode='r')
+        if key in validation.KEYS_EPOCHS:
+            columns[key] = _bits_reader(array, meta['n_samples'])
+        else:
+            columns[key] = _slice_reader(array)
+    return meta, columns
+
+
+def _slice_reader(array):
+    return lambda start, stop: array[start:stop]
+
+
+def _bits_reader(packed, n_samples):
+    def read(start, stop):
+        stop = min(stop, n_samples)
+        bits = np.unpackbits(packed[start // 8:(stop + 7) // 8])
+        return bits[start % 8:start % 8 + (stop - start)].view(np.bool_)
+    return read
+
+
+def _read_csv_arrow(filepath_data, dtypes):
+    import pyarrow as pa
+    import pyarrow.csv
+
+    types = {key: pa.bool_() if dtype == np.bool_ else pa.from_numpy_dtype(dtype) for key, dtype in dtypes.items()}
+    table = pyarrow.csv.read_csv(
+        str(filepath_data),
+        read_options=pyarrow.csv.ReadOptions(use_threads=True),
+        convert_options=pyarrow.csv.ConvertOptions(
+            column_types=types, include_columns=list(types), true_values=TRUE_VALUES, false_values=FALSE_VALUES,
+        ),
+    )
+    ## Missing epoch values come back as object columns holding None, which
+    ##  validation reports like the NaN of pandas
+    return {key: table.column(key).to_numpy() for key in table.column_names}
+
+
+def _read_arrow_columns(filepath_data, fmt, neurons=None):
+    """
+    Read a Parquet or Feather file into a dict of numpy arrays.
+    Feather files are memory-mapped and single-chunk numeric columns without
+     nulls are returned as zero-copy views.
+    """
+    if fmt == 'feather':
+        import pyarrow.feather
+        table = pyarrow.feather.read_table(str(filepath_data), memory_map=True)
+    else:
+        import pyarrow.parquet
+        table = pyarrow.parquet.read_table(str(filepath_data), memory_map=True)
+    if neurons is not None:
+        table = table.select(select_columns(table.column_names, neurons))
+
+    import pyarrow as pa
+
+    data = {}
+    for key in table.column_names:
+        column = table.column(key)
+        is_numeric = pa.types.is_floating(column.type) or pa.types.is_integer(column.type)
+        if is_numeric and column.num_chunks == 1 and column.null_count == 0:
+            data[key] = column.chunk(0).to_numpy(zero_copy_only=True)
+        else:
+            data[key] = column.to_numpy()
+    return data
+
+
+def _iter_slices(meta, columns, chunk_size):
+    for start in range(0, meta['n_samples'], chunk_size):
+        stop = min(start + chunk_size, meta['n_samples'])
+        yield {key: _column_slice(column, start, stop) for key, column in columns.items()}
+
+
+def _column_slice(column, start, stop):
+    if callable(column):
+        return column(start, stop)
+    return column[start:stop]
@@ -0,0 +1,495 @@
+## Resident pipeline service
+##
+##     my-pipeline serve --params params.json --port 8765 --jobs 8
+##     my-pipeline submit data/session_01.csv --port 8765
+##
+## A long-lived process that keeps numpy, pandas, scipy, the parsed
+##  parameters files and the detection plans (detection.get_plan) loaded, so
+##  a finished session costs one local HTTP request instead of an
+##  interpreter start, the imports and the parameters parsing. It listens on
+##  localhost TCP or on a Unix socket.
+##
+## Endpoints (JSON in and out):
+##     POST /run       {"session": path, "params": path (optional), "chunk_size": int (optional)}
+##                      -> {"session", "counts", "error", "queue_time", "run_time", "latency"}
+##     GET  /metrics   queue depth, running jobs, job counts and latency percentiles
+##     GET  /health    {"status": "ok"}
+##
+## Jobs wait in a bounded queue for one of n_workers workers. When the queue
+##  is full the service answers 503 with a Retry-After header instead of
+##  queueing more (backpressure); Client.run retries with backoff.
+
+import collections
+import http.server
+import importlib
+import json
+import os
+import queue
+import socketserver
+import threading
+import time
+
+import numpy as np
+
+## Jobs waiting for a worker, per worker, when max_queue is not given
+QUEUE_PER_WORKER = 4
+## Jobs whose latency is kept for the percentiles of /metrics
+LATENCY_WINDOW = 1024
+PERCENTILES = [50, 90, 99]
+## Modules a session needs, imported once per worker process (see _warm_up)
+WARM_UP_MODULES = ['pandas', 'scipy.ndimage', 'scipy.signal', __package__ + '.batch', __package__ + '.pipeline', __package__ + '.readers']
+
+
+class ServiceBusy(RuntimeError):
+    """
+    The job queue of a PipelineService is full.
+    """
+
+
+class PipelineService:
+    """
+    Runs sessions (see batch.run_session) on a fixed set of workers fed by
+     a bounded queue, and keeps the metrics of the jobs.
+
+    Args:
+        filepath_parameters (str):
+            Default parameters JSON file of the jobs that do not name one.
+        executor (str):
+            'threads' runs the sessions in threads of this process;
+             'processes' (default) in a pool of worker processes, which are
+             started and warmed up (imports done) when the service starts.
+        n_workers (int):
+            Number of sessions run at the same time. If None,
+             os.cpu_count() is used.
+        max_queue (int):
+            Number of jobs that may wait for a worker before new jobs are
+             rejected. Default: QUEUE_PER_WORKER per worker.
+    """
+    def __init__(self, filepath_parameters=None, executor='processes', n_workers=None, max_queue=None):
+        ## Loaded once, and inherited by forked workers
+        importlib.import_module(__package__ + '.batch')
+        importlib.import_module(__package__ + '.pipeline')
+
+        if executor not in ['threads', 'processes']:
+            raise ValueError("executor must be 'threads' or 'processes', got: " + repr(executor))
+        self.filepath_parameters = filepath_parameters
+        self.executor = executor
+        self.n_workers = n_workers if n_workers is not None else (os.cpu_count() or 1)
+        self.max_queue = max_queue if max_queue is not None else QUEUE_PER_WORKER * self.n_workers
+        self._lock = threading.Lock()
+        self._parameters = {}
+        if filepath_parameters is not None:
+            self.parameters(filepath_parameters)
+
+        self._queue = queue.Queue()
+        ## Jobs accepted and not finished: queued or running
+        self._pending = 0
+        self._running = 0
+        self._counts = collections.Counter()
+        self._latencies = collections.deque(maxlen=LATENCY_WINDOW)
+        self._started = time.time()
+        self._closed = False
+
+        self._pool = None
+        if executor == 'processes':
+            from concurrent.futures import ProcessPoolExecutor
+            self._pool = ProcessPoolExecutor(max_workers=self.n_workers, initializer=_init_worker)
+            for future in [self._pool.submit(_warm_up) for _ in range(self.n_workers)]:
+                future.result()
+        self._workers = [threading.Thread(target=self._work, daemon=True) for _ in range(self.n_workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def parameters(self, filepath_parameters):
+        """
+        Parsed and validated parameters, cached until the file changes.
+
+        Raises:
+            ValueError:
+                If the file is invalid.
+        """
+        from . import validation
+        from .pipeline import load_parameters
+
+        path = os.path.realpath(str(filepath_parameters))
+        key = (path, os.stat(path).st_mtime_ns)
+        with self._lock:
+            parameters = self._parameters.get(key)
+        if parameters is None:
+            parameters = load_parameters(path)
+            errors = validation.validate_parameters(parameters)
+            if len(errors) > 0:
+                raise ValueError('; '.join(errors))
+            with self._lock:
+                self._parameters = {k: v for k, v in self._parameters.items() if k[0] != path}
+                self._parameters[key] = parameters
+        return parameters
+
+    def submit(self, session, filepath_parameters=None, chunk_size=None):
+        """
+        Queue one session.
+
+        Returns:
+            future (concurrent.futures.Future):
+                Resolves to the job result (see Client.run).
+
+        Raises:
+            ServiceBusy:
+                If every worker is busy and the queue is full.
+            ValueError:
+                If no parameters file is given, or it is invalid.
+        """
+        from concurrent.futures import Future
+
+        if self._closed:
+            raise RuntimeError('submit() called after close()')
+        filepath_parameters = filepath_parameters if filepath_parameters is not None else self.filepath_parameters
+        if filepath_parameters is None:
+            raise ValueError('No parameters file: pass "params" or start the service with one')
+        try:
+            parameters = self.parameters(filepath_parameters)
+        except OSError as ex:
+            raise ValueError('Cannot read parameters file ' + str(filepath_parameters) + ': ' + str(ex)) from None
+
+        future = Future()
+        job = (str(session), parameters, chunk_size, future, time.perf_counter())
+        with self._lock:
+            if self._pending >= self.n_workers + self.max_queue:
+                self._counts['rejected'] += 1
+                raise ServiceBusy(f'{self.n_workers} jobs running and {self.max_queue} queued')
+            self._pending += 1
+            self._counts['submitted'] += 1
+        self._queue.put(job)
+        return future
+
+    def _work(self):
+        from .batch import run_session
+
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            session, parameters, chunk_size, future, submitted = job
+            started = time.perf_counter()
+            with self._lock:
+                self._running += 1
+            try:
+                if future.set_running_or_notify_cancel():
+                    task = (session, parameters, chunk_size)
+                    if self._pool is not None:
+                        ns_conditions, error = self._pool.submit(run_session, task).result()
+                    else:
+                        ns_conditions, error = run_session(task)
+                    finished = time.perf_counter()
+                    result = {
+                        'session': session,
+                        'counts': ns_conditions,
+                        'error': error,
+                        'queue_time': started - submitted,
+                        'run_time': finished - started,
+                        'latency': finished - submitted,
+                    }
+                    with self._lock:
+                        self._counts['failed' if error is not None else 'completed'] += 1
+                        self._latencies.append((result['queue_time'], result['run_time'], result['latency']))
+                    future.set_result(result)
+            except Exception as ex:
+                with self._lock:
+                    self._counts['failed'] += 1
+                future.set_exception(ex)
+            finally:
+                with self._lock:
+                    self._running -= 1
+                    self._pending -= 1
+
+    def metrics(self):
+        """
+        Current state of the service.
+
+        Returns:
+            metrics (dict):
+                'queue_depth' (jobs waiting for a worker), 'running',
+                 'workers', 'max_queue', the numbers of jobs 'submitted',
+                 'completed', 'failed' (the session failed) and 'rejected'
+                 (queue full), 'uptime' (s), and for the last LATENCY_WINDOW
+                 jobs the mean, percentiles and maximum of 'queue_time',
+                 'run_time' and 'latency' (s).
+        """
+        with self._lock:
+            latencies = np.array(self._latencies, dtype=np.float64).reshape(-1, 3)
+            metrics = {
+                'queue_depth': self._pending - self._running,
+                'running': self._running,
+                'workers': self.n_workers,
+                'max_queue': self.max_queue,
+                'executor': self.executor,
+                'uptime': time.time() - self._started,
+            }
+            metrics.update({key: self._counts[key] for key in ['submitted', 'completed', 'failed', 'rejected']})
+        for jj, name in enumerate(['queue_time', 'run_time', 'latency']):
+            values = latencies[:, jj]
+            stats = {'n': len(values)}
+            if len(values) > 0:
+                stats['mean'] = float(values.mean())
+                stats.update({f'p{q}': float(v) for q, v in zip(PERCENTILES, np.percentile(values, PERCENTILES))})
+                stats['max'] = float(values.max())
+            metrics[name] = stats
+        return metrics
+
+    def close(self):
+        """
+        Stop the workers once the queued jobs are done.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        if self._pool is not None:
+            self._pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _init_worker():
+    import signal
+
+    ## Ctrl-C stops the service, which shuts the workers down itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _warm_up()
+
+
+def _warm_up():
+    ## Imports everything a session needs, once per worker process
+    for name in WARM_UP_MODULES:
+        importlib.import_module(name)
+
+
+def make_server(service, address):
+    """
+    HTTP server of a PipelineService; call serve_forever() to run it.
+
+    Args:
+        service (PipelineService):
+            Service the requests are passed to.
+        address (tuple or str):
+            (host, port) to listen on (port 0 picks a free one, see
+             server.server_address), or the filepath of a Unix socket.
+    """
+    handler = type('Handler', (_Handler,), {'service': service})
+    if isinstance(address, (str, os.PathLike)):
+        address = str(address)
+        if os.path.exists(address):
+            os.unlink(address)
+        return _UnixHTTPServer(address, handler)
+    return http.server.ThreadingHTTPServer(tuple(address), handler)
+
+
+def serve(address, filepath_parameters=None, executor='processes', n_workers=None, max_queue=None):
+    """
+    Run a PipelineService on address until interrupted (Ctrl-C or SIGTERM,
+     see make_server).
+    """
+    import signal
+    import sys
+
+    ## SIGTERM (e.g. from a process supervisor) stops like Ctrl-C, so the
+    ##  worker processes are shut down instead of orphaned
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    with PipelineService(filepath_parameters, executor=executor, n_workers=n_workers, max_queue=max_queue) as service:
+        server = make_server(service, address)
+        where = address if isinstance(address, str) else 'http://%s:%d' % server.server_address[:2]
+        print(f'my-pipeline: serving on {where} with {service.n_workers} {executor} workers, queue of {service.max_queue}',
+              file=sys.stderr, flush=True)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            if isinstance(address, str) and os.path.exists(address):
+                os.unlink(address)
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        socketserver.UnixStreamServer.server_bind(self)
+        self.server_name, self.server_port = 'localhost', 0
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    service = None
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.path == '/health':
+            self._reply(200, {'status': 'ok'})
+        elif self.path == '/metrics':
+            self._reply(200, self.service.metrics())
+        else:
+            self._reply(404, {'error': 'Unknown path ' + self.path})
+
+    def do_POST(self):
+        if self.path != '/run':
+            self._reply(404, {'error': 'Unknown path ' + self.path})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            if not isinstance(request, dict) or not isinstance(request.get('session'), str):
+                raise ValueError('Expected a JSON object with a "session" filepath')
+            chunk_size = request.get('chunk_size')
+            if chunk_size is not None and (not isinstance(chunk_size, int) or chunk_size < 1):
+                raise ValueError('"chunk_size" must be a positive integer, got: ' + repr(chunk_size))
+            future = self.service.submit(request['session'], request.get('params'), chunk_size)
+        except ServiceBusy as ex:
+            self._reply(503, {'error': str(ex)}, {'Retry-After': '1'})
+            return
+        except ValueError as ex:
+            self._reply(400, {'error': str(ex)})
+            return
+        self._reply(200, future.result())
+
+    def _reply(self, status, body, headers=None):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        ## Requests are counted in /metrics instead of logged one by one
+        pass
+
+
+class Client:
+    """
+    Client of a running service (see serve), keeping one connection open.
+
+    Args:
+        address (tuple or str):
+            (host, port) of the service, or the filepath of its Unix socket.
+        timeout (float):
+            Socket timeout in seconds (None: wait for as long as a job takes).
+    """
+    def __init__(self, address, timeout=None):
+        self.address = address
+        self.timeout = timeout
+        self._connection = None
+
+    def run(self, session, filepath_parameters=None, chunk_size=None, retries=10, backoff=0.05):
+        """
+        Run one session on the service.
+
+        Args:
+            session (str):
+                Filepath of the data file, as seen by the service.
+            filepath_parameters (str):
+                Parameters JSON file; default: the one the service was
+                 started with.
+            chunk_size (int):
+                Stream the session in blocks of chunk_size rows (see
+                 pipeline()).
+            retries (int):
+                Number of times a job rejected because the service is busy
+                 is resubmitted, waiting backoff, 2 * backoff, ... seconds
+                 (at most the Retry-After of the service) in between.
+
+        Returns:
+            result (dict):
+                'session', 'counts' (spike counts per condition, or None if
+                 the session failed), 'error' (error message or None), and
+                 'queue_time', 'run_time' and 'latency' (s, on the service).
+
+        Raises:
+            ServiceBusy:
+                If the service is still busy after the retries.
+            ValueError:
+                If the service rejected the request (e.g. invalid parameters).
+        """
+        request = {'session': os.path.abspath(str(session))}
+        if filepath_parameters is not None:
+            request['params'] = os.path.abspath(str(filepath_parameters))
+        if chunk_size is not None:
+            request['chunk_size'] = int(chunk_size)
+        for attempt in range(retries + 1):
+            status, body, headers = self._request('POST', '/run', request)
+            if status != 503:
+                break
+            if attempt < retries:
+                time.sleep(min(backoff * 2 ** attempt, float(headers.get('Retry-After', 1))))
+        if status == 503:
+            raise ServiceBusy(body['error'])
+        if status != 200:
+            raise ValueError(body['error'])
+        return body
+
+    def metrics(self):
+        """
+        Metrics of the service (see PipelineService.metrics).
+        """
+        return self._request('GET', '/metrics')[1]
+
+    def health(self):
+        return self._request('GET', '/health')[1]
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _request(self, method, path, body=None):
+        import http.client
+
+        payload = json.dumps(body).encode() if body is not None else None
+        headers = {'Content-Type': 'application/json'} if payload is not None else {}
+        for attempt in range(2):
+            if self._connection is None:
+                self._connection = self._connect()
+            sent = False
+            try:
+                self._connection.request(method, path, body=payload, headers=headers)
+                sent = True
+                response = self._connection.getresponse()
+                return response.status, json.loads(response.read()), dict(response.getheaders())
+            except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+                ## The server closed the connection (e.g. an idle keep-alive
+                ##  one): reconnect once. A request that was sent may have
+                ##  been received, so only a GET is sent again: resending
+                ##  POST /run could run the job twice.
+                self.close()
+                if attempt == 1 or (sent and method != 'GET'):
+                    raise
+
+    def _connect(self):
+        import http.client
+        import socket
+
+        if not isinstance(self.address, (str, os.PathLike)):
+            return http.client.HTTPConnection(*self.address, timeout=self.timeout)
+        filepath_socket = str(self.address)
+
+        class UnixHTTPConnection(http.client.HTTPConnection):
+            def connect(self):
+                self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                if self.timeout is not None:
+                    self.sock.settimeout(self.timeout)
+                self.sock.connect(filepath_socket)
+        return UnixHTTPConnection('localhost', timeout=self.timeout)
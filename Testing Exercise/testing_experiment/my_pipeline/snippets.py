@@ -0,0 +1,280 @@
+## Spike waveform snippets and per-spike features
+##
+## The snippets of all spikes are gathered at once from a strided window
+##  view of the (n_samples, n_neurons) traces (np.lib.stride_tricks.
+##  sliding_window_view): the traces are never copied or padded, and each
+##  block of spikes is one fancy-indexing gather into the output, which can
+##  be a memory-mapped .npy file when there are many spikes. Features are
+##  computed on whole blocks of snippets with array operations.
+
+import numpy as np
+
+from . import detection, spikes
+
+## Ways to cut the snippets of spikes closer to the edges of the recording
+##  than the window:
+##     - 'fill': samples outside of the recording are fill_value (NaN)
+##     - 'nearest': they repeat the first or last sample
+##     - 'drop': those spikes get no snippet
+EDGES = ['fill', 'nearest', 'drop']
+## Per-spike features of snippet_features
+FEATURES = ['amplitude', 'half_width', 'trough', 'trough_delay']
+## Spikes gathered (or featurized) at a time, which bounds the temporaries
+BLOCK_SPIKES = 2 ** 16
+## Snippets larger than this many bytes go to the spill file, if one is given
+SPILL_BYTES = 2 ** 28
+
+
+class Snippets:
+    """
+    Waveform snippets of a set of spikes, one row per spike, stored
+     neuron after neuron like SpikeTrains: the snippets of neuron ii are
+     waveforms[offsets[ii]:offsets[ii + 1]].
+
+    Args:
+        waveforms (np.ndarray or np.memmap, shape (n_spikes, before + 1 + after)):
+            Trace around every spike; the spike is at column before.
+        spike_times (1-D array of int):
+            Sample index of every spike, neuron after neuron.
+        offsets (1-D array of int, shape (n_neurons + 1,)):
+            Start of each neuron's spikes, plus the total number of spikes.
+        neurons (list of str):
+            Name of each neuron.
+        before (int):
+            Samples before the spike in every snippet.
+    """
+    __slots__ = ('waveforms', 'spike_times', 'offsets', 'neurons', 'before')
+
+    def __init__(self, waveforms, spike_times, offsets, neurons, before):
+        self.waveforms = waveforms
+        self.spike_times = np.asarray(spike_times)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.neurons = tuple(str(key) for key in neurons)
+        self.before = int(before)
+
+    @property
+    def after(self):
+        return self.waveforms.shape[1] - self.before - 1
+
+    @property
+    def nbytes(self):
+        return self.waveforms.nbytes
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, key):
+        """
+        Snippets of one neuron, by position or name, as a view of waveforms.
+        """
+        ii = self.neurons.index(key) if isinstance(key, str) else key
+        if ii < 0:
+            ii += len(self)
+        if not 0 <= ii < len(self):
+            raise IndexError('Neuron index out of range: ' + str(key))
+        return self.waveforms[self.offsets[ii]:self.offsets[ii + 1]]
+
+    def __repr__(self):
+        return (
+            f'Snippets(n_neurons={len(self)}, n_spikes={len(self.waveforms)},'
+            f' before={self.before}, after={self.after})'
+        )
+
+    def spike_trains(self):
+        """
+        The spikes that have a snippet, as a spikes.SpikeTrains.
+        """
+        return spikes.SpikeTrains(self.spike_times, self.offsets, self.neurons)
+
+    def features(self):
+        """
+        Features of every snippet (see snippet_features), computed block by
+         block so that spilled waveforms are never loaded at once.
+
+        Returns:
+            features (dict):
+                One 1-D array of n_spikes values per name in FEATURES.
+        """
+        n_spikes = len(self.waveforms)
+        result = {
+            'amplitude': np.empty(n_spikes, dtype=np.float64),
+            'half_width': np.empty(n_spikes, dtype=np.float64),
+            'trough': np.empty(n_spikes, dtype=np.float64),
+            'trough_delay': np.empty(n_spikes, dtype=np.int64),
+        }
+        for start in range(0, n_spikes, BLOCK_SPIKES):
+            block = snippet_features(self.waveforms[start:start + BLOCK_SPIKES], self.before)
+            for key in FEATURES:
+                result[key][start:start + BLOCK_SPIKES] = block[key]
+        return result
+
+
+def extract_snippets(traces, spike_trains, before, after, edge='fill', fill_value=np.nan, spill=None, spill_bytes=SPILL_BYTES):
+    """
+    Cut the trace around every spike.
+
+    Args:
+        traces (array-like, shape (n_samples, n_neurons), or QuantizedTraces):
+            Raw traces (detection.traces_matrix) or smoothed ones
+             (SpikeDetector.smooth), in the neuron order of spike_trains.
+             int16 traces are calibrated to float32.
+        spike_trains (spikes.SpikeTrains):
+            Spikes to cut, e.g. from pipeline(..., return_spikes=True).
+        before, after (int):
+            Samples kept before and after every spike.
+        edge (str):
+            How spikes closer to the edges of the recording than the window
+             are handled, one of EDGES.
+        fill_value (float):
+            Value of the samples outside of the recording with edge='fill'.
+        spill (str):
+            If given, snippets larger than spill_bytes are written to a
+             memory-mapped .npy file at this filepath instead of memory
+             (np.load(spill, mmap_mode='r') reopens it).
+        spill_bytes (int):
+            See spill.
+
+    Returns:
+        snippets (Snippets):
+            float64 waveforms for float64 or integer traces, float32 for
+             float32 and int16 ones.
+    """
+    if edge not in EDGES:
+        raise ValueError('edge must be one of ' + str(EDGES) + ', got: ' + repr(edge))
+    if before < 0 or after < 0:
+        raise ValueError(f'before and after must be >= 0, got: {before}, {after}')
+    quantized = isinstance(traces, detection.QuantizedTraces)
+    values = traces.counts if quantized else np.asarray(traces)
+    if values.ndim == 1:
+        values = values.reshape(-1, 1)
+    n_samples, n_neurons = values.shape
+    if n_neurons != len(spike_trains):
+        raise ValueError(f'Expected traces of {len(spike_trains)} neurons, got: {n_neurons}')
+    if quantized:
+        dtype = np.dtype(np.float32)
+    else:
+        dtype = values.dtype if values.dtype in (np.float32, np.float64) else np.dtype(np.float64)
+    window = before + after + 1
+
+    spike_times = spike_trains.spike_times
+    neuron_ids = spike_trains.neuron_ids()
+    inside = (spike_times >= before) & (spike_times < n_samples - after)
+    offsets = spike_trains.offsets
+    if edge == 'drop':
+        spike_times, neuron_ids = spike_times[inside], neuron_ids[inside]
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(neuron_ids, minlength=n_neurons))]).astype(np.int64)
+        inside = np.ones(len(spike_times), dtype=np.bool_)
+
+    n_spikes = len(spike_times)
+    if spill is not None and n_spikes * window * dtype.itemsize > spill_bytes:
+        waveforms = np.lib.format.open_memmap(str(spill), mode='w+', dtype=dtype, shape=(n_spikes, window))
+    else:
+        waveforms = np.empty((n_spikes, window), dtype=dtype)
+
+    ## (n_samples - window + 1, n_neurons, window) view: row t is the window
+    ##  starting at sample t of every neuron
+    view = np.lib.stride_tricks.sliding_window_view(values, window, axis=0) if n_samples >= window else None
+    lags = np.arange(-before, after + 1)
+    for start in range(0, n_spikes, BLOCK_SPIKES):
+        stop = min(start + BLOCK_SPIKES, n_spikes)
+        times = spike_times[start:stop].astype(np.int64)
+        ids = neuron_ids[start:stop]
+        ok = inside[start:stop]
+        block = waveforms[start:stop]
+        if ok.all():
+            block[:] = view[times - before, ids]
+            outside = None
+        else:
+            if ok.any():
+                block[ok] = view[times[ok] - before, ids[ok]]
+            ## Few spikes are at the edges: their indices are clipped to the
+            ##  recording ('nearest'), then filled
+            positions = times[~ok, None] + lags
+            block[~ok] = values[np.clip(positions, 0, n_samples - 1), ids[~ok, None]]
+            outside = (positions < 0) | (positions >= n_samples)
+        if quantized:
+            block *= traces.scale[ids, None]
+            block += traces.offset[ids, None]
+        if edge == 'fill' and outside is not None:
+            edge_rows = block[~ok]
+            edge_rows[outside] = fill_value
+            block[~ok] = edge_rows
+    if isinstance(waveforms, np.memmap):
+        waveforms.flush()
+    return Snippets(waveforms, spike_times, offsets, spike_trains.neurons, before)
+
+
+def snippet_features(waveforms, before):
+    """
+    Vectorized features of snippets whose spike is at column before:
+        - 'amplitude': value at the spike.
+        - 'half_width': width (samples, interpolated) of the spike at half
+           its prominence, as scipy.signal.peak_widths(snippet, [before])
+           with the default rel_height=0.5.
+        - 'trough': minimum from the spike to the end of the snippet.
+        - 'trough_delay': samples from the spike to the trough (first one).
+    NaN samples (edge='fill') end the snippet, so the features of a spike at
+     the edge are those of the part of its snippet inside the recording.
+
+    Args:
+        waveforms (np.ndarray, shape (n_spikes, window)):
+            Snippets, see extract_snippets.
+        before (int):
+            Column of the spike.
+
+    Returns:
+        features (dict):
+            One 1-D array of n_spikes values per name in FEATURES.
+    """
+    x = np.asarray(waveforms, dtype=np.float64)
+    peak = x[:, before]
+    ## Both sides, ordered from the spike outwards (column 0 is the spike)
+    left = x[:, before::-1]
+    right = x[:, before:]
+
+    ## Prominence (scipy.signal.peak_prominences): on each side, the lowest
+    ##  sample before one higher than the spike (or the end of the snippet)
+    bases = [_side_base(side, peak) for side in (left, right)]
+    prominence = peak - np.maximum(bases[0][1], bases[1][1])
+    height = peak - prominence * 0.5
+
+    ## Half-width (scipy.signal.peak_widths): first sample at or below height
+    ##  going outwards, not beyond the base, then interpolated
+    k_left, fraction_left = _side_crossing(left, height, bases[0][0])
+    k_right, fraction_right = _side_crossing(right, height, bases[1][0])
+    left_ip = (before - k_left) + fraction_left
+    right_ip = (before + k_right) - fraction_right
+
+    trough_delay = np.argmin(np.where(np.isnan(right), np.inf, right), axis=1)
+    return {
+        'amplitude': peak,
+        'half_width': right_ip - left_ip,
+        'trough': right[np.arange(len(right)), trough_delay],
+        'trough_delay': trough_delay,
+    }
+
+
+def _side_base(side, peak):
+    ## Returns the position (from the spike) and value of the base of a side
+    n_spikes, length = side.shape
+    blocked = (side > peak[:, None]) | np.isnan(side)
+    blocked[:, 0] = False
+    stop = np.where(blocked.any(axis=1), np.argmax(blocked, axis=1), length)
+    searched = np.where(np.arange(length) < stop[:, None], side, np.inf)
+    position = np.argmin(searched, axis=1)
+    return position, searched[np.arange(n_spikes), position]
+
+
+def _side_crossing(side, height, base):
+    ## Distance from the spike of the first sample of a side at or below
+    ##  height (or the base), and the fraction of a sample towards the spike
+    ##  at which the side crosses height
+    rows = np.arange(len(side))
+    reached = ~(height[:, None] < side) | (np.arange(side.shape[1]) >= base[:, None])
+    k = np.argmax(reached, axis=1)
+    value = side[rows, k]
+    toward = side[rows, np.maximum(k - 1, 0)]
+    below = value < height
+    fraction = np.zeros(len(side))
+    fraction[below] = (height[below] - value[below]) / (toward[below] - value[below])
+    return k, fraction
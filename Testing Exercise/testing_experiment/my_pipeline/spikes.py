@@ -0,0 +1,186 @@
+## Compact spike-train container
+
+import numpy as np
+
+from . import conditions
+
+
+class SpikeTrains:
+    """
+    Spike times of a set of neurons, stored CSR-style in two flat arrays
+     instead of a list of per-neuron arrays.
+    The spikes of neuron ii are spike_times[offsets[ii]:offsets[ii + 1]], so
+     indexing a neuron returns a view and the spikes of all neurons can be
+     histogrammed without concatenating anything.
+
+    Args:
+        spike_times (1-D array of int):
+            Sample index of every spike, neuron after neuron. Stored as int32
+             when every index fits, int64 otherwise.
+        offsets (1-D array of int, shape (n_neurons + 1,)):
+            Start of each neuron's spikes in spike_times, plus the total
+             number of spikes.
+        neurons (list of str):
+            Name of each neuron. If None, neurons are named by position.
+        n_samples (int):
+            Length of the recording, if known.
+    """
+    __slots__ = ('spike_times', 'offsets', 'neurons', 'n_samples')
+
+    def __init__(self, spike_times, offsets, neurons=None, n_samples=None):
+        spike_times = np.asarray(spike_times)
+        offsets = np.asarray(offsets, dtype=np.int64)
+        if offsets.ndim != 1 or len(offsets) == 0 or offsets[0] != 0 or offsets[-1] != len(spike_times) or np.any(np.diff(offsets) < 0):
+            raise ValueError('offsets must start at 0, be non-decreasing and end at len(spike_times)')
+        if neurons is None:
+            neurons = [str(ii) for ii in range(len(offsets) - 1)]
+        if len(neurons) != len(offsets) - 1:
+            raise ValueError('Expected ' + str(len(offsets) - 1) + ' neuron names, got: ' + str(len(neurons)))
+
+        self.spike_times = spike_times.astype(_index_dtype(spike_times, n_samples), copy=False)
+        self.offsets = offsets
+        self.neurons = tuple(str(key) for key in neurons)
+        self.n_samples = None if n_samples is None else int(n_samples)
+
+    @classmethod
+    def from_list(cls, spike_times, neurons=None, n_samples=None):
+        """
+        Build from a list of per-neuron spike index arrays (e.g. the output
+         of parallel.detect_spikes).
+        """
+        counts = [len(st) for st in spike_times]
+        offsets = np.concatenate([[0], np.cumsum(counts, dtype=np.int64)])
+        flat = np.concatenate(spike_times) if len(spike_times) > 0 else np.empty(0, dtype=np.int64)
+        return cls(flat.astype(np.int64, copy=False), offsets, neurons, n_samples)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, key):
+        """
+        Spike times of one neuron, by position or name. The result is a
+         view of spike_times, not a copy.
+        """
+        ii = self.neurons.index(key) if isinstance(key, str) else key
+        if ii < 0:
+            ii += len(self)
+        if not 0 <= ii < len(self):
+            raise IndexError('Neuron index out of range: ' + str(key))
+        return self.spike_times[self.offsets[ii]:self.offsets[ii + 1]]
+
+    def __iter__(self):
+        for ii in range(len(self)):
+            yield self[ii]
+
+    def __repr__(self):
+        return 'SpikeTrains(n_neurons=' + str(len(self)) + ', n_spikes=' + str(len(self.spike_times)) + ')'
+
+    def __eq__(self, other):
+        if not isinstance(other, SpikeTrains):
+            return NotImplemented
+        return (
+            self.neurons == other.neurons
+            and self.n_samples == other.n_samples
+            and np.array_equal(self.offsets, other.offsets)
+            and np.array_equal(self.spike_times, other.spike_times)
+        )
+
+    def counts(self):
+        """
+        Number of spikes of each neuron, as an int64 array.
+        """
+        return np.diff(self.offsets)
+
+    def condition_counts(self, codes, conditions_list=conditions.CONDITIONS):
+        """
+        Number of spikes, summed across neurons, for each condition.
+
+        Args:
+            codes (np.ndarray of uint8):
+                Epoch code of every sample (see conditions.epoch_codes).
+            conditions_list (list of str):
+                Conditions to count (see conditions.count_conditions).
+
+        Returns:
+            ns_conditions (dict):
+                Same output as pipeline().
+        """
+        return conditions.count_conditions(conditions.code_histogram(self.spike_times, codes), conditions_list)
+
+    def neuron_ids(self):
+        """
+        Neuron (position) of every spike in spike_times.
+        """
+        return np.repeat(np.arange(len(self), dtype=np.int32), self.counts())
+
+    def breakdown(self, trial_on, reward_on, light_on, conditions_list=conditions.CONDITIONS):
+        """
+        Per-neuron condition counts and per-trial counts, from the spike
+         indices already detected. Each spike's neuron and epoch code are
+         looked up once; no detection is rerun.
+
+        Args:
+            trial_on, reward_on, light_on (1-D array-like of bool):
+                Epoch columns of the recording.
+            conditions_list (list of str):
+                Conditions to count (see conditions.count_conditions).
+
+        Returns:
+            ns_conditions (pandas.DataFrame):
+                Number of spikes of each neuron (rows) during each condition
+                 (columns). Its column sums are the output of pipeline().
+            ns_trials (pandas.DataFrame):
+                Number of spikes of each neuron (rows) during each trial
+                 (columns), a trial being a contiguous run of trial_on. The
+                 'start' and 'stop' sample of every trial are in
+                 ns_trials.attrs['start'] and ns_trials.attrs['stop'].
+        """
+        import pandas as pd
+
+        neuron_ids = self.neuron_ids()
+        codes = conditions.epoch_codes(trial_on, reward_on, light_on)
+        histograms = conditions.neuron_code_histogram(self.spike_times, neuron_ids, codes, len(self))
+        ns_conditions = pd.DataFrame(
+            conditions.count_conditions_matrix(histograms, conditions_list),
+            index=pd.Index(self.neurons, name='neuron'),
+            columns=list(conditions_list),
+        )
+
+        starts, stops = conditions.trial_bounds(trial_on)
+        ns_trials = pd.DataFrame(
+            conditions.count_trials(self.spike_times, neuron_ids, starts, stops, len(self)),
+            index=pd.Index(self.neurons, name='neuron'),
+            columns=pd.RangeIndex(len(starts), name='trial'),
+        )
+        ns_trials.attrs['start'] = starts
+        ns_trials.attrs['stop'] = stops
+        return ns_conditions, ns_trials
+
+    def save(self, filepath):
+        """
+        Write to a .npz file (uncompressed, so it loads without decoding).
+        """
+        np.savez(
+            filepath,
+            spike_times=self.spike_times,
+            offsets=self.offsets,
+            neurons=np.array(self.neurons, dtype=str),
+            n_samples=np.int64(-1 if self.n_samples is None else self.n_samples),
+        )
+
+    @classmethod
+    def load(cls, filepath):
+        """
+        Read a .npz file written by save().
+        """
+        with np.load(filepath, allow_pickle=False) as f:
+            n_samples = int(f['n_samples'])
+            return cls(f['spike_times'], f['offsets'], list(f['neurons']), None if n_samples < 0 else n_samples)
+
+
+def _index_dtype(spike_times, n_samples):
+    """
+    int32 if every spike index (or the recording length, when known) fits, else int64.
+    """
+    limit = n_samples if n_samples is not None else (int(spike_times.max()) + 1 if len(spike_times) > 0 else 0)
+    return np.dtype(np.int32) if limit <= np.iinfo(np.int32).max else np.dtype(np.int64)
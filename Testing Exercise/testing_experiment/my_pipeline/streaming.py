@@ -0,0 +1,410 @@
+## Chunked (streaming) spike detection
+
+from collections import namedtuple
+
+import numpy as np
+
+from . import conditions, detection, spikes, validation
+
+## What stream_spikes yields after every block
+SpikeUpdate = namedtuple('SpikeUpdate', [
+    'spike_times', ## list of np.ndarray: spikes of each neuron finalized by the block
+    'counts', ## dict: running number of spikes per condition (see StreamingDetector.counts)
+    'n_samples', ## number of samples received so far
+])
+
+
+class StreamingDetector:
+    """
+    Chunk-by-chunk equivalent of count_spikes for a set of neurons.
+    Samples are pushed in blocks of any size, and spike times are emitted as
+     soon as later samples can no longer change them. Only the state that
+     later results depend on is kept between blocks:
+        - the last raw samples (a few filter windows), so that the
+           Savitzky-Golay filter of the next block sees the same inputs as a
+           filter over the full trace would, including the polynomial fits
+           at both ends of the recording.
+        - the last smoothed sample, which tells whether the next one is on a
+           rising edge, and for a flat top above threshold that reaches the
+           end of the block only its first sample and value: the peak is in
+           its middle, found when the value changes.
+        - the epoch codes from the earliest sample a later spike can be at,
+           as runs of equal codes.
+        - the candidate peaks that may still suppress, or be suppressed by, a
+           peak less than `distance` samples away in the next block.
+    Memory is therefore bounded by the block size, not the recording length
+     (during a flat top, such as a saturated channel, the epoch codes grow by
+     one run per change of epoch).
+     Every step works on all neurons at once (see detection.py), so the cost
+     of a block grows with its number of samples, not with the number of
+     per-neuron calls.
+    A spike at sample p is emitted by the first push() that brings the
+     recording to at least p + latency samples, where latency is half a
+     filter window plus `distance` (longer only if the peak has a flat top).
+    The emitted spike times are identical to count_spikes on the full trace,
+     except for two peaks of exactly equal height within `distance` of each
+     other. This class keeps the later one (a stable ranking of heights).
+     find_peaks ranks them with an unstable sort of all the peaks of the
+     neuron, and which of them it keeps depends on the rest of the recording,
+     so no block-by-block detector can match it. Ties are rare on float
+     traces but common on integer ones (e.g. ADC counts), on which the
+     results of this class and of pipeline() without chunk_size can differ
+     by a few spikes per 10^4.
+
+    Args:
+        n_neurons (int):
+            Number of traces (columns) in every pushed block.
+        sample_rate (float):
+            Frequency at which data samples were collected.
+        threshold (float):
+            Voltage above which the voltage must reach to be considered a valid spike.
+    """
+    def __init__(self, n_neurons, sample_rate, threshold):
+        self.plan = detection.get_plan(float(sample_rate), float(threshold))
+        if self.plan.distance < 1:
+            raise ValueError('`distance` must be greater or equal to 1')
+
+        self.n_neurons = int(n_neurons)
+        self.threshold = threshold
+        self.window_length = self.plan.window_length
+        self.distance = int(np.ceil(self.plan.distance))
+        ## Raw samples kept on each side of the samples being smoothed: every
+        ##  filter output depends on at most window_length // 2 samples on
+        ##  either side (plus one for the off-centre even windows).
+        self.context = self.window_length // 2 + 1
+        ## Samples after a (sharp) peak until it is emitted
+        self.latency = self.context + self.distance + 1
+
+        ## Running spike counts per neuron and epoch code (see conditions.py)
+        self.histogram = np.zeros((self.n_neurons, conditions.N_CODES), dtype=np.int64)
+        self.n_samples = 0
+        self.finished = False
+
+        self._raw = np.empty((0, self.n_neurons), dtype=np.float64)
+        self._raw_start = 0
+        self._n_smoothed = 0
+        ## Epoch codes as runs: the code of sample t is
+        ##  _code_values[searchsorted(_code_starts, t, side='right') - 1]
+        self._code_starts = np.empty(0, dtype=np.int64)
+        self._code_values = np.empty(0, dtype=np.uint8)
+        ## Last smoothed sample of all neurons (no row before the first one)
+        self._smooth = np.empty((0, self.n_neurons), dtype=np.float64)
+        self._smooth_start = 0
+        ## First sample and value of the flat top above threshold that each
+        ##  neuron is on, if it was reached by a rising edge (-1 otherwise)
+        self._plateau_left = np.full(self.n_neurons, -1, dtype=np.int64)
+        self._plateau_value = np.zeros(self.n_neurons, dtype=np.float64)
+        ## Unresolved candidate peaks of all neurons, sorted by neuron then sample
+        self._pending = _empty_candidates()
+
+    def push(self, traces, codes=None):
+        """
+        Add a block of samples.
+
+        Args:
+            traces (array-like, shape (n_samples, n_neurons)):
+                Voltage of each neuron for the new samples. A 1-D array is
+                 accepted when there is a single neuron.
+            codes (1-D array of uint8):
+                Epoch code of each new sample (see conditions.epoch_codes).
+                If None, every sample gets code 0 (no epoch on).
+
+        Returns:
+            spike_times (list of np.ndarray):
+                For each neuron, the (global) sample indices of the spikes
+                 that were finalized by this block.
+        """
+        if self.finished:
+            raise RuntimeError('push() called after finish()')
+        traces = np.asarray(traces, dtype=np.float64)
+        if traces.ndim == 1:
+            traces = traces[:, None]
+        if traces.ndim != 2 or traces.shape[1] != self.n_neurons:
+            raise ValueError('Expected a block of shape (n_samples, ' + str(self.n_neurons) + '), got: ' + str(traces.shape))
+        if codes is None:
+            codes = np.zeros(len(traces), dtype=np.uint8)
+        elif len(codes) != len(traces):
+            raise ValueError('codes and traces must have the same number of samples')
+
+        self._raw = np.concatenate([self._raw, traces])
+        self._append_codes(np.asarray(codes, dtype=np.uint8))
+        self.n_samples += len(traces)
+        return self._advance(final=False)
+
+    def finish(self):
+        """
+        Signal the end of the recording and flush all remaining spikes.
+
+        Returns:
+            spike_times (list of np.ndarray):
+                For each neuron, the spikes that were still pending.
+        """
+        if self.finished:
+            raise RuntimeError('finish() called twice')
+        spike_times = self._advance(final=True)
+        self.finished = True
+        return spike_times
+
+    def counts(self, conditions_list=conditions.CONDITIONS):
+        """
+        Running number of spikes, summed across neurons, per condition.
+        """
+        return conditions.count_conditions(self.histogram.sum(axis=0), conditions_list)
+
+    def _advance(self, final):
+        ## Smooth every sample whose filter output can no longer change
+        ##  (the first window_length // 2 outputs are fitted to the first
+        ##  window, so nothing is final before a full window has arrived).
+        if final:
+            n_smoothed = self.n_samples
+        elif self.n_samples >= self.window_length:
+            n_smoothed = max(self.n_samples - self.context, self._n_smoothed)
+        else:
+            n_smoothed = self._n_smoothed
+        if n_smoothed > self._n_smoothed:
+            slice_start = max(0, self._n_smoothed - self.context)
+            raw = self._raw[slice_start - self._raw_start:]
+            smoothed = detection.savgol_smooth(raw, self.plan, fit_start=(slice_start == 0), fit_end=final)
+            smoothed = smoothed[self._n_smoothed - slice_start:n_smoothed - slice_start]
+            self._n_smoothed = n_smoothed
+            keep_from = max(0, n_smoothed - self.context)
+            self._raw = self._raw[keep_from - self._raw_start:]
+            self._raw_start = keep_from
+        else:
+            smoothed = np.empty((0, self.n_neurons), dtype=np.float64)
+
+        seg = np.concatenate([self._smooth, smoothed])
+        seg_start = self._smooth_start
+
+        ## Local maxima of all neurons. Every one of them has its rising and
+        ##  falling edges inside seg, so it is new and final.
+        peaks, columns, heights = detection.local_maxima_batched(seg, self.threshold)
+        positions = peaks + seg_start
+        candidates = _merge_candidates(self._pending, (positions, columns, heights, self._code_at(positions)))
+
+        ## Flat tops carried from earlier blocks end at the first sample of
+        ##  another value (seg[0] is their last known sample); they are
+        ##  peaks if that sample is lower.
+        on_plateau = np.flatnonzero(self._plateau_left >= 0)
+        if len(on_plateau) > 0 and len(seg) > 1:
+            values = self._plateau_value[on_plateau]
+            differs = seg[1:, on_plateau] != values
+            ended = differs.any(axis=0)
+            right = np.argmax(differs, axis=0)[ended] + 1
+            columns = on_plateau[ended]
+            is_peak = seg[right, columns] < values[ended]
+            columns = columns[is_peak]
+            positions = (self._plateau_left[columns] + seg_start + right[is_peak] - 1) // 2
+            candidates = _merge_candidates(candidates, (positions, columns, self._plateau_value[columns], self._code_at(positions)))
+            self._plateau_left[on_plateau[ended]] = -1
+
+        if final:
+            ## A flat top reaching the last sample is not a peak
+            self._plateau_left[:] = -1
+            next_peak = np.full(self.n_neurons, np.iinfo(np.int64).max // 2, dtype=np.int64)
+        else:
+            if len(seg) > 0:
+                last = len(seg) - 1
+                left, is_plateau = _trailing_plateaus(seg, self.threshold)
+                self._plateau_left[is_plateau] = seg_start + left[is_plateau]
+                self._plateau_value[is_plateau] = seg[last, is_plateau]
+                self._smooth = seg[last:].copy()
+                self._smooth_start = seg_start + last
+            ## Peaks found later are after the last smoothed sample, or in
+            ##  the middle of a flat top that goes on after it
+            next_peak = np.full(self.n_neurons, self._smooth_start + 1, dtype=np.int64)
+            on_plateau = self._plateau_left >= 0
+            next_peak[on_plateau] = (self._plateau_left[on_plateau] + self._smooth_start) // 2
+
+        ## Candidates that are `distance` away from any possible later peak
+        ##  of their neuron can be resolved now.
+        is_closed = _closed_mask(candidates[0], candidates[1], next_peak, self.distance)
+        closed = tuple(c[is_closed] for c in candidates)
+        self._pending = tuple(c[~is_closed] for c in candidates)
+
+        ## Stable ranking: the winner of a tie does not depend on later blocks
+        keep = detection.select_by_distance_batched(closed[0], closed[1], closed[2], self.distance, kind='stable')
+        positions, columns, codes = closed[0][keep], closed[1][keep], closed[3][keep]
+        self.histogram += np.bincount(columns * conditions.N_CODES + codes, minlength=self.n_neurons * conditions.N_CODES).reshape(self.n_neurons, conditions.N_CODES)
+        bounds = np.searchsorted(columns, np.arange(self.n_neurons + 1))
+        spike_times = [positions[bounds[ii]:bounds[ii + 1]] for ii in range(self.n_neurons)]
+
+        if not final and self.n_neurons > 0:
+            ## Codes of the samples a later peak can be at
+            first = np.searchsorted(self._code_starts, next_peak.min(), side='right') - 1
+            self._code_starts = self._code_starts[max(first, 0):]
+            self._code_values = self._code_values[max(first, 0):]
+        return spike_times
+
+    def _append_codes(self, codes):
+        if len(codes) == 0:
+            return
+        starts = np.concatenate([[0], np.flatnonzero(codes[1:] != codes[:-1]) + 1])
+        values = codes[starts]
+        if len(self._code_values) > 0 and values[0] == self._code_values[-1]:
+            starts, values = starts[1:], values[1:]
+        self._code_starts = np.concatenate([self._code_starts, starts + self.n_samples])
+        self._code_values = np.concatenate([self._code_values, values])
+
+    def _code_at(self, positions):
+        return self._code_values[np.searchsorted(self._code_starts, positions, side='right') - 1]
+
+
+def stream_spikes(blocks, n_neurons, sample_rate, threshold):
+    """
+    Run a StreamingDetector over live data. The spikes are those of
+     count_spikes on the full recording, up to the resolution of
+     equal-height peaks (see StreamingDetector).
+
+    Args:
+        blocks (iterable):
+            Blocks of samples, e.g. a generator reading from the acquisition
+             system. Each block is either an array of traces of shape
+             (n_samples, n_neurons) or a (traces, codes) tuple (see
+             StreamingDetector.push).
+        n_neurons, sample_rate, threshold:
+            See StreamingDetector.
+
+    Yields:
+        update (SpikeUpdate):
+            One per block, as soon as the block is processed, then one for
+             the spikes flushed at the end of the stream.
+    """
+    detector = StreamingDetector(n_neurons, sample_rate, threshold)
+    for block in blocks:
+        spike_times = detector.push(*block) if isinstance(block, tuple) else detector.push(block)
+        yield SpikeUpdate(spike_times, detector.counts(), detector.n_samples)
+    spike_times = detector.finish()
+    yield SpikeUpdate(spike_times, detector.counts(), detector.n_samples)
+
+
+async def stream_spikes_async(queue, n_neurons, sample_rate, threshold):
+    """
+    Asynchronous version of stream_spikes reading blocks from an
+     asyncio.Queue, with the same spikes. The producer puts None on the
+     queue to end the stream.
+
+    Yields:
+        update (SpikeUpdate):
+            See stream_spikes.
+    """
+    detector = StreamingDetector(n_neurons, sample_rate, threshold)
+    while True:
+        block = await queue.get()
+        if block is None:
+            break
+        spike_times = detector.push(*block) if isinstance(block, tuple) else detector.push(block)
+        yield SpikeUpdate(spike_times, detector.counts(), detector.n_samples)
+    spike_times = detector.finish()
+    yield SpikeUpdate(spike_times, detector.counts(), detector.n_samples)
+
+
+def count_spikes_chunked(chunks, parameters, return_spikes=False, conditions_list=conditions.CONDITIONS):
+    """
+    Streaming version of the spike counting in pipeline().
+    Every chunk is validated, pushed through a StreamingDetector and then
+     released, so memory is bounded by the chunk size. Equal-height peaks
+     closer than the minimal peak distance are resolved as described in
+     StreamingDetector, not as in pipeline().
+
+    Args:
+        chunks (iterable of pandas.DataFrame or dict):
+            Consecutive blocks of rows of the input data, e.g. from
+             readers.read_chunks(filepath_data, chunk_size).
+        parameters (dict):
+            Parameters read from the JSON parameters file.
+        return_spikes (bool):
+            If True, also collect the spike times of every neuron. They are
+             small compared to the traces, so memory stays bounded by the
+             chunk size in practice.
+        conditions_list (list of str):
+            Conditions to count (see conditions.count_conditions).
+
+    Returns:
+        ns_conditions (dict):
+            Same output as pipeline().
+        spike_trains (spikes.SpikeTrains):
+            Only if return_spikes is True.
+
+    Raises:
+        ValueError:
+            If a chunk fails validation or the input has no rows.
+    """
+    detector = None
+    keys_neurons = None
+    blocks = []
+    for chunk in chunks:
+        status, optional_error = validation.validate_input(chunk, parameters)
+        if not status:
+            raise ValueError(optional_error)
+
+        if detector is None:
+            keys_neurons = [key for key in chunk.keys() if key not in validation.KEYS_EPOCHS]
+            detector = StreamingDetector(len(keys_neurons), parameters['sample_rate'], parameters['threshold'])
+        codes = conditions.epoch_codes(*(chunk[key] for key in validation.KEYS_EPOCHS))
+        block = detector.push(np.column_stack([np.asarray(chunk[key], dtype=np.float64) for key in keys_neurons]), codes)
+        if return_spikes:
+            blocks.append(block)
+
+    if detector is None:
+        raise ValueError('No rows in input data')
+    blocks.append(detector.finish())
+    if not return_spikes:
+        return detector.counts(conditions_list)
+    spike_times = [np.concatenate([block[ii] for block in blocks]) for ii in range(len(keys_neurons))]
+    return detector.counts(conditions_list), spikes.SpikeTrains.from_list(spike_times, keys_neurons, n_samples=detector.n_samples)
+
+
+def _trailing_plateaus(seg, threshold):
+    """
+    First sample in seg of the trailing run of equal values of every column,
+     and whether that run is a flat top that can still be a peak: above
+     threshold and reached by a rising edge inside seg.
+    """
+    n_samples, n_neurons = seg.shape
+    left = np.zeros(n_neurons, dtype=np.int64)
+    if n_samples > 1:
+        changes = seg[1:] != seg[:-1]
+        left = np.where(changes.any(axis=0), n_samples - 1 - np.argmax(changes[::-1], axis=0), 0)
+    columns = np.arange(n_neurons)
+    value = seg[n_samples - 1]
+    is_plateau = (left > 0) & (value >= threshold) & (seg[np.maximum(left - 1, 0), columns] < value)
+    return left, is_plateau
+
+
+def _closed_mask(positions, columns, next_peak, distance):
+    """
+    Mask of the candidates whose distance resolution cannot be affected by a
+     peak of their neuron at or after next_peak[neuron]: all but the last
+     group of candidates closer than distance to each other, and that group
+     too if its last candidate is at least distance before next_peak.
+    """
+    n = len(positions)
+    if n == 0:
+        return np.zeros(0, dtype=np.bool_)
+    is_break = np.ones(n, dtype=np.bool_)
+    is_break[1:] = (columns[1:] != columns[:-1]) | (positions[1:] - positions[:-1] >= distance)
+    group = np.cumsum(is_break)
+    is_last = np.ones(n, dtype=np.bool_)
+    is_last[:-1] = columns[1:] != columns[:-1]
+    last = np.flatnonzero(is_last)
+    is_open = positions[last] + distance > next_peak[columns[last]]
+    open_groups = np.zeros(group[-1] + 1, dtype=np.bool_)
+    open_groups[group[last[is_open]]] = True
+    return ~open_groups[group]
+
+
+def _empty_candidates():
+    return (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64), np.empty(0, dtype=np.uint8))
+
+
+def _merge_candidates(a, b):
+    """
+    Concatenate two sets of candidates (positions, columns, heights, codes),
+     each sorted by column then position, keeping that order.
+    """
+    merged = tuple(np.concatenate([x, y]) for x, y in zip(a, b))
+    if len(a[0]) == 0 or len(b[0]) == 0:
+        return merged
+    order = np.lexsort((merged[0], merged[1]))
+    return tuple(c[order] for c in merged)
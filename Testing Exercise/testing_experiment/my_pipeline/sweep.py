@@ -0,0 +1,113 @@
+## Threshold sweeps: spike counts for many thresholds from one smoothing pass
+
+import numpy as np
+
+from . import conditions, detection, readers, validation
+
+
+def run_sweep(filepath_data, filepath_parameters, thresholds, conditions_list=conditions.CONDITIONS):
+    """
+    Same counts as calling pipeline() once per threshold, at roughly the cost
+     of one call: the data are read, validated and smoothed once (see
+     sweep_thresholds). The 'threshold' entry of the parameters file is not used.
+
+    Args:
+        filepath_data (str):
+            Filepath to the data file (any format accepted by pipeline()).
+        filepath_parameters (str):
+            Filepath to the parameters JSON file (see pipeline()).
+        thresholds (1-D array-like of float):
+            Thresholds to count spikes for.
+        conditions_list (list of str):
+            Conditions to count (see conditions.count_conditions).
+
+    Returns:
+        ns_conditions (pandas.DataFrame):
+            Number of spikes, summed across neurons, for each threshold (rows)
+             and condition (columns).
+
+    Raises:
+        ValueError:
+            If the data or parameters are invalid.
+    """
+    from .pipeline import load_parameters
+
+    data = readers.read_data(filepath_data)
+    parameters = load_parameters(filepath_parameters)
+    thresholds = np.asarray(thresholds, dtype=np.float64).ravel()
+    if len(thresholds) == 0:
+        raise ValueError('No thresholds to sweep')
+    ## Every threshold is a float, so only the other checks can fail
+    status, optional_error = validation.validate_input(data, dict(parameters, threshold=float(thresholds.min())))
+    if not status:
+        raise ValueError(optional_error)
+    return sweep_thresholds(data, parameters['sample_rate'], thresholds, conditions_list)
+
+
+def sweep_thresholds(data, sample_rate, thresholds, conditions_list=conditions.CONDITIONS):
+    """
+    Spike counts per condition for every threshold, on data that already
+     passed validate_input.
+
+    Returns:
+        ns_conditions (pandas.DataFrame):
+            See run_sweep.
+    """
+    import pandas as pd
+
+    keys_neurons = [key for key in data.keys() if key not in validation.KEYS_EPOCHS]
+    codes = conditions.epoch_codes(*(data[key] for key in validation.KEYS_EPOCHS))
+    thresholds = np.asarray(thresholds, dtype=np.float64).ravel()
+
+    detector = detection.SpikeDetector(sample_rate, thresholds.min())
+    traces_smooth = detector.smooth(detection.traces_matrix(data, keys_neurons))
+    counts = np.zeros((len(thresholds), len(conditions_list)), dtype=np.int64)
+    for ii, (spike_times, _) in enumerate(find_peaks_sweep(traces_smooth, thresholds, detector.plan.distance)):
+        histogram = conditions.code_histogram(spike_times, codes)
+        counts[ii] = list(conditions.count_conditions(histogram, conditions_list).values())
+    return pd.DataFrame(counts, index=pd.Index(thresholds, name='threshold'), columns=list(conditions_list))
+
+
+def find_peaks_sweep(traces_smooth, thresholds, distance):
+    """
+    find_peaks_batched(traces_smooth, threshold, distance) for every threshold,
+     with the local maxima searched only once.
+    Raising the threshold only removes local maxima, so the maxima above the
+     lowest threshold are found once and filtered by height for each
+     threshold. The `distance` rule is not monotonic in the threshold: a
+     peak suppressed by a higher neighbour is kept again once that neighbour
+     falls below threshold, and removing a peak can free a lower one it was
+     suppressing. It is therefore resolved again for every threshold, on the
+     filtered maxima only, exactly as find_peaks does on its own candidates.
+
+    Args:
+        traces_smooth (np.ndarray, shape (n_samples, n_neurons)):
+            Smoothed traces, one neuron per column.
+        thresholds (1-D array of float):
+            Minimal height of a peak, one value per sweep step.
+        distance (float):
+            Minimal distance in samples between peaks of the same neuron.
+
+    Returns:
+        results (list of (spike_times, offsets)):
+            Output of find_peaks_batched for each threshold, in order.
+    """
+    if distance < 1:
+        raise ValueError('`distance` must be greater or equal to 1')
+    x = np.asarray(traces_smooth)
+    if x.ndim == 1:
+        x = x[:, None]
+    n_neurons = x.shape[1]
+    distance = int(np.ceil(distance))
+    thresholds = np.asarray(thresholds, dtype=np.float64).ravel()
+
+    peaks, columns, heights = detection.local_maxima_batched(x, thresholds.min())
+    results = []
+    for threshold in thresholds:
+        ## heights are float64 values of x, so this is find_peaks' own comparison
+        above = heights >= threshold
+        peaks_t, columns_t, heights_t = peaks[above], columns[above], heights[above]
+        keep = detection.select_by_distance_batched(peaks_t, columns_t, heights_t, distance)
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(columns_t[keep], minlength=n_neurons))]).astype(np.int64)
+        results.append((peaks_t[keep], offsets))
+    return results
@@ -0,0 +1,154 @@
+## Vectorized input validation
+
+import numpy as np
+
+KEYS_EPOCHS = ['trial_on', 'reward_on', 'light_on']
+KEYS_PARAMETERS = ['sample_rate', 'threshold']
+
+
+def validate_input(data, parameters):
+    """
+    Validate the input data and parameters of pipeline().
+    Every column is checked as a whole (by dtype and with vectorized masks),
+     and all failures are collected in a single pass instead of stopping at
+     the first one.
+
+    Args:
+        data (pandas.DataFrame or dict):
+            Mapping from column name to a 1-D array-like of values.
+        parameters (dict):
+            Parameters read from the JSON parameters file.
+
+    Returns:
+        status (bool):
+            True if all checks passed.
+        message (str):
+            Empty string if status is True, otherwise all failure messages
+             joined by '; '.
+    """
+    errors = validate_data(data) + validate_parameters(parameters)
+    return len(errors) == 0, '; '.join(errors)
+
+
+def validate_data(data):
+    """
+    Check the data columns. Input data must have:
+        1. 3 critical column names: 'trial', 'reward' and 'light' tags
+        2. above 3 columns are temporal epochs that should have a boolean value
+        3. there is atleast 1 neuron voltage trace column
+        4. all neuron voltage trace columns should have numerical, non-NaN values
+
+    Args:
+        data (pandas.DataFrame or dict):
+            Mapping from column name to a 1-D array-like of values.
+
+    Returns:
+        errors (list of str):
+            One message per failed check. Empty if the data are valid.
+    """
+    errors = []
+    keys = list(data.keys())
+
+    for key in KEYS_EPOCHS:
+        if key not in keys:
+            errors.append('Critical temporal epoch column: ' + key + ' not in input data')
+        elif not _is_bool_column(data[key]):
+            errors.append('Critical temporal epoch column: ' + key + ' value type is not bool in input data')
+
+    keys_neurons = [key for key in keys if key not in KEYS_EPOCHS]
+    if len(keys_neurons) == 0:
+        errors.append('No neuron voltage trace columns found in input data')
+
+    ## Check dtypes first so that np.isnan is only applied to numeric columns
+    keys_numeric = []
+    for key in keys_neurons:
+        if _is_numeric_column(data[key]):
+            keys_numeric.append(key)
+        else:
+            errors.append('Found non-numerical values for column: ' + key + ' in input data')
+
+    ## One vectorized reduction per column; failures are reported for all columns at once
+    if len(keys_numeric) > 0:
+        has_nan = _columns_have_nan(data, keys_numeric)
+        for key in np.array(keys_numeric, dtype=object)[has_nan]:
+            errors.append('Found invalue NaN value for column: ' + key + ' in input data')
+
+    return errors
+
+
+def validate_parameters(parameters):
+    """
+    Check the parameters. Input parameters must have:
+        1. Both 'sample_rate' and 'threshold' keys
+        2. Value corresponding to each should be of 'float' type
+
+    Args:
+        parameters (dict):
+            Parameters read from the JSON parameters file.
+
+    Returns:
+        errors (list of str):
+            One message per failed check. Empty if the parameters are valid.
+    """
+    errors = []
+    for key in KEYS_PARAMETERS:
+        if key not in parameters:
+            errors.append('Column ' + key + ' missing in input parameters')
+        elif not isinstance(parameters[key], float):
+            errors.append('Column ' + key + ' value type is not float in input parameters')
+    return errors
+
+
+def _is_bool_column(values):
+    """
+    True if every value in the column is a boolean.
+    A bool dtype is accepted without looking at the values. Object columns
+     (e.g. booleans mixed with NaN after pd.read_csv) are classified by pandas'
+     compiled type inference rather than a Python loop.
+    """
+    dtype = getattr(values, 'dtype', None)
+    if dtype is None:
+        values = np.asarray(values)
+        dtype = values.dtype
+    if dtype == np.bool_:
+        return True
+    if dtype == np.object_:
+        import pandas as pd
+        return pd.api.types.infer_dtype(values, skipna=False) == 'boolean'
+    return False
+
+
+def _is_numeric_column(values):
+    """
+    pandas.api.types.is_numeric_dtype without importing pandas for numpy
+     dtypes: booleans, integers, floats and complex numbers, but not
+     datetimes or timedeltas.
+    """
+    dtype = getattr(values, 'dtype', None)
+    if dtype is None:
+        dtype = np.asarray(values).dtype
+    if isinstance(dtype, np.dtype):
+        return dtype.kind in 'biufc'
+    ## Extension dtypes (e.g. pandas' nullable Int64) come from pandas anyway
+    import pandas as pd
+    return pd.api.types.is_numeric_dtype(dtype)
+
+
+def _columns_have_nan(data, keys):
+    """
+    Returns a boolean array with one entry per key, True where the column
+     contains at least one NaN. Integer and bool columns cannot hold NaN and
+     are skipped without touching their values.
+    """
+    has_nan = np.zeros(len(keys), dtype=np.bool_)
+    for ii, key in enumerate(keys):
+        values = np.asarray(data[key])
+        if values.dtype.kind in 'fc':
+            ## np.isnan(...).any() allocates a full mask; the sum of a float
+            ##  array is NaN iff it contains a NaN (or both +inf and -inf,
+            ##  which is then disambiguated with the exact check).
+            with np.errstate(invalid='ignore', over='ignore'):
+                total = values.sum()
+            if np.isnan(total):
+                has_nan[ii] = np.isnan(values).any()
+    return has_nan
@@ -3,7 +3,7 @@
 ## setup.py file for my_pipeline
 from pathlib import Path
 
-from distutils.core import setup
+from setuptools import setup
 import copy
 
 dir_parent = Path(__file__).parent
@@ -58,4 +58,10 @@ setup(
         'all': deps_all,
         'all_latest': deps_all_latest,
     },
+
+    entry_points={
+        'console_scripts': [
+            'my-pipeline=my_pipeline.cli:main',
+        ],
+    },
 )
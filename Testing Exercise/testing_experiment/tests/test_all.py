@@ -8,7 +8,7 @@ import numpy as np
 import pandas as pd
 import json
 
-from my_pipeline import pipeline
+from my_pipeline import batch, cache, conditions, detection, fused, intervals, parallel, pipeline, profiling, readers, snippets, spikes, streaming, sweep, validation
 
 # Based on the reference https://github.com/RichieHakim/ROICaT/blob/main/tests/test_*.py
 # we could ideally add more tests for individual packages,
@@ -213,6 +213,997 @@ def test_common_neuron_voltage_trace_threshold_scenario():
   assert actual_result == expected_result, 'Test failed. Expected: ' + str(expected_result) + ', Actual: ' + str(actual_result)
 
 
+# Part 3: Validation engine
+
+def test_validate_input_reports_all_failures():
+  data = pd.DataFrame({
+    'trial_on': [True, False, True],
+    'reward_on': [True, np.nan, False],
+    'neuron_1': [0.0, np.nan, 1.0],
+    'neuron_2': ['a', 'b', 'c'],
+  })
+  parameters = {'sample_rate': 2000}
+
+  status, message = pipeline.validate_input(data, parameters)
+  assert not status
+  expected_errors = [
+    'Critical temporal epoch column: reward_on value type is not bool in input data',
+    'Critical temporal epoch column: light_on not in input data',
+    'Found non-numerical values for column: neuron_2 in input data',
+    'Found invalue NaN value for column: neuron_1 in input data',
+    'Column sample_rate value type is not float in input parameters',
+    'Column threshold missing in input parameters',
+  ]
+  for error in expected_errors:
+    assert error in message, 'Missing validation error: ' + error + '. Actual: ' + message
+
+
+def test_validate_input_accepts_valid_columns():
+  data = {
+    'trial_on': np.array([True, False, True]),
+    'reward_on': pd.Series([True, False, False], dtype=object),
+    'light_on': [False, False, True],
+    'neuron_1': np.array([0.0, 1.0, 2.0], dtype=np.float32),
+    'neuron_2': np.array([0, 1, 2], dtype=np.int16),
+  }
+  parameters = {'sample_rate': 2000.0, 'threshold': 9.0}
+  assert pipeline.validate_input(data, parameters) == (True, '')
+
+  data['neuron_3'] = np.array([0.0, np.inf, -np.inf])
+  assert pipeline.validate_input(data, parameters) == (True, '')
+
+  del data['neuron_1'], data['neuron_2'], data['neuron_3']
+  status, message = pipeline.validate_input(data, parameters)
+  assert not status and 'No neuron voltage trace columns' in message
+
+
+# Part 4: Parallel spike detection
+
+def write_random_recording(n=20000, n_neurons=6, seed=0, sample_rate=2000.0, threshold=9.0):
+  # Epochs with the layout of util.make_fake_data_file, noisy traces with sparse spikes.
+  rng = np.random.default_rng(seed)
+  idx = np.arange(n)
+  data = {
+    'trial_on': (idx % 1000) > 500,
+    'reward_on': (idx % 1000) > 750,
+    'light_on': (idx % 2000) > 900,
+  }
+  for ii in range(n_neurons):
+    trace = rng.normal(0, 5, n)
+    trace[rng.choice(n, n // 100, replace=False)] += 60
+    data[f'neuron_{ii + 1}'] = trace
+  filepath_data = str((Path(tempfile.gettempdir()) / f'random_recording_{n}_{n_neurons}_{seed}.csv').resolve().absolute())
+  pd.DataFrame(data).to_csv(filepath_data, index=False)
+
+  filepath_params = str((Path(tempfile.gettempdir()) / 'random_recording_params.json').resolve().absolute())
+  with open(filepath_params, 'w') as f:
+    json.dump({'sample_rate': sample_rate, 'threshold': threshold}, f)
+  return filepath_data, filepath_params
+
+
+@pytest.mark.parametrize('executor', ['threads', 'processes'])
+def test_parallel_executors_match_serial(executor):
+  filepath_data, filepath_params = write_random_recording()
+  expected_result = pipeline.pipeline(filepath_data, filepath_params, executor='serial')
+  actual_result = pipeline.pipeline(filepath_data, filepath_params, executor=executor, n_workers=3)
+  assert actual_result == expected_result, 'Test failed. Expected: ' + str(expected_result) + ', Actual: ' + str(actual_result)
+  assert expected_result['t'] > 0
+
+
+@pytest.mark.parametrize('executor', parallel.EXECUTORS)
+def test_parallel_executors_window_too_short(executor):
+  # At 1000 Hz the smoothing window is 2 samples, too short for a 2nd order polynomial.
+  filepath_data, filepath_params = write_random_recording(n=3000, n_neurons=2, seed=7, sample_rate=1000.0)
+  with pytest.raises(ValueError, match='polyorder must be less than window_length'):
+    pipeline.pipeline(filepath_data, filepath_params, executor=executor)
+
+
+def test_parallel_executor_invalid(monkeypatch):
+  with pytest.raises(ValueError):
+    parallel.detect_spikes([np.zeros(10)], 2000.0, 9.0, executor='gpu')
+
+  # pipeline() rejects it before reading anything
+  filepath_data, filepath_params = write_random_recording(n=3000, n_neurons=2, seed=8)
+  def read_head(*args, **kwargs):
+    raise AssertionError('data file read')
+  monkeypatch.setattr(readers, 'read_head', read_head)
+  with pytest.raises(ValueError):
+    pipeline.pipeline(filepath_data, filepath_params, executor='gpu')
+
+
+# Part 5: Condition counting
+
+def test_condition_counts_match_isin():
+  rng = np.random.default_rng(1)
+  n = 5000
+  t, r, l = (rng.random(n) > 0.5 for _ in range(3))
+  st_cat = np.concatenate([np.sort(rng.choice(n, 300, replace=False)) for _ in range(4)])
+
+  histogram = conditions.code_histogram(st_cat, conditions.epoch_codes(t, r, l))
+  actual_result = conditions.count_conditions(histogram, conditions.CONDITIONS + [''])
+
+  bool_to_idx = lambda x: np.where(x)[0]
+  idx_conditions = {
+    't': bool_to_idx(t), 'r': bool_to_idx(r), 'l': bool_to_idx(l),
+    'tr': bool_to_idx(t * r), 'tl': bool_to_idx(t * l), 'rl': bool_to_idx(r * l),
+    'trl': bool_to_idx(t * r * l), '': np.arange(n),
+  }
+  expected_result = {key: np.isin(st_cat, val).sum() for key, val in idx_conditions.items()}
+  assert actual_result == expected_result, 'Test failed. Expected: ' + str(expected_result) + ', Actual: ' + str(actual_result)
+
+  with pytest.raises(ValueError):
+    conditions.condition_mask('tx')
+
+
+# Part 6: Streaming mode
+
+@pytest.mark.parametrize('chunk_size', [13, 500, 20000])
+def test_streaming_matches_in_memory(chunk_size):
+  filepath_data, filepath_params = write_random_recording(n=4000, n_neurons=3, seed=2)
+  expected_result = pipeline.pipeline(filepath_data, filepath_params)
+  actual_result = pipeline.pipeline(filepath_data, filepath_params, chunk_size=chunk_size)
+  assert actual_result == expected_result, 'Test failed. Expected: ' + str(expected_result) + ', Actual: ' + str(actual_result)
+
+
+def test_streaming_detector_spike_times():
+  # Rounded traces have flat tops and equal-height neighbours across chunk boundaries.
+  rng = np.random.default_rng(3)
+  traces = np.round(rng.normal(0, 5, (3000, 2)) / 5) * 5
+  traces[rng.random(traces.shape) < 0.02] += 40
+  expected_spikes = [pipeline.count_spikes(traces[:, ii], 3000.0, 9.0) for ii in range(2)]
+
+  detector = streaming.StreamingDetector(2, 3000.0, 9.0)
+  blocks = [detector.push(traces[start:start + 37]) for start in range(0, len(traces), 37)]
+  blocks.append(detector.finish())
+  for ii in range(2):
+    actual_spikes = np.concatenate([block[ii] for block in blocks])
+    assert np.array_equal(actual_spikes, expected_spikes[ii])
+
+
+def test_streaming_equal_height_ties():
+  # Integer traces have equal-height peaks closer than the peak distance. Chunked detection
+  # keeps the later peak of a tie whatever the chunk size, where find_peaks' unstable sort may not.
+  filepath_data, filepath_params = write_random_recording(n=20000, n_neurons=4, seed=5)
+  data = pd.read_csv(filepath_data)
+  keys = [key for key in data.keys() if key.startswith('neuron')]
+  rng = np.random.default_rng(5)
+  traces = rng.integers(-2, 3, (len(data), len(keys))).astype(np.int16)
+  traces[rng.random(traces.shape) < 0.05] += 40
+  data[keys] = traces
+  tied_filepath_data = str((Path(tempfile.gettempdir()) / 'tied_streaming_data.csv').resolve().absolute())
+  data.to_csv(tied_filepath_data, index=False)
+
+  detector = detection.SpikeDetector(2000.0, 9.0)
+  peaks, columns, heights = detection.local_maxima_batched(detector.smooth(traces.astype(np.float64)), 9.0)
+  distance = int(np.ceil(detector.plan.distance))
+  ties = (columns[1:] == columns[:-1]) & (peaks[1:] - peaks[:-1] < distance) & (heights[1:] == heights[:-1])
+  assert ties.sum() > 0
+  keep = detection.select_by_distance_batched(peaks, columns, heights, distance, kind='stable')
+  for chunk_size in [37, 1000, 20000]:
+    _, spike_trains = pipeline.pipeline(tied_filepath_data, filepath_params, chunk_size=chunk_size, return_spikes=True)
+    for ii in range(len(keys)):
+      assert np.array_equal(spike_trains[ii], peaks[keep & (columns == ii)])
+
+
+def test_streaming_detector_plateau():
+  import time
+  # A saturated channel between two artifacts is one flat top peak across all blocks:
+  # only its start and value are carried until it ends
+  rng = np.random.default_rng(9)
+  traces = np.column_stack([np.full(60000, 20.0), rng.normal(0, 5, 60000)])
+  traces[[1000, 59000], 0] = 60.0
+  codes = np.repeat(np.arange(60) % 8, 1000).astype(np.uint8)
+  detector = streaming.StreamingDetector(2, 2000.0, 9.0)
+  tic = time.perf_counter()
+  blocks = []
+  for start in range(0, len(traces), 1000):
+    blocks.append(detector.push(traces[start:start + 1000], codes[start:start + 1000]))
+    assert len(detector._smooth) <= 1 and len(detector._raw) <= 1000 + detector.context
+  blocks.append(detector.finish())
+  assert time.perf_counter() - tic < 2.0
+  for ii in range(2):
+    actual_spikes = np.concatenate([block[ii] for block in blocks])
+    expected_spikes = pipeline.count_spikes(traces[:, ii], 2000.0, 9.0)
+    assert np.array_equal(actual_spikes, expected_spikes)
+  assert 29999 in np.concatenate([block[0] for block in blocks])
+  assert detector.histogram[0, codes[29999]] >= 1
+
+
+def test_stream_spikes_online():
+  import asyncio
+  filepath_data, filepath_params = write_random_recording(n=4000, n_neurons=3, seed=13)
+  expected_result, spike_trains = pipeline.pipeline(filepath_data, filepath_params, return_spikes=True)
+  data = pd.read_csv(filepath_data)
+  traces = data[list(spike_trains.neurons)].to_numpy()
+  codes = conditions.epoch_codes(data['trial_on'], data['reward_on'], data['light_on'])
+  blocks = [(traces[start:start + 50], codes[start:start + 50]) for start in range(0, len(traces), 50)]
+
+  updates = list(streaming.stream_spikes(iter(blocks), 3, 2000.0, 9.0))
+  assert updates[-1].counts == expected_result and updates[-1].n_samples == len(traces)
+  detector = streaming.StreamingDetector(3, 2000.0, 9.0)
+  for ii in range(3):
+    spike_times = np.concatenate([update.spike_times[ii] for update in updates])
+    assert np.array_equal(spike_times, spike_trains[ii])
+    # Bounded latency: every spike is emitted by the first block reaching spike + latency samples
+    for update in updates[:-1]:
+      assert np.all(update.spike_times[ii] >= update.n_samples - 50 - detector.latency)
+
+  async def run():
+    queue = asyncio.Queue()
+    for block in blocks:
+      queue.put_nowait(block)
+    queue.put_nowait(None)
+    return [update async for update in streaming.stream_spikes_async(queue, 3, 2000.0, 9.0)]
+  assert asyncio.run(run())[-1].counts == expected_result
+
+
+def test_stream_spikes_equal_height_ties():
+  rng = np.random.default_rng(6)
+  traces = rng.integers(-2, 3, (5000, 3)).astype(np.float64)
+  traces[rng.random(traces.shape) < 0.05] += 40
+  detector = detection.SpikeDetector(2000.0, 9.0)
+  peaks, columns, heights = detection.local_maxima_batched(detector.smooth(traces), 9.0)
+  keep = detection.select_by_distance_batched(peaks, columns, heights, int(np.ceil(detector.plan.distance)), kind='stable')
+  updates = list(streaming.stream_spikes((traces[start:start + 50] for start in range(0, len(traces), 50)), 3, 2000.0, 9.0))
+  for ii in range(3):
+    assert np.array_equal(np.concatenate([update.spike_times[ii] for update in updates]), peaks[keep & (columns == ii)])
+
+
+def test_streaming_invalid_data():
+  filepath_data, filepath_params = write_random_recording(n=3000, n_neurons=2, seed=4)
+  invalid_filepath_data = str((Path(tempfile.gettempdir()) / 'invalid_streaming_data.csv').resolve().absolute())
+  invalid_data = pd.read_csv(filepath_data)
+  invalid_data.at[2500, 'neuron_2'] = np.nan
+  invalid_data.to_csv(invalid_filepath_data, index=False)
+  assert pipeline.pipeline(invalid_filepath_data, filepath_params, chunk_size=1000).empty
+  assert pipeline.pipeline('', filepath_params, chunk_size=1000).empty
+
+
+# Part 7: Binary input formats
+
+@pytest.mark.parametrize('suffix', ['_npy', '.parquet', '.feather'])
+def test_binary_formats_match_csv(suffix):
+  if suffix != '_npy':
+    pytest.importorskip('pyarrow')
+  filepath_data, filepath_params = write_random_recording(n=5003, n_neurons=3, seed=5)
+  filepath_binary = str((Path(tempfile.gettempdir()) / ('random_recording_binary' + suffix)).resolve().absolute())
+  readers.convert_csv(filepath_data, filepath_binary, chunk_size=1000)
+
+  data_csv = pd.read_csv(filepath_data)
+  data_binary = readers.read_data(filepath_binary)
+  assert list(data_binary.keys()) == list(data_csv.keys())
+  for key in data_csv.keys():
+    assert np.array_equal(np.asarray(data_binary[key]), data_csv[key].to_numpy())
+  assert data_binary['trial_on'].dtype == np.bool_
+
+  expected_result = pipeline.pipeline(filepath_data, filepath_params)
+  assert pipeline.pipeline(filepath_binary, filepath_params) == expected_result
+  assert pipeline.pipeline(filepath_binary, filepath_params, chunk_size=999) == expected_result
+
+
+# Part 8: Batch execution
+
+@pytest.mark.parametrize('executor', ['serial', 'threads', 'processes'])
+def test_run_batch(executor):
+  sessions = [write_random_recording(n=3000, n_neurons=2, seed=seed)[0] for seed in range(3)]
+  _, filepath_params = write_random_recording(n=3000, n_neurons=2, seed=0)
+  sessions.insert(1, '')
+
+  results = batch.run_batch(sessions, filepath_params, executor=executor, n_workers=2)
+  assert list(results.index) == sessions
+  assert list(results.columns) == conditions.CONDITIONS + ['error']
+
+  for session in sessions:
+    expected_result = pipeline.pipeline(session, filepath_params)
+    if session == '':
+      assert results.loc[session, conditions.CONDITIONS].isna().all()
+      assert results.loc[session, 'error'] is not None
+    else:
+      assert results.loc[session, conditions.CONDITIONS].to_dict() == expected_result
+      assert results.loc[session, 'error'] is None
+
+
+def test_run_batch_invalid_parameters():
+  filepath_data, _ = write_random_recording(n=3000, n_neurons=2, seed=0)
+  invalid_filepath_params = str((Path(tempfile.gettempdir()) / 'invalid_batch_params.json').resolve().absolute())
+  with open(invalid_filepath_params, 'w') as f:
+    json.dump({'sample_rate': 2000.0}, f)
+  with pytest.raises(ValueError):
+    batch.run_batch([filepath_data], invalid_filepath_params)
+
+
+# Part 9: Detector and detection plans
+
+@pytest.mark.parametrize('sample_rate', [1500.0, 2250.0, 10000.0])
+def test_detector_matches_count_spikes(sample_rate):
+  rng = np.random.default_rng(6)
+  traces = rng.normal(0, 5, (5000, 4))
+  traces[rng.random(traces.shape) < 0.01] += 50
+
+  detector = detection.SpikeDetector(sample_rate, 9.0)
+  assert detector.plan is detection.get_plan(sample_rate, 9.0)
+  for trace_in in [traces, traces.astype(np.float32)]:
+    actual_spikes = detector.detect(trace_in)
+    for ii in range(traces.shape[1]):
+      assert np.array_equal(actual_spikes[ii], pipeline.count_spikes(trace_in[:, ii], sample_rate, 9.0))
+  assert np.array_equal(detector.detect(traces[:, 0]), pipeline.count_spikes(traces[:, 0], sample_rate, 9.0))
+
+
+def test_find_peaks_batched_matches_find_peaks():
+  import scipy.signal
+  rng = np.random.default_rng(7)
+  for distance in [1, 2.5, 4, 20]:
+    # Rounding gives flat tops and equal-height neighbours.
+    traces_smooth = np.round(rng.normal(0, 5, (3000, 5)) / 3)
+    spike_times, offsets = detection.find_peaks_batched(traces_smooth, 1.0, distance, block_size=5000)
+    assert len(offsets) == 6
+    for ii in range(5):
+      expected_spikes, _ = scipy.signal.find_peaks(traces_smooth[:, ii], height=1.0, distance=distance)
+      assert np.array_equal(spike_times[offsets[ii]:offsets[ii + 1]], expected_spikes)
+
+
+def test_find_peaks_batched_plateaus():
+  import scipy.signal
+  import time
+  # Flat tops of every length, down to a saturated channel that is one plateau
+  rng = np.random.default_rng(8)
+  traces_smooth = np.round(rng.normal(0, 1, (200000, 3)))
+  traces_smooth[1000:150000, 0] = 4.0
+  traces_smooth[:, 1] = np.repeat(rng.integers(0, 4, 2000), 100)
+  traces_smooth[1:-1, 2] = 5.0
+  tic = time.perf_counter()
+  spike_times, offsets = detection.find_peaks_batched(traces_smooth, 1.0, 4)
+  assert time.perf_counter() - tic < 1.0
+  for ii in range(3):
+    expected_spikes, _ = scipy.signal.find_peaks(traces_smooth[:, ii], height=1.0, distance=4)
+    assert np.array_equal(spike_times[offsets[ii]:offsets[ii + 1]], expected_spikes)
+
+
+# Part 10: Spike-train container
+
+@pytest.mark.parametrize('mode', [{}, {'executor': 'threads', 'n_workers': 2}, {'chunk_size': 700}])
+def test_pipeline_returns_spike_trains(mode):
+  filepath_data, filepath_params = write_random_recording(n=4000, n_neurons=3, seed=8)
+  expected_result = pipeline.pipeline(filepath_data, filepath_params)
+  actual_result, spike_trains = pipeline.pipeline(filepath_data, filepath_params, return_spikes=True, **mode)
+  assert actual_result == expected_result
+
+  data = pd.read_csv(filepath_data)
+  assert spike_trains.neurons == ('neuron_1', 'neuron_2', 'neuron_3')
+  assert spike_trains.spike_times.dtype == np.int32
+  for ii, key in enumerate(spike_trains.neurons):
+    expected_spikes = pipeline.count_spikes(data[key].to_numpy(), 2000.0, 9.0)
+    assert np.array_equal(spike_trains[key], expected_spikes)
+    assert np.shares_memory(spike_trains[ii], spike_trains.spike_times)
+  assert list(spike_trains.counts()) == [len(st) for st in spike_trains]
+  codes = conditions.epoch_codes(data['trial_on'], data['reward_on'], data['light_on'])
+  assert spike_trains.condition_counts(codes) == expected_result
+
+  filepath_npz = str((Path(tempfile.gettempdir()) / 'spike_trains.npz').resolve().absolute())
+  spike_trains.save(filepath_npz)
+  assert spikes.SpikeTrains.load(filepath_npz) == spike_trains
+
+  assert pipeline.pipeline('', filepath_params, return_spikes=True)[1] is None
+
+
+def test_spike_trains_breakdown():
+  filepath_data, filepath_params = write_random_recording(n=6000, n_neurons=4, seed=9)
+  expected_result, spike_trains = pipeline.pipeline(filepath_data, filepath_params, return_spikes=True)
+  data = pd.read_csv(filepath_data)
+  t, r, l = data['trial_on'].to_numpy(), data['reward_on'].to_numpy(), data['light_on'].to_numpy()
+  ns_conditions, ns_trials = spike_trains.breakdown(t, r, l)
+
+  assert ns_conditions.sum(axis=0).to_dict() == expected_result
+  codes = conditions.epoch_codes(t, r, l)
+  for key in spike_trains.neurons:
+    expected_row = conditions.count_conditions(conditions.code_histogram(spike_trains[key], codes))
+    assert ns_conditions.loc[key].to_dict() == expected_row
+
+  # Trials of the random recording: samples 501-999 of every 1000
+  starts, stops = ns_trials.attrs['start'], ns_trials.attrs['stop']
+  assert list(starts) == list(range(501, 6000, 1000)) and list(stops) == list(range(1000, 6001, 1000))
+  for key in spike_trains.neurons:
+    expected_row = [((spike_trains[key] >= start) & (spike_trains[key] < stop)).sum() for start, stop in zip(starts, stops)]
+    assert list(ns_trials.loc[key]) == expected_row
+
+  # A trial running to the end of the recording is closed there
+  starts, stops = conditions.trial_bounds([True, True, False, True])
+  assert list(starts) == [0, 3] and list(stops) == [2, 4]
+
+
+# Part 11: Result cache
+
+def test_pipeline_cache(monkeypatch):
+  filepath_data, filepath_params = write_random_recording(n=4000, n_neurons=3, seed=10)
+  cache_dir = tempfile.mkdtemp()
+  expected_result, expected_spikes = pipeline.pipeline(filepath_data, filepath_params, return_spikes=True)
+  assert pipeline.pipeline(filepath_data, filepath_params, cache=cache_dir) == expected_result
+
+  # Cache hits do not read the data file
+  def read_data(filepath_data):
+    raise AssertionError('data file read on a cache hit')
+  with monkeypatch.context() as m:
+    m.setattr(readers, 'read_data', read_data)
+    actual_result, actual_spikes = pipeline.pipeline(filepath_data, filepath_params, return_spikes=True, cache=cache_dir)
+    assert actual_result == expected_result and actual_spikes == expected_spikes
+
+    # Threshold-only change: peaks are found on the cached smoothed traces
+    filepath_params_2 = str((Path(tempfile.gettempdir()) / 'random_recording_params_2.json').resolve().absolute())
+    with open(filepath_params_2, 'w') as f:
+      json.dump({'sample_rate': 2000.0, 'threshold': 14.0}, f)
+    actual_result = pipeline.pipeline(filepath_data, filepath_params_2, cache=cache_dir)
+  assert actual_result == pipeline.pipeline(filepath_data, filepath_params_2)
+
+  # An edited data file misses the cache
+  data = pd.read_csv(filepath_data)
+  data['neuron_1'] += 100.0
+  data.to_csv(filepath_data, index=False)
+  assert pipeline.pipeline(filepath_data, filepath_params, cache=cache_dir) == pipeline.pipeline(filepath_data, filepath_params)
+
+  # Least recently used entries are evicted above the size limit
+  result_cache = cache.ResultCache(cache_dir, max_bytes=150000)
+  pipeline.pipeline(filepath_data, filepath_params_2, cache=result_cache)
+  assert result_cache.size() <= 150000
+
+  # Entries larger than the size limit are not stored: 4000 x 3 smoothed samples take 96000 bytes
+  result_cache = cache.ResultCache(tempfile.mkdtemp(), max_bytes=20000)
+  expected_result = pipeline.pipeline(filepath_data, filepath_params)
+  assert pipeline.pipeline(filepath_data, filepath_params, cache=result_cache) == expected_result
+  assert [path.name.split('-')[0] for path in (result_cache.directory / 'entries').iterdir()] == ['spikes']
+
+
+# Part 12: Threshold sweeps
+
+def test_sweep_matches_separate_runs():
+  filepath_data, filepath_params = write_random_recording(n=5000, n_neurons=3, seed=11)
+  thresholds = [4.0, 9.0, 9.5, 20.0, 1000.0]
+  results = sweep.run_sweep(filepath_data, filepath_params, thresholds)
+  assert list(results.index) == thresholds and list(results.columns) == conditions.CONDITIONS
+
+  filepath_params_sweep = str((Path(tempfile.gettempdir()) / 'sweep_params.json').resolve().absolute())
+  for threshold in thresholds:
+    with open(filepath_params_sweep, 'w') as f:
+      json.dump({'sample_rate': 2000.0, 'threshold': threshold}, f)
+    assert results.loc[threshold].to_dict() == pipeline.pipeline(filepath_data, filepath_params_sweep)
+
+
+def test_find_peaks_sweep_matches_find_peaks():
+  import scipy.signal
+  rng = np.random.default_rng(12)
+  # Rounding gives flat tops and equal-height neighbours.
+  traces_smooth = np.round(rng.normal(0, 5, (3000, 4)) / 3)
+  thresholds = np.arange(-1.0, 6.0, 0.5)
+  for distance in [1, 4, 20]:
+    results = sweep.find_peaks_sweep(traces_smooth, thresholds, distance)
+    for threshold, (spike_times, offsets) in zip(thresholds, results):
+      for ii in range(4):
+        expected_spikes, _ = scipy.signal.find_peaks(traces_smooth[:, ii], height=threshold, distance=distance)
+        assert np.array_equal(spike_times[offsets[ii]:offsets[ii + 1]], expected_spikes)
+
+
+# Part 13: Instrumentation
+
+def test_pipeline_instrumentation():
+  filepath_data, filepath_params = write_random_recording(n=4000, n_neurons=3, seed=14)
+  expected_result = pipeline.pipeline(filepath_data, filepath_params)
+
+  # Instrumented runs take the same code path as uninstrumented ones
+  reports = []
+  assert pipeline.pipeline(filepath_data, filepath_params, instrument=reports.append) == expected_result
+  summary = reports[0].summary()
+  for name in ['read_data', 'validate_input', 'smooth', 'find_peaks', 'count_conditions']:
+    assert name in summary and summary[name]['wall'] >= 0 and summary[name]['peak_memory'] >= 0
+  assert 'detect_neuron' not in summary
+
+  # Per-neuron stages are opt-in
+  with profiling.record(per_neuron=True) as report:
+    assert pipeline.pipeline(filepath_data, filepath_params) == expected_result
+  assert report.summary()['detect_neuron']['calls'] == 3
+  assert [entry['neuron'] for entry in report.stages if entry['name'] == 'detect_neuron'] == ['neuron_1', 'neuron_2', 'neuron_3']
+  assert report.max_rss is None or report.max_rss > 2**20
+
+  filepath_report = str((Path(tempfile.gettempdir()) / 'pipeline_report.json').resolve().absolute())
+  filepath_profile = str((Path(tempfile.gettempdir()) / 'pipeline_report.prof').resolve().absolute())
+  with profiling.record(memory=False, per_neuron=False, filepath_profile=filepath_profile) as report:
+    assert pipeline.pipeline(filepath_data, filepath_params) == expected_result
+  report.to_json(filepath_report)
+  with open(filepath_report, 'r') as f:
+    names = [entry['name'] for entry in json.load(f)['stages']]
+  assert names == ['probe_data', 'read_data', 'validate_input', 'traces_matrix', 'smooth', 'find_peaks', 'count_conditions']
+  import pstats
+  assert pstats.Stats(filepath_profile).total_calls > 0
+
+  # Stages outside of a recording are not recorded
+  assert profiling.stage('read_data') is profiling.stage('smooth')
+
+
+# Part 14: Synthetic recordings
+
+def test_fake_data_generator():
+  import util
+
+  data = util.make_fake_data(n=30001, n_neurons=4, seed=5)
+  assert list(data.keys()) == ['trial_on', 'reward_on', 'light_on', 'neuron_1', 'neuron_2', 'neuron_3', 'neuron_4']
+  assert all(len(column) == 30001 for column in data.values())
+  assert data['trial_on'].dtype == np.bool_ and data['neuron_1'].dtype == np.float64
+  assert np.array_equal(data['light_on'], (np.arange(30001) % 2000) > 900)
+
+  # Reproducible, independent of the chunk size, and one seed per neuron
+  traces = np.column_stack([data[f'neuron_{ii + 1}'] for ii in range(4)])
+  assert np.array_equal(traces, np.column_stack([util.make_fake_data(30001, 4, seed=5)[f'neuron_{ii + 1}'] for ii in range(4)]))
+  assert np.array_equal(traces, np.concatenate(list(util.iter_fake_traces(30001, 4, seed=5, chunk_size=1000))))
+  assert np.array_equal(traces[:, :2], next(util.iter_fake_traces(30001, 2, seed=5, chunk_size=30001)))
+  assert not np.array_equal(traces, next(util.iter_fake_traces(30001, 4, seed=6, chunk_size=30001)))
+
+  # Spikes reach about +30 mV at the rate of make_fake_voltage_trace (about 0.86 per 1000 samples)
+  spike_counts = np.array([len(pipeline.count_spikes(traces[:, ii], 10000.0, 0.0)) for ii in range(4)])
+  assert np.all((spike_counts > 10) & (spike_counts < 50))
+
+  # Streamed to disk as a directory of .npy arrays
+  filepath_data = str((Path(tempfile.gettempdir()) / 'fake_data_generator').resolve().absolute())
+  util.make_fake_data_file(filepath_data, n=30001, n_neurons=4, seed=5, chunk_size=4096, fmt='npy')
+  loaded = readers.read_data(filepath_data)
+  assert all(np.array_equal(loaded[key], column) for key, column in data.items())
+
+
+# Part 15: Lazy imports
+
+def test_lazy_imports():
+  import subprocess
+  import sys
+
+  # Submodules load on first access, and the batched path on binary data
+  # never loads pandas or scipy.signal.
+  filepath_data = str((Path(tempfile.gettempdir()) / 'lazy_imports_data').resolve().absolute())
+  filepath_params = str((Path(tempfile.gettempdir()) / 'lazy_imports_params.json').resolve().absolute())
+  readers.write_npy_dir(pd.read_csv(write_random_recording(n=4000, n_neurons=3, seed=15)[0]), filepath_data)
+  with open(filepath_params, 'w') as f:
+    json.dump({'sample_rate': 10000.0, 'threshold': 9.0}, f)
+  script = '\n'.join([
+    'import sys',
+    'import my_pipeline',
+    'assert "numpy" not in sys.modules and "my_pipeline.pipeline" not in sys.modules',
+    'assert my_pipeline.conditions.N_CODES == 8 and "conditions" in dir(my_pipeline)',
+    'from my_pipeline import pipeline',
+    f'assert isinstance(pipeline.pipeline({filepath_data!r}, {filepath_params!r}), dict)',
+    'assert "pandas" not in sys.modules and "scipy.signal" not in sys.modules',
+  ])
+  subprocess.run([sys.executable, '-c', script], cwd=str(dir_parent.parent), check=True)
+
+  import my_pipeline
+  with pytest.raises(AttributeError):
+    my_pipeline.not_a_module
+  # The coefficients are those of scipy, bit for bit
+  import scipy.signal
+  for window_length in [3, 4, 5, 20, 21, 101]:
+    assert np.array_equal(detection.savgol_coeffs(window_length), scipy.signal.savgol_coeffs(window_length, 2))
+
+
+# Part 16: Command-line interface
+
+@pytest.mark.parametrize('suffix', ['.csv', '.parquet'])
+def test_cli_run_resume(suffix):
+  from my_pipeline import cli
+
+  sessions = [write_random_recording(n=3000, n_neurons=2, seed=seed)[0] for seed in range(3)]
+  _, filepath_params = write_random_recording(n=3000, n_neurons=2, seed=0)
+  filepath_invalid = str((Path(tempfile.gettempdir()) / 'cli_invalid_session.csv').resolve().absolute())
+  with open(filepath_invalid, 'w') as f:
+    f.write('x,y\n1,2\n')
+  filepath_out = str((Path(tempfile.gettempdir()) / ('cli_results' + suffix)).resolve().absolute())
+
+  # A failed session is recorded in the output and sets the exit status
+  args = ['run', sessions[0], filepath_invalid, '--params', filepath_params, '--out', filepath_out, '--executor', 'threads', '-j', '2', '-q']
+  assert cli.main(args + ['--overwrite']) == 1
+  # The output is not replaced unless asked to
+  assert cli.main(args) == 2
+  # Resuming only runs the sessions not in the output yet
+  assert cli.main(['run'] + sessions + ['--params', filepath_params, '--out', filepath_out, '--resume', '-q']) == 0
+
+  def read_results():
+    if suffix == '.csv':
+      return cli.read_rows(filepath_out).set_index('session')
+    assert not cli.journal_path(Path(filepath_out)).exists()
+    return pd.read_parquet(filepath_out).set_index('session')
+  results = read_results()
+  assert sorted(results.index) == sorted(sessions + [filepath_invalid])
+  for session in sessions:
+    assert results.loc[session, conditions.CONDITIONS].to_dict() == pipeline.pipeline(session, filepath_params)
+    assert results.loc[session, 'error'] is None
+  assert results.loc[filepath_invalid, 'error'].startswith('ValueError')
+  assert results.loc[filepath_invalid, conditions.CONDITIONS].isna().all()
+
+  # Resuming runs the failed sessions again, and replaces their rows
+  pd.read_csv(sessions[0]).to_csv(filepath_invalid, index=False)
+  assert cli.main(['run'] + sessions + [filepath_invalid, '--params', filepath_params, '--out', filepath_out, '--resume', '-q']) == 0
+  results = read_results()
+  assert sorted(results.index) == sorted(sessions + [filepath_invalid])
+  assert results.loc[filepath_invalid, conditions.CONDITIONS].to_dict() == pipeline.pipeline(filepath_invalid, filepath_params)
+  assert results['error'].isna().all()
+
+
+# Part 17: Reduced precision
+
+@pytest.mark.parametrize('precision', ['float32', 'int16'])
+def test_reduced_precision(precision):
+  filepath_data, filepath_params = write_random_recording(n=6000, n_neurons=4, seed=17)
+  expected_result, expected_spikes = pipeline.pipeline(filepath_data, filepath_params, return_spikes=True)
+  actual_result, actual_spikes = pipeline.pipeline(filepath_data, filepath_params, return_spikes=True, precision=precision)
+  for key, expected in expected_result.items():
+    assert abs(actual_result[key] - expected) <= 0.01 * expected
+
+  # count_spikes, the batched detector and the instrumented per-neuron path agree exactly
+  data = pd.read_csv(filepath_data)
+  parameters = pipeline.load_parameters(filepath_params)
+  for ii, key in enumerate(actual_spikes.neurons):
+    assert np.array_equal(actual_spikes[ii], pipeline.count_spikes(data[key].to_numpy(), parameters['sample_rate'], parameters['threshold'], precision=precision))
+  with profiling.record(memory=False):
+    assert pipeline.pipeline(filepath_data, filepath_params, precision=precision) == actual_result
+  assert pipeline.pipeline(filepath_data, filepath_params, executor='threads', n_workers=2, precision=precision) == actual_result
+
+  # The smoothed traces take half the memory, the stored traces half or a quarter
+  traces = detection.traces_matrix(data, actual_spikes.neurons, precision=precision)
+  traces_smooth = detection.savgol_smooth(traces, detection.get_plan(parameters['sample_rate'], parameters['threshold']))
+  assert traces_smooth.dtype == np.float32
+  footprint = detection.memory_footprint(len(data), len(actual_spikes.neurons), precision)
+  assert footprint['smoothed'] == traces_smooth.nbytes
+  assert footprint['traces'] == (traces.counts if precision == 'int16' else traces).nbytes
+  assert footprint['saved'] == 16 * traces_smooth.size - footprint['total']
+
+  # Cached separately from float64 results
+  dir_cache = str((Path(tempfile.gettempdir()) / 'precision_cache').resolve().absolute())
+  cache.ResultCache(dir_cache).clear()
+  assert pipeline.pipeline(filepath_data, filepath_params, cache=dir_cache) == expected_result
+  assert pipeline.pipeline(filepath_data, filepath_params, cache=dir_cache, precision=precision) == actual_result
+
+  with pytest.raises(ValueError):
+    pipeline.pipeline(filepath_data, filepath_params, precision='float16')
+  with pytest.raises(ValueError):
+    pipeline.pipeline(filepath_data, filepath_params, precision=precision, chunk_size=1000)
+
+
+def test_quantize_adc_counts():
+  counts = np.random.default_rng(0).integers(-32767, 32768, size=(1000, 3)).astype(np.float64)
+  quantized = detection.quantize(counts)
+  assert np.array_equal(quantized.counts, counts) and np.all(quantized.scale == 1) and np.all(quantized.offset == 0)
+  # Other traces are rounded to half a quantization step
+  traces = counts * 0.37 + 12.5
+  quantized = detection.quantize(traces)
+  assert np.all(np.abs(quantized.counts * quantized.scale.astype(np.float64) + quantized.offset - traces) <= quantized.scale * 0.5001 + 1e-4)
+
+
+# Part 18: Interval-based conditions
+
+def test_epoch_intervals():
+  import util
+
+  rng = np.random.default_rng(18)
+  for n in [0, 1, 7, 1000]:
+    t, r, l = (rng.random(n) < p for p in [0.2, 0.5, 0.9])
+    epochs = intervals.epoch_intervals(t, r, l)
+    for key, column in zip('trl', (t, r, l)):
+      assert np.array_equal(epochs[key].to_mask(), column)
+      assert np.array_equal((~epochs[key]).to_mask(), ~column)
+    assert np.array_equal((epochs['t'] & epochs['r']).to_mask(), t & r)
+    assert np.array_equal((epochs['t'] | epochs['l']).to_mask(), t | l)
+    assert np.array_equal((epochs['r'] ^ epochs['l']).to_mask(), r ^ l)
+
+  # Memory scales with the number of transitions, not of samples
+  n = 10**6
+  data = util.make_fake_data(n, n_neurons=1, seed=0)
+  epochs = intervals.epoch_intervals(data['trial_on'], data['reward_on'], data['light_on'])
+  assert sum(epoch.nbytes for epoch in epochs.values()) < n // 10
+  assert epochs['t'] == intervals.Intervals.from_mask(data['trial_on'])
+
+
+def test_condition_expressions():
+  filepath_data, filepath_params = write_random_recording(n=6000, n_neurons=4, seed=18)
+  conditions_list = conditions.CONDITIONS + ['', 't & ~l', 'trial_on and not light_on', '(r | l) ^ t', '~tr']
+  result, spike_trains = pipeline.pipeline(filepath_data, filepath_params, return_spikes=True, conditions_list=conditions_list)
+  assert list(result) == conditions_list
+  assert {key: result[key] for key in conditions.CONDITIONS} == pipeline.pipeline(filepath_data, filepath_params)
+
+  data = pd.read_csv(filepath_data)
+  t, r, l = (data[key].to_numpy(dtype=bool) for key in ['trial_on', 'reward_on', 'light_on'])
+  masks = {'': np.ones(len(t), dtype=bool), 't & ~l': t & ~l, 'trial_on and not light_on': t & ~l, '(r | l) ^ t': (r | l) ^ t, '~tr': ~(t & r)}
+  for condition, mask in masks.items():
+    assert result[condition] == mask[spike_trains.spike_times].sum()
+  # The code histogram paths agree with the intervals
+  histogram = conditions.code_histogram(spike_trains.spike_times, conditions.epoch_codes(t, r, l))
+  assert conditions.count_conditions(histogram, conditions_list) == result
+  assert pipeline.pipeline(filepath_data, filepath_params, chunk_size=1000, conditions_list=conditions_list) == result
+
+  for condition in ['tx', 't + r', 'light', 't & f(r)']:
+    with pytest.raises(ValueError):
+      pipeline.pipeline(filepath_data, filepath_params, conditions_list=[condition])
+
+
+# Part 19: Fused smoothing and peak detection
+
+@pytest.mark.parametrize('engine', [
+  'numpy',
+  pytest.param('numba', marks=pytest.mark.skipif(not fused.HAVE_NUMBA, reason='numba is not installed')),
+])
+def test_fused_kernel(engine):
+  rng = np.random.default_rng(19)
+  for sample_rate, n, flat in [(10000, 5000, False), (5000, 3000, True), (3000, 700, False), (1500, 40, True)]:
+    traces = rng.normal(-40, 20, (n, 3))
+    if flat:
+      # Flat tops that straddle the blocks of the 'numpy' engine
+      traces = np.round(traces / 10) * 10
+    plan = detection.get_plan(float(sample_rate), 0.0)
+    expected = [pipeline.count_spikes(traces[:, ii], sample_rate, 0.0) for ii in range(3)]
+    for block_size in [7, fused.BLOCK_SIZE]:
+      spike_times, offsets = fused.find_peaks_fused(traces, plan, engine=engine, block_size=block_size)
+      for ii in range(3):
+        assert np.array_equal(spike_times[offsets[ii]:offsets[ii + 1]], expected[ii])
+    for precision in ['float32', 'int16']:
+      reduced = detection.as_precision(traces, precision)
+      assert all(np.array_equal(a, b) for a, b in zip(
+        fused.find_peaks_fused(reduced, plan, engine=engine),
+        detection.find_peaks_batched(detection.savgol_smooth(reduced, plan), plan.threshold, plan.distance),
+      ))
+
+  filepath_data, filepath_params = write_random_recording(n=6000, n_neurons=4, seed=19)
+  expected_result, expected_spikes = pipeline.pipeline(filepath_data, filepath_params, return_spikes=True)
+  result, spike_trains = pipeline.pipeline(filepath_data, filepath_params, return_spikes=True, fused=engine)
+  assert result == expected_result
+  assert np.array_equal(spike_trains.spike_times, expected_spikes.spike_times)
+  with pytest.raises(ValueError):
+    pipeline.pipeline(filepath_data, filepath_params, fused='cuda')
+  # Combinations the fused kernel does not run in are rejected, not ignored
+  for options in [{'executor': 'threads'}, {'chunk_size': 1000}, {'cache': tempfile.mkdtemp()}]:
+    with pytest.raises(ValueError):
+      pipeline.pipeline(filepath_data, filepath_params, fused=engine, **options)
+
+
+def test_fused_numpy_plateau(monkeypatch):
+  import time
+  # A saturated channel between two artifacts is one flat top peak across all blocks:
+  # only its start and value are carried until it ends
+  traces = np.full(200000, 20.0)
+  traces[[1000, 199000]] = 60.0
+  plan = detection.get_plan(2000.0, 9.0)
+  segments = []
+  local_maxima_batched = detection.local_maxima_batched
+  def spy(x, threshold):
+    segments.append(len(x))
+    return local_maxima_batched(x, threshold)
+  monkeypatch.setattr(detection, 'local_maxima_batched', spy)
+  tic = time.perf_counter()
+  spike_times, offsets = fused.find_peaks_fused(traces, plan, engine='numpy', block_size=1000)
+  assert time.perf_counter() - tic < 2.0
+  assert max(segments) <= 1000 + 1
+  assert np.array_equal(spike_times, pipeline.count_spikes(traces, 2000.0, 9.0))
+  assert 99999 in spike_times
+
+
+# Part 20: Resident pipeline service
+
+def test_service():
+  import threading
+  from my_pipeline import service
+
+  sessions = [write_random_recording(n=3000, n_neurons=3, seed=20 + ii) for ii in range(3)]
+  filepath_params = sessions[0][1]
+  expected = {filepath_data: pipeline.pipeline(filepath_data, filepath_params) for filepath_data, _ in sessions}
+
+  with service.PipelineService(filepath_params, executor='threads', n_workers=1, max_queue=1) as pipeline_service:
+    server = service.make_server(pipeline_service, ('127.0.0.1', 0))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+      with service.Client(server.server_address) as client:
+        assert client.health()['status'] == 'ok'
+        for filepath_data in expected:
+          result = client.run(filepath_data)
+          assert result['error'] is None
+          assert result['counts'] == expected[filepath_data]
+        assert client.run(filepath_data, chunk_size=1000)['counts'] == expected[filepath_data]
+        # Session errors are reported in the result, request errors raise
+        assert client.run(str(dir_parent / 'missing.csv'))['error'] is not None
+        with pytest.raises(ValueError):
+          client.run(filepath_data, filepath_parameters=str(dir_parent / 'missing.json'))
+        metrics = client.metrics()
+        assert (metrics['submitted'], metrics['completed'], metrics['failed']) == (5, 4, 1)
+        assert metrics['latency']['n'] == 5
+    finally:
+      server.shutdown()
+      server.server_close()
+
+    # Backpressure: one job running and one queued at most
+    futures = []
+    with pytest.raises(service.ServiceBusy):
+      for _ in range(20):
+        futures.append(pipeline_service.submit(filepath_data))
+    assert 2 <= len(futures) < 20
+    assert all(future.result()['counts'] == expected[filepath_data] for future in futures)
+    assert pipeline_service.metrics()['rejected'] == 1
+
+
+def test_service_client_retries():
+  import http.client
+  import socket
+  import threading
+  from my_pipeline import service
+  # A server that reads every request and hangs up without answering
+  listener = socket.create_server(('127.0.0.1', 0))
+  received = []
+  def hang_up():
+    while True:
+      try:
+        connection, _ = listener.accept()
+      except OSError:
+        return
+      with connection:
+        received.append(connection.recv(65536).split(b' ')[0])
+  threading.Thread(target=hang_up, daemon=True).start()
+  try:
+    with service.Client(listener.getsockname(), timeout=10) as client:
+      # A job that reached the server is never resubmitted
+      with pytest.raises(http.client.RemoteDisconnected):
+        client.run('session.csv')
+      assert received == [b'POST']
+      with pytest.raises(http.client.RemoteDisconnected):
+        client.health()
+      assert received == [b'POST', b'GET', b'GET']
+  finally:
+    listener.close()
+
+
+# Part 21: Schema-aware CSV reader
+
+@pytest.mark.parametrize('engine', readers.CSV_ENGINES)
+def test_csv_reader(engine):
+  filepath_data, filepath_params = write_random_recording(n=4000, n_neurons=12, seed=21)
+  expected = pd.read_csv(filepath_data, float_precision='round_trip' if engine == 'pyarrow' else None)
+
+  data = readers.read_csv(filepath_data, engine=engine)
+  assert list(data.keys()) == list(expected.columns)
+  for key in data.keys():
+    assert np.asarray(data[key]).dtype == (np.bool_ if key in validation.KEYS_EPOCHS else np.float64)
+    assert np.array_equal(np.asarray(data[key]), expected[key].to_numpy())
+  data = readers.read_csv(filepath_data, precision='int16', engine=engine)
+  assert all(np.asarray(data[key]).dtype == np.float32 for key in data.keys() if key not in validation.KEYS_EPOCHS)
+
+  # Neurons by name or glob pattern, in the order of the file
+  data = readers.read_csv(filepath_data, neurons=['neuron_1?', 'neuron_2'], engine=engine)
+  assert list(data.keys()) == ['trial_on', 'reward_on', 'light_on', 'neuron_2', 'neuron_10', 'neuron_11', 'neuron_12']
+  with pytest.raises(ValueError):
+    readers.read_csv(filepath_data, neurons=['neuron_13'], engine=engine)
+
+  keys = ['trial_on', 'reward_on', 'light_on', 'neuron_3', 'neuron_4']
+  filepath_subset = str(Path(tempfile.gettempdir()) / 'random_recording_subset.csv')
+  expected[keys].to_csv(filepath_subset, index=False)
+  result = pipeline.pipeline(filepath_subset, filepath_params, csv_engine=engine)
+  assert pipeline.pipeline(filepath_data, filepath_params, neurons=['neuron_3', 'neuron_4'], csv_engine=engine) == result
+  assert pipeline.pipeline(filepath_data, filepath_params, neurons='neuron_[34]', chunk_size=1000) == result
+  with tempfile.TemporaryDirectory() as directory:
+    assert pipeline.pipeline(filepath_data, filepath_params, neurons='neuron_[34]', cache=directory, csv_engine=engine) == result
+    assert pipeline.pipeline(filepath_data, filepath_params, cache=directory, csv_engine=engine) == pipeline.pipeline(filepath_data, filepath_params, csv_engine=engine)
+  assert pipeline.pipeline(filepath_data, filepath_params, neurons=['neuron_13']).empty
+
+  # Values that do not parse as the declared types are left to validation
+  invalid = expected[keys].astype({'reward_on': object, 'neuron_4': object})
+  invalid.loc[5, 'reward_on'] = None
+  invalid.loc[7, 'neuron_4'] = 'spike'
+  invalid.to_csv(filepath_subset, index=False)
+  errors = validation.validate_data(readers.read_csv(filepath_subset, engine=engine))
+  assert len(errors) == 2 and 'reward_on' in errors[0] and 'neuron_4' in errors[1]
+  assert pipeline.pipeline(filepath_subset, filepath_params, csv_engine=engine).empty
+  with pytest.raises(ValueError):
+    pipeline.pipeline(filepath_data, filepath_params, csv_engine='python')
+
+
+# Part 22: Pre-flight probe
+
+def test_probe_input(monkeypatch):
+  filepath_data, filepath_params = write_random_recording(n=4000, n_neurons=3, seed=22)
+  data = pd.read_csv(filepath_data)
+  filepath_invalid = str(Path(tempfile.gettempdir()) / 'probe_invalid.csv')
+  filepath_invalid_params = str(Path(tempfile.gettempdir()) / 'probe_invalid_params.json')
+  with open(filepath_invalid_params, 'w') as f:
+    json.dump({'sample_rate': 2000.0}, f)
+
+  # Files that are invalid in their first rows are never read in full
+  def read_data(*args, **kwargs):
+    raise AssertionError('data file read in full')
+  invalid = {
+    'no trial_on': data.drop(columns='trial_on'),
+    'no neurons': data[['trial_on', 'reward_on', 'light_on']],
+    'non-boolean epoch': data.astype({'light_on': object}).assign(light_on=lambda df: df['light_on'].where(df.index != 3, 'yes')),
+  }
+  with monkeypatch.context() as m:
+    m.setattr(readers, 'read_data', read_data)
+    m.setattr(readers, 'read_chunks', read_data)
+    for name, frame in invalid.items():
+      frame.to_csv(filepath_invalid, index=False)
+      assert pipeline.pipeline(filepath_invalid, filepath_params).empty, name
+      assert pipeline.pipeline(filepath_invalid, filepath_params, chunk_size=1000).empty, name
+      assert pipeline.pipeline(filepath_invalid, filepath_params, cache=tempfile.mkdtemp()).empty, name
+      ns_conditions, error = batch.run_session((filepath_invalid, {'sample_rate': 2000.0, 'threshold': 9.0}, None))
+      assert ns_conditions is None and 'validation failed' in error, name
+    assert pipeline.pipeline(filepath_data, filepath_params, neurons='neuron_9').empty
+
+    # The parameters are checked before the data file is opened
+    m.setattr(readers, 'read_head', read_data)
+    assert pipeline.pipeline(filepath_data, filepath_invalid_params).empty
+    assert pipeline.pipeline(filepath_data, '').empty
+
+  # Rows after the probed ones are still validated
+  late = data.copy()
+  late.loc[pipeline.PROBE_ROWS + 50, 'neuron_2'] = np.nan
+  late.to_csv(filepath_invalid, index=False)
+  assert pipeline.pipeline(filepath_invalid, filepath_params).empty
+
+  # Every format gives the first rows of read_data
+  with tempfile.TemporaryDirectory() as directory:
+    for filepath_out in [Path(directory) / 'npy', Path(directory) / 'data.parquet', Path(directory) / 'data.feather']:
+      readers.convert_csv(filepath_data, str(filepath_out))
+      full = readers.read_data(str(filepath_out))
+      for n_rows in [1, 37, 5000]:
+        head = readers.read_head(str(filepath_out), n_rows)
+        assert list(head.keys()) == list(full.keys())
+        for key in full.keys():
+          assert np.array_equal(head[key], full[key][:n_rows])
+      assert list(readers.read_head(str(filepath_out), 3, neurons='neuron_[12]')) == ['trial_on', 'reward_on', 'light_on', 'neuron_1', 'neuron_2']
+
+
+# Part 23: Waveform snippets and features
+
+@pytest.mark.parametrize('edge', snippets.EDGES)
+def test_snippets(edge):
+  import scipy.signal
+
+  rng = np.random.default_rng(23)
+  n, before, after = 3000, 5, 8
+  traces = np.round(rng.normal(0, 5, (n, 3)), 1)
+  spike_trains = spikes.SpikeTrains.from_list([np.array([0, 3, 100, 2000, 2995]), np.array([], dtype=np.int64), np.array([1500, n - 1])])
+
+  # Same as slicing every spike by hand
+  result = snippets.extract_snippets(traces, spike_trains, before, after, edge=edge)
+  expected, expected_times = [], []
+  for ii, spike_times in enumerate(spike_trains):
+    for t in spike_times:
+      positions = np.arange(t - before, t + after + 1)
+      outside = (positions < 0) | (positions >= n)
+      if edge == 'drop' and outside.any():
+        continue
+      snippet = traces[np.clip(positions, 0, n - 1), ii]
+      expected.append(np.where(outside, np.nan, snippet) if edge == 'fill' else snippet)
+      expected_times.append(t)
+  assert np.array_equal(result.waveforms, np.array(expected), equal_nan=True)
+  assert np.array_equal(result.spike_times, expected_times)
+  assert np.array_equal(result[2], result.waveforms[result.offsets[2]:], equal_nan=True)
+  assert np.shares_memory(result[2], result.waveforms)
+  assert result.spike_trains().counts().sum() == len(expected)
+
+  # Features of the spikes away from the edges are those of scipy
+  features = result.features()
+  inside = [ii for ii, t in enumerate(expected_times) if before <= t < n - after]
+  for ii in inside:
+    snippet = result.waveforms[ii]
+    assert features['amplitude'][ii] == snippet[before]
+    with warnings.catch_warnings():
+      warnings.simplefilter('ignore')  # the random spike times are not all peaks
+      assert features['half_width'][ii] == scipy.signal.peak_widths(snippet, [before])[0][0]
+    assert features['trough_delay'][ii] == np.argmin(snippet[before:])
+    assert features['trough'][ii] == snippet[before:].min()
+  assert np.all(np.isfinite(features['half_width']))
+
+  # int16 traces are calibrated, and large snippets spill to a .npy file
+  quantized = detection.traces_matrix({str(ii): traces[:, ii] for ii in range(3)}, ['0', '1', '2'], precision='int16')
+  calibrated = snippets.extract_snippets(quantized.counts * quantized.scale + quantized.offset, spike_trains, before, after, edge=edge)
+  with tempfile.TemporaryDirectory() as directory:
+    filepath = str(Path(directory) / 'snippets.npy')
+    spilled = snippets.extract_snippets(quantized, spike_trains, before, after, edge=edge, spill=filepath, spill_bytes=0)
+    assert isinstance(spilled.waveforms, np.memmap) and spilled.waveforms.dtype == np.float32
+    assert np.array_equal(np.load(filepath), calibrated.waveforms, equal_nan=True)
+    del spilled
+  with pytest.raises(ValueError):
+    snippets.extract_snippets(traces[:, :2], spike_trains, before, after)
+
+
 # def run_all_tests():
 #   test_importing_packages()
 #   test_invalid_input_files()
@@ -19,33 +19,233 @@ def make_fake_parameters(filepath_save=r'~/Desktop/parameters.json'):
     with open(filepath_save, 'w') as f:
         json.dump(parameters, f)
 
-def make_fake_data_file(filepath_save=r'~/Desktop/data.csv'):
+def make_fake_data_file(filepath_save=r'~/Desktop/data.csv', n=100000, n_neurons=7, seed=None, chunk_size=2**20, n_workers=None, fmt=None):
     """
-    Make a fake data file.
+    Make a fake data file, chunk by chunk so that memory does not grow with n.
 
     Args:
         filepath_save (str):
-            Filepath to save the data file.
+            Filepath to save the data file (a directory for 'npy').
+        n, n_neurons, seed, chunk_size, n_workers:
+            See iter_fake_traces.
+        fmt (str):
+            'csv', 'parquet', or 'npy' (a directory of .npy arrays, read by
+             readers.read_data; by far the fastest to write, about the speed
+             of the generator). None: 'parquet' for a '.parquet'/'.pq'
+             extension, else 'csv'.
+    """
+    from pathlib import Path
+    from my_pipeline import readers
+
+    path = Path(filepath_save).expanduser()
+    if fmt is None:
+        fmt = 'parquet' if path.suffix.lower() in readers.SUFFIXES_PARQUET else 'csv'
+    if fmt not in ['csv', 'parquet', 'npy']:
+        raise ValueError("fmt must be 'csv', 'parquet' or 'npy', got: " + repr(fmt))
+    ## Chunks of the .npy writer are a multiple of 8 rows (the data do not
+    ##  depend on the chunk size)
+    chunk_size = max(8, chunk_size - chunk_size % 8)
+    chunks = iter_fake_data(n, n_neurons, seed, chunk_size, n_workers)
+    if fmt == 'csv':
+        for ii, chunk in enumerate(chunks):
+            chunk.to_csv(path, index=False, header=(ii == 0), mode='w' if ii == 0 else 'a')
+    elif fmt == 'parquet':
+        import pyarrow as pa
+        import pyarrow.parquet
+        writer = None
+        try:
+            for chunk in chunks:
+                table = pa.Table.from_pandas(chunk, preserve_index=False)
+                if writer is None:
+                    writer = pyarrow.parquet.ParquetWriter(str(path), table.schema)
+                writer.write_table(table)
+        finally:
+            if writer is not None:
+                writer.close()
+    else:
+        readers.write_npy_chunks(chunks, str(path), n)
+
+def make_fake_data(n=100000, n_neurons=7, seed=None, n_workers=None):
+    """
+    Make the columns of a fake data file.
+
+    Args:
+        n, n_neurons, seed, n_workers:
+            See iter_fake_traces.
+
+    Returns:
+        data (dict):
+            'trial_on', 'reward_on' and 'light_on' boolean columns, then
+             'neuron_1' ... 'neuron_<n_neurons>' voltage traces (views of one
+             Fortran-ordered (n, n_neurons) array).
+    """
+    import numpy as np
+
+    data = fake_epochs(0, n)
+    traces = next(iter_fake_traces(n, n_neurons, seed, chunk_size=max(n, 1), n_workers=n_workers), np.empty((0, n_neurons)))
+    data.update({f"neuron_{ii + 1}": traces[:, ii] for ii in range(n_neurons)})
+    return data
+
+def iter_fake_data(n=100000, n_neurons=7, seed=None, chunk_size=2**20, n_workers=None):
+    """
+    Make a fake data file as consecutive pandas DataFrames of chunk_size rows
+     (see iter_fake_traces).
     """
     import pandas as pd
+
+    start = 0
+    for traces in iter_fake_traces(n, n_neurons, seed, chunk_size, n_workers):
+        chunk = fake_epochs(start, start + len(traces))
+        chunk.update({f"neuron_{ii + 1}": traces[:, ii] for ii in range(n_neurons)})
+        start += len(traces)
+        yield pd.DataFrame(chunk, copy=False)
+
+def fake_epochs(start, stop):
+    """
+    Epoch columns of the fake data for samples start ... stop - 1: trials of
+     1000 samples, reward in their last quarter and light on for 1100 out of
+     every 2000 samples.
+    """
     import numpy as np
 
-    N = 100000
+    t = np.arange(start, stop)
+    return {
+        'trial_on': (t % 1000) > 500,
+        'reward_on': (t % 1000) > 750,
+        'light_on': (t % 2000) > 900,
+    }
+
+def iter_fake_traces(n=100000, n_neurons=7, seed=None, chunk_size=2**20, n_workers=None):
+    """
+    Fast, reproducible version of make_fake_voltage_trace for all neurons at
+     once, as consecutive (chunk_size, n_neurons) Fortran-ordered arrays.
 
-    data = {}
+    The traces have the statistics of make_fake_voltage_trace: Gaussian noise
+     around -70 mV and spikes of the same shape and rate. Instead of
+     thresholding the noise, threshold crossings are drawn directly as
+     geometric gaps between spike indices, and the spike kernel is added only
+     around the spikes. The noise of make_fake_voltage_trace is the sum of two
+     Gaussians; here it is one Gaussian with the same total variance.
 
-    data['trial_on'] = ((np.arange(N) % 1000) > 500).astype(np.bool_)
-    data['reward_on'] = ((np.arange(N) % 1000) > 750).astype(np.bool_)
-    data['light_on'] = ((np.arange(N) % 2000) > 900).astype(np.bool_)
+    Every neuron has its own generators, spawned from seed, so the data do not
+     depend on chunk_size and neuron ii is the same whatever n_neurons is.
+
+    Args:
+        n (int):
+            Number of samples.
+        n_neurons (int):
+            Number of neuron voltage traces.
+        seed (int):
+            Seed of the data. If None, fresh entropy is used.
+        chunk_size (int):
+            Number of samples per chunk.
+        n_workers (int):
+            Number of threads drawing the noise of the neurons in parallel
+             (numpy's generators release the GIL). Defaults to os.cpu_count().
+
+    Yields:
+        traces (np.ndarray):
+            float64 array of shape (min(chunk_size, samples left), n_neurons).
+    """
+    import math
+    import os
+    from concurrent.futures import ThreadPoolExecutor
+    import numpy as np
+
+    baseline_voltage = -70
+    spike_voltage = 100
+    threshold_voltage = -45
+    refractory_period = 40 # samples, as in make_fake_voltage_trace
+    spike_width = 1 # ms (std)
+    variance = 8
+    noise_std = 10
+    sample_rate = 10000 # Hz
+
+    ## Probability that the first noise of make_fake_voltage_trace crosses the threshold
+    z = (threshold_voltage - baseline_voltage) / variance
+    probability = 0.5 * math.erfc(z / math.sqrt(2))
+
+    ## scipy.signal.windows.gaussian(width * 5, width), peak-normalized and
+    ##  placed as np.convolve(..., mode='same') places it
+    width = spike_width / 1000 * sample_rate
+    kernel_size = int(width * 5)
+    kernel = np.exp(-0.5 * ((np.arange(kernel_size) - (kernel_size - 1) / 2) / width) ** 2)
+    kernel = kernel / kernel.max() * spike_voltage
+    kernel_shifts = np.arange(kernel_size) - (kernel_size - 1) // 2
+
+    sequences = np.random.SeedSequence(seed).spawn(n_neurons)
+    rngs_noise, neurons_spikes = [], []
+    for sequence in sequences:
+        sequence_noise, sequence_spikes = sequence.spawn(2)
+        rngs_noise.append(np.random.default_rng(sequence_noise))
+        neurons_spikes.append(_FakeSpikes(np.random.default_rng(sequence_spikes), probability, refractory_period))
+
+    noise_total = math.hypot(variance, noise_std)
+    def draw_noise(ii, trace):
+        rngs_noise[ii].standard_normal(out=trace)
+        trace *= noise_total
+        trace += baseline_voltage
+
+    pool = ThreadPoolExecutor(max_workers=n_workers or os.cpu_count() or 1)
+    try:
+        for start in range(0, n, max(1, chunk_size)):
+            stop = min(start + chunk_size, n)
+            traces = np.empty((stop - start, n_neurons), dtype=np.float64, order='F')
+            list(pool.map(draw_noise, range(n_neurons), [traces[:, ii] for ii in range(n_neurons)]))
+
+            ## Stamp the kernel of every spike overlapping the chunk, including
+            ##  spikes of the neighbouring chunks
+            lo, hi = start - kernel_shifts[-1], stop - kernel_shifts[0]
+            spike_times = [spikes.window(lo, hi) for spikes in neurons_spikes]
+            neurons = np.repeat(np.arange(n_neurons), [len(times) for times in spike_times])
+            spike_times = np.concatenate(spike_times + [np.empty(0, dtype=np.int64)]) - start
+            flat = traces.reshape(-1, order='F')
+            for shift, value in zip(kernel_shifts, kernel):
+                t = spike_times + shift
+                inside = (t >= 0) & (t < stop - start)
+                ## Spikes of one neuron are distinct, so no index repeats within a shift
+                flat[neurons[inside] * (stop - start) + t[inside]] += value
+            yield traces
+    finally:
+        pool.shutdown()
+
+class _FakeSpikes:
+    """
+    Spike times of one fake neuron, drawn lazily in increasing order.
+    Threshold crossings are a Bernoulli process, so the gaps between them are
+     geometric; a crossing is kept as a spike if it comes at least
+     refractory_period samples after the previous crossing (kept or not),
+     exactly as in make_fake_voltage_trace.
+    """
+    def __init__(self, rng, probability, refractory_period, batch_size=1024):
+        import numpy as np
 
-    voltages = {f"neuron_{ii + 1}": make_fake_voltage_trace(N) for ii in range(7)}
+        self.rng = rng
+        self.probability = probability
+        self.refractory_period = refractory_period
+        self.batch_size = batch_size
+        ## Last crossing drawn. make_fake_voltage_trace compares the first
+        ##  crossing to 0, and the first gap starts before sample 0.
+        self.last_crossing = 0
+        self.position = -1
+        self.times = np.empty(0, dtype=np.int64)
 
-    ## Make dataframe with named columns
-    data.update(voltages)
-    data_df = pd.DataFrame(data)
+    def window(self, start, stop):
+        """
+        Spike times in [start, stop). start must not decrease between calls:
+         earlier spikes are forgotten.
+        """
+        import numpy as np
 
-    ## Save to CSV
-    data_df.to_csv(filepath_save, index=False)
+        ## Gaps are always drawn in batches of batch_size, so the random stream
+        ##  (and the spikes) do not depend on the windows asked for.
+        while self.position < stop:
+            crossings = self.position + np.cumsum(self.rng.geometric(self.probability, self.batch_size))
+            keep = np.diff(crossings, prepend=self.last_crossing) >= self.refractory_period
+            self.times = np.concatenate([self.times, crossings[keep]])
+            self.position = self.last_crossing = crossings[-1]
+        self.times = self.times[self.times >= start]
+        return self.times[self.times < stop]
 
 def make_fake_voltage_trace(n):
     """
@@ -54,6 +254,7 @@ def make_fake_voltage_trace(n):
     Spike voltage: +80 mV
     Spike width: 2 ms
     Noise: Gaussian with mean 0 and std 5 mV
+    Reference for iter_fake_traces, which is much faster at scale.
     """
     import numpy as np
     import scipy.signal
@@ -86,14 +287,17 @@ def make_fake_voltage_trace(n):
     return voltage_trace
 
 
-# Write fake data to filepath_data and filepath_params files for testing
+# Write fake data to filepath_data and filepath_params files for testing.
+# Only when run as a script, so that the generators can be imported (e.g. by
+# the benchmarks) without writing files.
 
-from pathlib import Path
+if __name__ == '__main__':
+    from pathlib import Path
 
-dir_parent = Path(__file__).parent
+    dir_parent = Path(__file__).parent
 
-test_filepath_data = str(dir_parent / "data.csv")
-test_filepath_parameters = str(dir_parent / "params.json")
+    test_filepath_data = str(dir_parent / "data.csv")
+    test_filepath_parameters = str(dir_parent / "params.json")
 
-make_fake_data_file(test_filepath_data)
-make_fake_parameters(test_filepath_parameters)
+    make_fake_data_file(test_filepath_data)
+    make_fake_parameters(test_filepath_parameters)